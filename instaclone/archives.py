@@ -6,13 +6,23 @@ from __future__ import print_function
 
 __author__ = 'jlevy'
 
+import errno
 import sys
 import os
+import stat
+import struct
 import tarfile
 import tempfile
 import itertools
+import threading
+import zlib
+import Queue
 import logging as log
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from contextlib import contextmanager
+from distutils.spawn import find_executable
 
 from functools32 import lru_cache  # functools32 pip
 
@@ -24,14 +34,52 @@ except ImportError:
 
 from strif import shell_expand_to_popen, DEV_NULL
 
+import tracing
+import trees
+
 SHELL_OUTPUT = sys.stderr
 
+BLOCK_SIZE = 2 ** 20
+
+# Window bits for zlib to read or write gzip format.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 
 class ArchiveError(RuntimeError):
   pass
 
 
-_Archiver = namedtuple("_Archiver", "suffix archive unarchive")
+# An archiver handles one archive format. It can archive a directory to a file, and
+# unarchive a file to a directory. If streaming is set, these also accept file objects,
+# which are written or read sequentially. Archiving takes an optional compression level,
+# from the lowest to the highest of levels, and number of threads to compress with.
+_Archiver = namedtuple("_Archiver", "name suffix magic archive unarchive streaming levels")
+
+_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+# Files with these suffixes are already compressed, so are stored rather than
+# compressed again, where the archive format allows it.
+COMPRESSED_SUFFIXES = (".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".zip", ".jar", ".war", ".whl",
+                       ".7z", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp3", ".mp4", ".woff", ".woff2")
+
+GZIP_DEFAULT_LEVEL = 9
+
+# Size of independently compressed blocks when compressing gzip in parallel.
+GZIP_PARALLEL_BLOCK_SIZE = 2 ** 20
+
+# Python 2 can't interrupt a wait on a result without a timeout, so we use a long one.
+_WAIT_FOREVER = 2 ** 31
+
+# Number of leading bytes needed to recognize any archive format.
+MAGIC_SIZE = 6
+
+
+def is_compressed_name(name):
+  return name.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+def default_threads():
+  return cpu_count()
 
 
 def followlink(path, max_follows=10):
@@ -53,7 +101,46 @@ def followlink(path, max_follows=10):
   return path
 
 
-def targz_dir(source_dir, target_archive, dereference_ext_symlinks=True):
+def _describe(target):
+  return target if isinstance(target, basestring) else "stream"
+
+
+@contextmanager
+def _open_target(target):
+  if hasattr(target, "write"):
+    yield target
+  else:
+    with open(target, "wb") as f:
+      yield f
+
+
+@contextmanager
+def _open_source(source):
+  if hasattr(source, "read"):
+    yield source
+  else:
+    with open(source, "rb") as f:
+      yield f
+
+
+def _drain(stream):
+  while stream.read(BLOCK_SIZE):
+    pass
+
+
+def _flush_tar_stream(tf):
+  """Write out what a tarfile opened for streaming ("w|") has buffered."""
+  stream = tf.fileobj
+  if stream.buf:
+    stream.fileobj.write(stream.buf)
+    stream.buf = ""
+
+
+def _tar_dir(source_dir, fileobj, dereference_ext_symlinks=True, on_member=None):
+  """
+  Write a directory as a tar stream to a file object. If set, on_member is called with
+  each member just before it is written.
+  """
   norm_source_dir = os.path.normpath(source_dir)
   total = itertools.count()
   symlinks = itertools.count()
@@ -76,26 +163,653 @@ def targz_dir(source_dir, target_archive, dereference_ext_symlinks=True):
           symlinks_followed.next()
         else:
           raise ArchiveError("Absolute path in symlink target not supported: %r -> %r" % (tarinfo.name, target))
+    if on_member:
+      # tarfile buffers up to a record of what it writes, so the end of the last member
+      # must be written out first, for on_member to apply from this member on.
+      _flush_tar_stream(tf)
+      on_member(tarinfo)
     return tarinfo
 
-  with tarfile.open(target_archive, "w:gz") as tf:
-    log.info("creating archive: %s -> %s", source_dir, target_archive)
+  with tarfile.open(fileobj=fileobj, mode="w|") as tf:
     tf.add(source_dir, arcname=".", filter=tarinfo_filter)
 
   log.info("added %s items to archive (%s were symlinks, %s followed)",
            total.next(), symlinks.next(), symlinks_followed.next())
 
 
-def untargz_dir(source_archive, target_dir):
-  with tarfile.open(source_archive, "r:gz") as tf:
-    tf.extractall(path=target_dir)
+def _archive_tar(writer_factory, source_dir, target_archive, dereference_ext_symlinks=True):
+  """Archive a directory as a tar stream, compressed by a writer from writer_factory."""
+  log.info("creating archive: %s -> %s", source_dir, _describe(target_archive))
+  with _open_target(target_archive) as fileobj:
+    writer = writer_factory(fileobj)
+    try:
+      on_member = None
+      if hasattr(writer, "set_storing"):
+        min_size = getattr(writer, "min_stored_size", 0)
+        on_member = lambda tarinfo: writer.set_storing(tarinfo.isfile() and tarinfo.size >= min_size and
+                                                       is_compressed_name(tarinfo.name))
+      _tar_dir(source_dir, writer, dereference_ext_symlinks=dereference_ext_symlinks, on_member=on_member)
+    except:
+      writer.abort()
+      raise
+    writer.close()
+
+
+class _ReadOnlyTarFile(tarfile.TarFile):
+  """
+  Extracts members with write permission removed. Since tarfile sets the modes of
+  directories after extracting everything, they are still writable while filled.
+  """
+
+  def chmod(self, tarinfo, targetpath):
+    if hasattr(os, "chmod"):
+      try:
+        os.chmod(targetpath, tarinfo.mode & ~_WRITE_BITS)
+      except EnvironmentError as e:
+        raise tarfile.ExtractError("could not change mode: %s" % e)
+
+
+def _unarchive_tar(reader_factory, source_archive, target_dir, readonly=False):
+  """
+  Extract a tar stream, decompressed by a reader from reader_factory. If readonly is
+  set, everything is extracted without write permission.
+  """
+  tar_class = _ReadOnlyTarFile if readonly else tarfile.TarFile
+  with _open_source(source_archive) as fileobj:
+    reader = reader_factory(fileobj)
+    try:
+      with tar_class.open(fileobj=reader, mode="r|") as tf:
+        tf.extractall(path=target_dir)
+      # Read to the end, so the reader can check the whole stream is valid.
+      _drain(reader)
+    except:
+      reader.abort()
+      raise
+    reader.close()
+
+
+class GzipStreamWriter(object):
+  """
+  A file object that gzip compresses everything written to it onto another file object.
+  Data that is already compressed can be stored instead, in a separate uncompressed
+  gzip member (all gzip readers handle streams with multiple members).
+  """
+
+  def __init__(self, fileobj, level=None):
+    self.fileobj = fileobj
+    self.level = GZIP_DEFAULT_LEVEL if level is None else level
+    self.storing = False
+    self._new_member()
+
+  def _new_member(self):
+    self.compressor = zlib.compressobj(0 if self.storing else self.level, zlib.DEFLATED, GZIP_WBITS)
+    self.member_empty = True
+
+  def set_storing(self, storing):
+    if storing != self.storing:
+      if not self.member_empty:
+        self.fileobj.write(self.compressor.flush())
+      self.storing = storing
+      self._new_member()
+
+  def write(self, data):
+    if data:
+      self.member_empty = False
+      self.fileobj.write(self.compressor.compress(data))
+
+  def close(self):
+    self.fileobj.write(self.compressor.flush())
+
+  def abort(self):
+    pass
+
+
+def _gzip_member(data, level):
+  # Note zlib releases the GIL while compressing, so this runs in parallel on threads.
+  compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+  return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter(object):
+  """
+  Like GzipStreamWriter, but compresses blocks of data on a pool of threads, writing
+  each block as a separate gzip member, in order, like pigz does. Standard gzip
+  tools read the result like any other gzip file.
+  """
+
+  def __init__(self, fileobj, level=None, threads=None, block_size=GZIP_PARALLEL_BLOCK_SIZE):
+    self.fileobj = fileobj
+    self.level = GZIP_DEFAULT_LEVEL if level is None else level
+    self.threads = threads or default_threads()
+    self.block_size = block_size
+    self.storing = False
+    self.buffer = []
+    self.buffered = 0
+    self.pending = deque()
+    # Bound how far compression gets ahead of writing, to bound memory use.
+    self.max_pending = 2 * self.threads
+    self.pool = ThreadPool(processes=self.threads)
+
+  def _submit_block(self):
+    if not self.buffered:
+      return
+    data = "".join(self.buffer)
+    self.buffer = []
+    self.buffered = 0
+    level = 0 if self.storing else self.level
+    self.pending.append(self.pool.apply_async(_gzip_member, (data, level)))
+    while len(self.pending) > self.max_pending:
+      self._write_next()
+
+  def _write_next(self):
+    self.fileobj.write(self.pending.popleft().get(_WAIT_FOREVER))
+
+  def set_storing(self, storing):
+    if storing != self.storing:
+      self._submit_block()
+      self.storing = storing
+
+  def write(self, data):
+    self.buffer.append(data)
+    self.buffered += len(data)
+    if self.buffered >= self.block_size:
+      self._submit_block()
+
+  def close(self):
+    try:
+      self._submit_block()
+      while self.pending:
+        self._write_next()
+    finally:
+      self.pool.close()
+      self.pool.join()
+
+  def abort(self):
+    self.pool.terminate()
+    self.pool.join()
+
+
+class GzipStreamReader(object):
+  """
+  A file object that decompresses a gzip stream read sequentially from another file
+  object. It handles multi-member streams and, unlike tarfile's "r|gz" mode, checks
+  that the stream is complete, so that a truncated download is an error. Input is
+  decompressed at most block_size bytes of output at a time, as it is read, so memory
+  stays bounded however well the data compresses.
+  """
+
+  def __init__(self, fileobj, block_size=BLOCK_SIZE):
+    self.fileobj = fileobj
+    self.block_size = block_size
+    self.decompressor = zlib.decompressobj(GZIP_WBITS)
+    self.in_member = False
+    self.seen_data = False
+    # Input read but not yet decompressed, and whether the decompressor may hold output.
+    self.pending = ""
+    self.draining = False
+    self.buffer = ""
+    self.pos = 0
+    self.eof = False
+
+  def _decompress(self):
+    self.in_member = True
+    out = self.decompressor.decompress(self.pending, self.block_size)
+    if self.decompressor.unused_data:
+      # The member ended and another follows.
+      self.pending = self.decompressor.unused_data
+      self.decompressor = zlib.decompressobj(GZIP_WBITS)
+    else:
+      self.pending = self.decompressor.unconsumed_tail
+    # Once output is cut off at the limit, there may be more even with no input left.
+    self.draining = len(out) == self.block_size
+    return out
+
+  def _check_complete(self):
+    if not self.seen_data:
+      raise ArchiveError("Archive is empty")
+    if self.in_member:
+      # Once a member is complete, any further input is left unused. If the member
+      # is incomplete, the input is consumed instead.
+      try:
+        self.decompressor.decompress("\0")
+      except zlib.error:
+        pass
+      if not self.decompressor.unused_data:
+        raise ArchiveError("Archive is truncated")
+
+  def _fill(self):
+    if not self.pending and not self.draining:
+      self.pending = self.fileobj.read(self.block_size)
+      if not self.pending:
+        self._check_complete()
+        self.eof = True
+        return
+      self.seen_data = True
+    self.buffer = self.buffer[self.pos:] + self._decompress()
+    self.pos = 0
+
+  def read(self, size=-1):
+    while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+      self._fill()
+    end = len(self.buffer) if size < 0 else min(self.pos + size, len(self.buffer))
+    data = self.buffer[self.pos:end]
+    self.pos = end
+    return data
+
+  def close(self):
+    pass
+
+  def abort(self):
+    pass
+
+
+class PipelinedReader(object):
+  """
+  A file object that reads another file object on a separate thread, a block ahead, so
+  work done there (like decompression) overlaps with work done by the caller (like
+  parsing and writing out files).
+  """
+
+  def __init__(self, fileobj, block_size=BLOCK_SIZE, depth=4):
+    self.fileobj = fileobj
+    self.block_size = block_size
+    self.queue = Queue.Queue(depth)
+    self.aborted = False
+    self.buffer = ""
+    self.pos = 0
+    self.eof = False
+    self.thread = threading.Thread(target=self._read_ahead)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _put(self, item):
+    while not self.aborted:
+      try:
+        self.queue.put(item, timeout=0.1)
+        return
+      except Queue.Full:
+        pass
+
+  def _read_ahead(self):
+    try:
+      while not self.aborted:
+        data = self.fileobj.read(self.block_size)
+        self._put((data, None))
+        if not data:
+          break
+    except Exception:
+      self._put((None, sys.exc_info()))
+
+  def _fill(self):
+    (data, exc_info) = self.queue.get(timeout=_WAIT_FOREVER)
+    if exc_info:
+      self.eof = True
+      raise exc_info[0], exc_info[1], exc_info[2]
+    if data:
+      self.buffer = self.buffer[self.pos:] + data
+      self.pos = 0
+    else:
+      self.eof = True
+
+  def read(self, size=-1):
+    while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+      self._fill()
+    end = len(self.buffer) if size < 0 else min(self.pos + size, len(self.buffer))
+    data = self.buffer[self.pos:end]
+    self.pos = end
+    return data
+
+  def close(self):
+    self.thread.join()
+    self.fileobj.close()
+
+  def abort(self):
+    # Don't wait for the thread, which may be blocked reading. It stops once the
+    # underlying stream is closed.
+    self.aborted = True
+    self.fileobj.abort()
+
+
+@lru_cache()
+def _require_command(name):
+  path = find_executable(name)
+  if not path:
+    raise ArchiveError("Archive format requires '%s' in path" % name)
+  return path
+
+
+def _copy_in_thread(source, target, errors, close_target=False):
+  def copy():
+    try:
+      while True:
+        data = source.read(BLOCK_SIZE)
+        if not data:
+          break
+        target.write(data)
+    except Exception:
+      errors.append(sys.exc_info())
+    finally:
+      if close_target:
+        try:
+          target.close()
+        except IOError:
+          pass
+
+  thread = threading.Thread(target=copy)
+  thread.daemon = True
+  thread.start()
+  return thread
+
+
+class _CommandStream(object):
+  """Common handling of a compression or decompression command and its copier thread."""
+
+  def _start(self, popenargs, **kwargs):
+    self.popenargs = popenargs
+    self.errors = []
+    self.copier = None
+    log.debug("archive command: %s", " ".join(popenargs))
+    self.process = subprocess.Popen(popenargs, stderr=SHELL_OUTPUT, **kwargs)
+
+  def _finish(self):
+    if self.copier:
+      self.copier.join()
+    status = self.process.wait()
+    # A failed command usually also breaks the copy, with a broken pipe, and then its status
+    # is more useful. But if the copy failed first, say reading its source, that's the cause.
+    copy_error = self.errors[0][1] if self.errors else None
+    if status and (copy_error is None or getattr(copy_error, "errno", None) == errno.EPIPE):
+      raise ArchiveError("Archive command failed with status %s: %s" % (status, " ".join(self.popenargs)))
+    if self.errors:
+      exc_info = self.errors[0]
+      raise exc_info[0], exc_info[1], exc_info[2]
+
+  def abort(self):
+    try:
+      self.process.kill()
+    except OSError:
+      pass
+    self.process.wait()
+
+
+class _CommandWriter(_CommandStream):
+  """A file object that pipes everything written to it through a command onto another file object."""
+
+  def __init__(self, popenargs, fileobj):
+    if isinstance(fileobj, file):
+      # Pass the file directly, so no copying is needed.
+      fileobj.flush()
+      self._start(popenargs, stdin=subprocess.PIPE, stdout=fileobj)
+    else:
+      self._start(popenargs, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      self.copier = _copy_in_thread(self.process.stdout, fileobj, self.errors)
+
+  def write(self, data):
+    self.process.stdin.write(data)
+
+  def close(self):
+    self.process.stdin.close()
+    self._finish()
+
+
+class _StoredZstdFrame(object):
+  """Writes data uncompressed as a zstd frame of raw blocks."""
+
+  # A 128KiB window, which is also the largest block size.
+  HEADER = "\x28\xb5\x2f\xfd\x00\x38"
+  BLOCK_SIZE = 2 ** 17
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.buffer = ""
+    fileobj.write(self.HEADER)
+
+  def _write_block(self, data, last):
+    header = struct.pack("<I", len(data) << 3 | int(last))[:3]
+    self.fileobj.write(header + data)
+
+  def write(self, data):
+    self.buffer += data
+    # The last block is marked, so a full block is only written once more follows it.
+    while len(self.buffer) > self.BLOCK_SIZE:
+      self._write_block(self.buffer[:self.BLOCK_SIZE], False)
+      self.buffer = self.buffer[self.BLOCK_SIZE:]
+
+  def close(self):
+    self._write_block(self.buffer, True)
+
+
+class _StoredLz4Frame(object):
+  """Writes data uncompressed as an lz4 frame of uncompressed blocks."""
+
+  # Independent blocks of at most 64KiB, with no checksums, and the header checksum.
+  HEADER = "\x04\x22\x4d\x18\x60\x40\x82"
+  BLOCK_SIZE = 2 ** 16
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    fileobj.write(self.HEADER)
+
+  def write(self, data):
+    for start in xrange(0, len(data), self.BLOCK_SIZE):
+      block = data[start:start + self.BLOCK_SIZE]
+      self.fileobj.write(struct.pack("<I", len(block) | 0x80000000) + block)
+
+  def close(self):
+    self.fileobj.write("\0\0\0\0")
+
+
+def _xz_varint(value):
+  out = ""
+  while value >= 0x80:
+    out += chr(value & 0x7f | 0x80)
+    value >>= 7
+  return out + chr(value)
+
+
+def _crc32(data, crc=0):
+  return struct.pack("<I", zlib.crc32(data, crc) & 0xffffffff)
+
+
+class _StoredXzStream(object):
+  """Writes data uncompressed as an xz stream, of one block of uncompressed LZMA2 chunks."""
+
+  # Stream flags for a CRC32 check on the block.
+  FLAGS = "\x00\x01"
+  # An LZMA2 filter, with the smallest dictionary, padded, with its size in the first byte.
+  BLOCK_HEADER = "\x02\x00\x21\x01\x00\x00\x00\x00"
+  CHUNK_SIZE = 2 ** 16
+
+  def __init__(self, fileobj):
+    self.fileobj = fileobj
+    self.crc = 0
+    self.size = 0
+    self.compressed_size = 0
+    fileobj.write("\xfd7zXZ\x00" + self.FLAGS + _crc32(self.FLAGS))
+
+  def write(self, data):
+    if not data:
+      return
+    if not self.size:
+      self.fileobj.write(self.BLOCK_HEADER + _crc32(self.BLOCK_HEADER))
+    for start in xrange(0, len(data), self.CHUNK_SIZE):
+      chunk = data[start:start + self.CHUNK_SIZE]
+      # The first chunk resets the dictionary.
+      control = "\x02" if self.size else "\x01"
+      self.fileobj.write(control + struct.pack(">H", len(chunk) - 1) + chunk)
+      self.crc = zlib.crc32(chunk, self.crc)
+      self.size += len(chunk)
+      self.compressed_size += 3 + len(chunk)
+
+  def close(self):
+    records = ""
+    if self.size:
+      self.compressed_size += 1
+      padding = "\0" * (-self.compressed_size % 4)
+      self.fileobj.write("\x00" + padding + struct.pack("<I", self.crc & 0xffffffff))
+      unpadded_size = len(self.BLOCK_HEADER) + 4 + self.compressed_size + 4
+      records = _xz_varint(unpadded_size) + _xz_varint(self.size)
+    index = "\x00" + _xz_varint(1 if self.size else 0) + records
+    index += "\0" * (-len(index) % 4)
+    index += _crc32(index)
+    backward_size = struct.pack("<I", len(index) // 4 - 1)
+    self.fileobj.write(index + _crc32(backward_size + self.FLAGS) + backward_size + self.FLAGS + "YZ")
+
+
+class _FramedCommandWriter(object):
+  """
+  Like _CommandWriter, but data that is already compressed can be stored instead, in
+  separate frames written directly. The output is a series of frames, or streams, which
+  the decompressor reads as one. Each switch back to compressing starts the command
+  again, so only members of at least min_stored_size are stored.
+  """
+
+  min_stored_size = 2 ** 20
+
+  def __init__(self, popenargs, fileobj, stored_frame_class):
+    self.popenargs = popenargs
+    self.fileobj = fileobj
+    self.stored_frame_class = stored_frame_class
+    self.storing = False
+    self.frame = None
+
+  def _end_frame(self):
+    if self.frame:
+      frame = self.frame
+      self.frame = None
+      frame.close()
+
+  def set_storing(self, storing):
+    if storing != self.storing:
+      self._end_frame()
+      self.storing = storing
+
+  def write(self, data):
+    if not data:
+      return
+    if not self.frame:
+      if self.storing:
+        self.frame = self.stored_frame_class(self.fileobj)
+      else:
+        self.frame = _CommandWriter(self.popenargs, self.fileobj)
+    self.frame.write(data)
+
+  def close(self):
+    self._end_frame()
+
+  def abort(self):
+    if isinstance(self.frame, _CommandWriter):
+      self.frame.abort()
+
+
+class _CommandReader(_CommandStream):
+  """A file object that reads what a command outputs when fed another file object."""
+
+  def __init__(self, popenargs, fileobj):
+    if isinstance(fileobj, file):
+      self._start(popenargs, stdin=fileobj, stdout=subprocess.PIPE)
+    else:
+      self._start(popenargs, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+      self.copier = _copy_in_thread(fileobj, self.process.stdin, self.errors, close_target=True)
+    self.done = False
+
+  def read(self, size=-1):
+    data = self.process.stdout.read(size)
+    if not data and not self.done:
+      self.done = True
+      self._finish()
+    return data
+
+  def close(self):
+    if not self.done:
+      _drain(self)
+
+
+# Compression and decompression commands for formats handled by an external compressor,
+# the default compression level of each, whether it can compress with multiple threads,
+# and how data is stored uncompressed in the format.
+_COMPRESSOR_COMMANDS = {
+  "zstd": (["zstd", "-q", "-c"], ["zstd", "-q", "-d", "-c"], 3, True, _StoredZstdFrame),
+  "lz4": (["lz4", "-q", "-c"], ["lz4", "-q", "-d", "-c"], 1, False, _StoredLz4Frame),
+  "xz": (["xz", "-q", "-c"], ["xz", "-q", "-d", "-c"], 6, True, _StoredXzStream),
+}
+
+
+def _compressor_writer(name, level, threads):
+  compress, _, default_level, multithreaded, stored_frame_class = _COMPRESSOR_COMMANDS[name]
+  _require_command(name)
+  popenargs = compress + ["-%d" % (default_level if level is None else level)]
+  if multithreaded:
+    popenargs.append("-T%d" % (threads or default_threads()))
+  return lambda fileobj: _FramedCommandWriter(popenargs, fileobj, stored_frame_class)
+
+
+def _compressor_reader(name):
+  _, decompress, _, _, _ = _COMPRESSOR_COMMANDS[name]
+  _require_command(name)
+  return lambda fileobj: _CommandReader(decompress, fileobj)
+
+
+def targz_dir(source_dir, target_archive, level=None, threads=None, dereference_ext_symlinks=True):
+  """
+  Archive a directory to a path, or sequentially to a file object such as a pipe.
+  Compresses on all cores unless threads is set.
+  """
+  threads = threads or default_threads()
+  if threads > 1:
+    writer_factory = lambda fileobj: ParallelGzipWriter(fileobj, level, threads)
+  else:
+    writer_factory = lambda fileobj: GzipStreamWriter(fileobj, level)
+  _archive_tar(writer_factory, source_dir, target_archive,
+               dereference_ext_symlinks=dereference_ext_symlinks)
+
+
+def untargz_dir(source_archive, target_dir, readonly=False):
+  """
+  Extract an archive from a path, or sequentially from a file object such as a pipe.
+  Decompression runs on its own thread, alongside extraction. If readonly is set,
+  files and directories are created without write permission.
+  """
+  _unarchive_tar(lambda fileobj: PipelinedReader(GzipStreamReader(fileobj)), source_archive, target_dir,
+                 readonly=readonly)
+
+
+def tarzst_dir(source_dir, target_archive, level=None, threads=None, dereference_ext_symlinks=True):
+  _archive_tar(_compressor_writer("zstd", level, threads), source_dir, target_archive,
+               dereference_ext_symlinks=dereference_ext_symlinks)
+
+
+def untarzst_dir(source_archive, target_dir, readonly=False):
+  _unarchive_tar(_compressor_reader("zstd"), source_archive, target_dir, readonly=readonly)
+
+
+def tarlz4_dir(source_dir, target_archive, level=None, threads=None, dereference_ext_symlinks=True):
+  _archive_tar(_compressor_writer("lz4", level, threads), source_dir, target_archive,
+               dereference_ext_symlinks=dereference_ext_symlinks)
 
 
-TarGzArchiver = _Archiver(".tar.gz", targz_dir, untargz_dir)
+def untarlz4_dir(source_archive, target_dir, readonly=False):
+  _unarchive_tar(_compressor_reader("lz4"), source_archive, target_dir, readonly=readonly)
 
 
-# Old code:
-# We tried zip for a while but found it less satisfactory.
+def tarxz_dir(source_dir, target_archive, level=None, threads=None, dereference_ext_symlinks=True):
+  _archive_tar(_compressor_writer("xz", level, threads), source_dir, target_archive,
+               dereference_ext_symlinks=dereference_ext_symlinks)
+
+
+def untarxz_dir(source_archive, target_dir, readonly=False):
+  _unarchive_tar(_compressor_reader("xz"), source_archive, target_dir, readonly=readonly)
+
+
+TarGzArchiver = _Archiver("tar.gz", ".tar.gz", "\x1f\x8b", targz_dir, untargz_dir, True, (0, 9))
+TarZstdArchiver = _Archiver("tar.zst", ".tar.zst", "\x28\xb5\x2f\xfd", tarzst_dir, untarzst_dir, True, (1, 19))
+TarLz4Archiver = _Archiver("tar.lz4", ".tar.lz4", "\x04\x22\x4d\x18", tarlz4_dir, untarlz4_dir, True, (1, 12))
+TarXzArchiver = _Archiver("tar.xz", ".tar.xz", "\xfd7zXZ\x00", tarxz_dir, untarxz_dir, True, (0, 9))
+
+
+# Zip format:
+# We tried zip for a while as the only format but found it less satisfactory. It can't be
+# streamed, but is still available as a format.
 # We use command-line standard zip/unzip instead of Python zip, since it is a bit more performant
 # than the Python native alternatives.
 
@@ -141,20 +855,96 @@ def _autodetect_unzip_command():
   return unzip_cmd
 
 
-def zip_dir(source_dir, target_archive):
-  popenargs = shell_expand_to_popen(_autodetect_zip_command(), {"ARCHIVE": target_archive, "DIR": "."})
+def zip_dir(source_dir, target_archive, level=None, threads=None):
+  zip_cmd = _autodetect_zip_command()
+  if level is not None:
+    zip_cmd += " -%d" % level
+  # Store files that are already compressed.
+  zip_cmd += " -n " + ":".join(COMPRESSED_SUFFIXES)
+  popenargs = shell_expand_to_popen(zip_cmd, {"ARCHIVE": os.path.abspath(target_archive), "DIR": "."})
   cd_to = source_dir
   log.debug("using cwd: %s", cd_to)
   log.info("compress: %s", " ".join(popenargs))
   subprocess.check_call(popenargs, cwd=cd_to, stdout=SHELL_OUTPUT, stderr=SHELL_OUTPUT, stdin=DEV_NULL)
 
 
-def unzip_dir(source_archive, target_dir):
+def unzip_dir(source_archive, target_dir, readonly=False):
   popenargs = shell_expand_to_popen(_autodetect_unzip_command(), {"ARCHIVE": source_archive, "DIR": target_dir})
   cd_to = target_dir
   log.debug("using cwd: %s", cd_to)
   log.info("decompress: %s", " ".join(popenargs))
   subprocess.check_call(popenargs, cwd=cd_to, stdout=SHELL_OUTPUT, stderr=SHELL_OUTPUT, stdin=DEV_NULL)
+  # Unzip can't set modes itself, so this takes another pass.
+  if readonly:
+    trees.make_readonly(target_dir)
+
 
+ZipArchiver = _Archiver("zip", ".zip", "PK\x03\x04", zip_dir, unzip_dir, False, (0, 9))
 
-ZipArchiver = _Archiver(".zip", zip_dir, unzip_dir)
+
+ARCHIVERS = OrderedDict((archiver.name, archiver) for archiver in
+                        [TarGzArchiver, TarZstdArchiver, TarLz4Archiver, TarXzArchiver, ZipArchiver])
+
+DEFAULT_FORMAT = TarGzArchiver.name
+
+
+class _PeekReader(object):
+  """A file object that reads the first bytes of another, then replays them."""
+
+  def __init__(self, fileobj, size):
+    self.fileobj = fileobj
+    self.head = ""
+    while len(self.head) < size:
+      data = fileobj.read(size - len(self.head))
+      if not data:
+        break
+      self.head += data
+    self.pos = 0
+
+  def read(self, size=-1):
+    if self.pos < len(self.head):
+      end = len(self.head) if size < 0 else min(self.pos + size, len(self.head))
+      data = self.head[self.pos:end]
+      self.pos = end
+      return data
+    return self.fileobj.read(size)
+
+
+def archiver_for_magic(head):
+  for archiver in ARCHIVERS.itervalues():
+    if head.startswith(archiver.magic):
+      return archiver
+  return None
+
+
+def archiver_for_suffix(path):
+  for archiver in ARCHIVERS.itervalues():
+    if path.endswith(archiver.suffix):
+      return archiver
+  return None
+
+
+def unarchive(source_archive, target_dir, default_format=DEFAULT_FORMAT, readonly=False):
+  """
+  Extract an archive from a path or file object, detecting its format from its first
+  bytes, or failing that its suffix, or failing that using default_format. If readonly
+  is set, everything is extracted without write permission.
+  """
+  if hasattr(source_archive, "read"):
+    source_archive = _PeekReader(source_archive, MAGIC_SIZE)
+    head = source_archive.head
+    archiver = archiver_for_magic(head)
+  else:
+    with open(source_archive, "rb") as f:
+      head = f.read(MAGIC_SIZE)
+    archiver = archiver_for_magic(head) or archiver_for_suffix(source_archive)
+  if not head:
+    raise ArchiveError("Archive is empty")
+  if not archiver:
+    archiver = ARCHIVERS[default_format]
+  log.debug("archive format: %s", archiver.name)
+  with tracing.span("extract", format=archiver.name) as span:
+    # A stream is counted by whoever reads it, as it may be read on after the archive ends.
+    if not hasattr(source_archive, "read"):
+      span.add_file_size(source_archive)
+    archiver.unarchive(source_archive, target_dir, readonly=readonly)
@@ -0,0 +1,375 @@
+"""
+Content-addressed storage of directories.
+
+A directory is stored as a manifest, listing each path with its type and mode, and
+for files, the SHA1 hash of the contents. Each distinct file content is stored once,
+as a blob named by its hash, both remotely and in the local cache. Consecutive
+versions of a directory share most blobs, so only changed files are transferred.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import errno
+import glob
+import hashlib
+import json
+import logging as log
+import os
+import shutil
+import stat
+import threading
+
+from strif import atomic_output_file, temp_output_dir, make_parent_dirs
+
+import archives
+import locks
+import parallel
+import tracing
+import trees
+
+MANIFEST_SUFFIX = ".manifest.json"
+MANIFEST_FORMAT = 1
+
+# Directory, under the remote prefix and its cache directory, that holds blobs.
+BLOBS_DIR = "_blobs"
+
+# Blobs are gzipped remotely, and stored uncompressed in the cache.
+BLOB_SUFFIX = ".gz"
+
+BLOB_GZIP_LEVEL = 6
+
+# Number of blobs to upload or download at once.
+TRANSFER_JOBS = 8
+
+# Modes of blobs in the cache, which are shared by all files with the same contents.
+_BLOB_MODE = 0444
+_MODE_MASK = 0555
+
+
+class ManifestError(RuntimeError):
+  pass
+
+
+def _is_internal_link(root, path):
+  target = os.readlink(path)
+  if os.path.isabs(target):
+    return False
+  resolved = os.path.normpath(os.path.join(os.path.dirname(path), target))
+  return resolved.startswith(os.path.normpath(root) + os.sep)
+
+
+def _scan(root, dir_path, rel_dir, entries, file_paths):
+  for name in sorted(os.listdir(dir_path)):
+    path = os.path.join(dir_path, name)
+    rel_path = os.path.join(rel_dir, name) if rel_dir else name
+    # As with archives, symlinks within the tree are kept, and others are followed.
+    if os.path.islink(path) and _is_internal_link(root, path):
+      entries.append({"path": rel_path, "type": "link", "target": os.readlink(path)})
+      continue
+    if os.path.islink(path) and not os.path.exists(path):
+      raise ManifestError("Symlink target not found: %r -> %r" % (rel_path, os.readlink(path)))
+    st = os.stat(path)
+    mode = stat.S_IMODE(st.st_mode)
+    if stat.S_ISDIR(st.st_mode):
+      entries.append({"path": rel_path, "type": "dir", "mode": mode})
+      _scan(root, path, rel_path, entries, file_paths)
+    elif stat.S_ISREG(st.st_mode):
+      entries.append({"path": rel_path, "type": "file", "mode": mode, "size": st.st_size})
+      file_paths.append((entries[-1], path))
+    else:
+      raise ManifestError("Only files, directories, and symlinks can be published: %r" % path)
+
+
+def scan_tree(source_dir):
+  """
+  Hash all files in a directory, in parallel. Returns a manifest for it, and a dict
+  from each hash to a file with that content.
+  """
+  entries = []
+  file_paths = []
+  _scan(source_dir, source_dir, "", entries, file_paths)
+  with tracing.span("hash") as span:
+    hashes = trees.hash_files([path for (_, path) in file_paths])
+    span.add_bytes(sum(entry["size"] for (entry, _) in file_paths))
+  sources = {}
+  for ((entry, path), sha1) in zip(file_paths, hashes):
+    entry["hash"] = sha1
+    sources.setdefault(sha1, path)
+  log.info("scanned %s items (%s distinct files): %s", len(entries), len(sources), source_dir)
+  return {"format": MANIFEST_FORMAT, "entries": entries}, sources
+
+
+def write_manifest(manifest, path):
+  with atomic_output_file(path, make_parents=True) as temp_path:
+    with open(temp_path, "w") as f:
+      json.dump(manifest, f, sort_keys=True, separators=(",", ":"))
+
+
+def read_manifest(path):
+  try:
+    with open(path) as f:
+      manifest = json.load(f)
+  except ValueError as e:
+    raise ManifestError("Invalid manifest: %s: %s" % (path, e))
+  if manifest.get("format") != MANIFEST_FORMAT:
+    raise ManifestError("Unsupported manifest format: %s: %r" % (path, manifest.get("format")))
+  return manifest
+
+
+def manifest_hashes(manifest):
+  """All distinct blob hashes in a manifest, in order of first use."""
+  seen = set()
+  out = []
+  for entry in manifest["entries"]:
+    if entry["type"] == "file" and entry["hash"] not in seen:
+      seen.add(entry["hash"])
+      out.append(entry["hash"])
+  return out
+
+
+def unused_paths(paths):
+  """
+  Those of the given stored blobs that no tree links to any longer. A blob with the
+  usual mode is also the source of copies with other modes, so it is only unused once
+  those are, too.
+  """
+
+  def links(path):
+    try:
+      return os.lstat(path).st_nlink
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return None
+
+  unused = set(path for path in paths if links(path) == 1)
+  for path in list(unused):
+    if "." not in os.path.basename(path):
+      if any(variant not in unused for variant in glob.glob(path + ".*")):
+        unused.remove(path)
+  return sorted(unused)
+
+
+def _run_transfers(tasks):
+  results = parallel.run_tasks(tasks, TRANSFER_JOBS)
+  failures = [result for result in results if result.error]
+  for result in failures:
+    log.debug("failed to transfer blob %s: %s", result.name, result.traceback)
+  if failures:
+    raise failures[0].error
+
+
+class BlobStore(object):
+  """
+  Blobs for one remote prefix, kept in a local directory and remotely. Upload and
+  download are functions taking a local path and remote location, and a remote location
+  and local path. If set, upload_batch and download_batch are used instead, to transfer
+  all blobs at once; they take a list of such pairs. Blobs are only added to the local
+  directory once they are known to be stored remotely, so a blob present locally need
+  never be uploaded. If set, on_add is called with a list of the paths of files added to
+  the local directory, each time flush is called.
+  """
+
+  def __init__(self, local_dir, remote_dir=None, upload=None, download=None, on_add=None,
+               upload_batch=None, download_batch=None):
+    self.local_dir = local_dir
+    self.remote_dir = remote_dir
+    self.upload = upload
+    self.download = download
+    self.upload_batch = upload_batch
+    self.download_batch = download_batch
+    self.on_add = on_add
+    # Paths added since the last flush. Blobs are added from several threads at once.
+    self._added_paths = []
+    self._added_lock = threading.Lock()
+
+  def __str__(self):
+    return "BlobStore@%s" % self.local_dir
+
+  def local_path(self, sha1):
+    return os.path.join(self.local_dir, sha1[:2], sha1)
+
+  def remote_loc(self, sha1):
+    return os.path.join(self.remote_dir, sha1[:2], sha1 + BLOB_SUFFIX)
+
+  def has(self, sha1):
+    return os.path.exists(self.local_path(sha1))
+
+  def _added(self, path):
+    with self._added_lock:
+      self._added_paths.append(path)
+
+  def flush(self):
+    """Report all files added since the last flush to on_add, at once."""
+    with self._added_lock:
+      (paths, self._added_paths) = (self._added_paths, [])
+    if self.on_add and paths:
+      self.on_add(paths)
+
+  def _add(self, sha1, source_path):
+    # Other processes sharing the cache may be adding blobs to the same directory.
+    locks.make_dirs(os.path.dirname(self.local_path(sha1)))
+    with atomic_output_file(self.local_path(sha1)) as temp_path:
+      trees.clone_file(source_path, temp_path)
+      os.chmod(temp_path, _BLOB_MODE)
+    self._added(self.local_path(sha1))
+
+  @staticmethod
+  def _compress_blob(source_path, temp_blob, level):
+    with open(source_path, "rb") as f_in, open(temp_blob, "wb") as f_out:
+      writer = archives.GzipStreamWriter(f_out, level)
+      writer.set_storing(archives.is_compressed_name(source_path))
+      shutil.copyfileobj(f_in, writer, archives.BLOCK_SIZE)
+      writer.close()
+
+  def _upload_blob(self, sha1, source_path, level):
+    with temp_output_dir("instaclone-blob.", always_clean=True) as temp_dir:
+      temp_blob = os.path.join(temp_dir, sha1 + BLOB_SUFFIX)
+      self._compress_blob(source_path, temp_blob, level)
+      self.upload(temp_blob, self.remote_loc(sha1))
+    self._add(sha1, source_path)
+
+  def _upload_batch(self, missing, level):
+    """Compress all blobs in parallel, then upload them with one batch command."""
+    with temp_output_dir("instaclone-blobs.", always_clean=True) as temp_dir:
+      temp_blobs = [os.path.join(temp_dir, sha1 + BLOB_SUFFIX) for (sha1, _) in missing]
+      _run_transfers([(sha1, lambda path=path, temp_blob=temp_blob: self._compress_blob(path, temp_blob, level))
+                      for ((sha1, path), temp_blob) in zip(missing, temp_blobs)])
+      self.upload_batch([(temp_blob, self.remote_loc(sha1)) for ((sha1, _), temp_blob) in zip(missing, temp_blobs)])
+    for (sha1, path) in missing:
+      self._add(sha1, path)
+
+  def _download_blob(self, sha1):
+    with temp_output_dir("instaclone-blob.", always_clean=True) as temp_dir:
+      temp_blob = os.path.join(temp_dir, sha1 + BLOB_SUFFIX)
+      self.download(self.remote_loc(sha1), temp_blob)
+      self._add_downloaded(sha1, temp_blob)
+
+  def _download_batch(self, missing):
+    """Download all blobs with one batch command, then check and add them in parallel."""
+    with temp_output_dir("instaclone-blobs.", always_clean=True) as temp_dir:
+      temp_blobs = [os.path.join(temp_dir, sha1 + BLOB_SUFFIX) for sha1 in missing]
+      self.download_batch([(self.remote_loc(sha1), temp_blob) for (sha1, temp_blob) in zip(missing, temp_blobs)])
+      _run_transfers([(sha1, lambda sha1=sha1, temp_blob=temp_blob: self._add_downloaded(sha1, temp_blob))
+                      for (sha1, temp_blob) in zip(missing, temp_blobs)])
+
+  def _add_downloaded(self, sha1, temp_blob):
+    """Decompress a downloaded blob beside it, check its hash, and add it."""
+    temp_path = temp_blob[:-len(BLOB_SUFFIX)]
+    if not os.path.isfile(temp_blob):
+      raise ManifestError("Blob was not downloaded: %s" % self.remote_loc(sha1))
+    digest = hashlib.sha1()
+    with open(temp_blob, "rb") as f_in, open(temp_path, "wb") as f_out:
+      reader = archives.GzipStreamReader(f_in)
+      while True:
+        data = reader.read(archives.BLOCK_SIZE)
+        if not data:
+          break
+        digest.update(data)
+        f_out.write(data)
+    if digest.hexdigest() != sha1:
+      raise ManifestError("Blob contents don't match its hash: %s" % self.remote_loc(sha1))
+    self._add(sha1, temp_path)
+
+  @tracing.traced("upload_blobs")
+  def upload_missing(self, sources, level=None):
+    """
+    Upload blobs for the given dict of hashes to files, except those already stored.
+    Returns the number uploaded.
+    """
+    level = BLOB_GZIP_LEVEL if level is None else level
+    missing = [(sha1, path) for (sha1, path) in sorted(sources.iteritems()) if not self.has(sha1)]
+    log.info("uploading %s of %s blobs", len(missing), len(sources))
+    tracing.annotate(count=len(missing))
+    if self.upload_batch and missing:
+      self._upload_batch(missing, level)
+    else:
+      _run_transfers([(sha1, lambda sha1=sha1, path=path: self._upload_blob(sha1, path, level))
+                      for (sha1, path) in missing])
+    return len(missing)
+
+  @tracing.traced("download_blobs")
+  def download_missing(self, manifest):
+    """Download all blobs a manifest needs that aren't stored locally. Returns the number downloaded."""
+    hashes = manifest_hashes(manifest)
+    missing = [sha1 for sha1 in hashes if not self.has(sha1)]
+    log.info("downloading %s of %s blobs", len(missing), len(hashes))
+    tracing.annotate(count=len(missing))
+    if self.download_batch and missing:
+      self._download_batch(missing)
+    else:
+      _run_transfers([(sha1, lambda sha1=sha1: self._download_blob(sha1)) for sha1 in missing])
+    return len(missing)
+
+  @tracing.traced("copy_blobs")
+  def add_from(self, other, manifest):
+    """
+    Add the blobs a manifest needs that aren't stored here but are in another store, such
+    as one in a shared cache, by cloning or copying them. They aren't hardlinked, since
+    unused blobs are found by how many links they have. Returns the number added.
+    """
+    hashes = [sha1 for sha1 in manifest_hashes(manifest) if not self.has(sha1) and other.has(sha1)]
+    log.info("copying %s blobs from %s", len(hashes), other)
+    tracing.annotate(count=len(hashes))
+    _run_transfers([(sha1, lambda sha1=sha1: self._add(sha1, other.local_path(sha1))) for sha1 in hashes])
+    return len(hashes)
+
+  def _variant_path(self, sha1, mode):
+    """
+    Files with other modes than the usual one need their own copy of the blob, since
+    hardlinks share a mode.
+    """
+    mode &= _MODE_MASK
+    path = self.local_path(sha1)
+    return path if mode == _BLOB_MODE else "%s.%o" % (path, mode)
+
+  def _file_source(self, sha1, mode):
+    """A stored blob with the given mode, to hardlink to."""
+    variant_path = self._variant_path(sha1, mode)
+    if not os.path.exists(variant_path):
+      with atomic_output_file(variant_path) as temp_path:
+        shutil.copyfile(self.local_path(sha1), temp_path)
+        os.chmod(temp_path, mode & _MODE_MASK)
+      self._added(variant_path)
+    return variant_path
+
+  def manifest_paths(self, manifest):
+    """Paths of all stored blobs that a tree made from a manifest links to."""
+    return sorted(set(self._variant_path(entry["hash"], entry["mode"])
+                      for entry in manifest["entries"] if entry["type"] == "file") |
+                  set(self.local_path(sha1) for sha1 in manifest_hashes(manifest)))
+
+  @tracing.traced("materialize")
+  def materialize(self, manifest, target_dir, readonly=False):
+    """
+    Create the tree described by a manifest in target_dir, which must exist and be empty,
+    with files hardlinked to stored blobs. All blobs must already be stored. Files are
+    read-only, as blobs are, and if readonly is set, so are directories.
+    """
+    dirs = []
+    for entry in manifest["entries"]:
+      path = os.path.join(target_dir, entry["path"])
+      if entry["type"] == "dir":
+        os.mkdir(path)
+        dirs.append((path, entry["mode"]))
+      elif entry["type"] == "link":
+        os.symlink(entry["target"], path)
+      elif entry["type"] == "file":
+        source = self._file_source(entry["hash"], entry["mode"])
+        try:
+          os.link(source, path)
+        except OSError as e:
+          # A blob used very many times may exceed the filesystem's limit on links.
+          if e.errno != errno.EMLINK:
+            raise
+          make_parent_dirs(path)
+          shutil.copy2(source, path)
+      else:
+        raise ManifestError("Invalid manifest entry: %r" % entry)
+    # Set modes last, so directories are writable while they are filled.
+    for (path, mode) in reversed(dirs):
+      os.chmod(path, mode & _MODE_MASK if readonly else mode)
+    if readonly:
+      os.chmod(target_dir, stat.S_IMODE(os.stat(target_dir).st_mode) & _MODE_MASK)
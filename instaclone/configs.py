@@ -15,26 +15,57 @@ import yaml  # PyYAML pip
 from functools32 import lru_cache  # functools32 pip
 import strif
 
+import archives
+import locks
+import transports
 from log_calls import log_calls
 
 _NAME_FIELD = "name"
 _required_fields = "local_path remote_path remote_prefix install_method upload_command download_command"
-_other_fields = "make_backup version_string version_hashable version_command"
+_other_fields = "make_backup version_string version_hashable version_command stream_mode " \
+                "archive_format archive_level archive_threads storage_mode multipart_size " \
+                "batch_upload_command batch_download_command download_retries ranged_download_command " \
+                "not_found_exit_code"
 
 ConfigBase = namedtuple("ConfigBase", _NAME_FIELD + " " + _other_fields + " " + _required_fields)
 
 CONFIGS_REQUIRED = _required_fields.split()
 CONFIG_DEFAULTS = {
-  "install_method": "symlink"
+  "archive_format": archives.DEFAULT_FORMAT,
+  "download_retries": 3,
+  "install_method": "symlink",
+  "not_found_exit_code": 1,
+  "storage_mode": "archive",
+  "stream_mode": "none",
 }
 CONFIG_DESCRIPTIONS = {
-  "download_command": "shell command template to download file",
-  "install_method": "the way to install files (symlink, copy, fastcopy, hardlink)",
+  "archive_format": "format to publish directories in (%s)" % ", ".join(archives.ARCHIVERS.keys()),
+  "archive_level": "compression level for archive_format (0-9 for tar.gz, tar.xz, and zip, 1-19 for tar.zst, "
+                   "1-12 for tar.lz4; the default depends on the format)",
+  "archive_threads": "number of threads to compress archives with (default is the number of CPUs)",
+  "batch_download_command": "optional shell command template to download many files at once, when there\n"
+                            "    are many to download: $MANIFEST is a file with a line REMOTE<tab>LOCAL for each",
+  "batch_upload_command": "optional shell command template to upload many files at once, when there\n"
+                          "    are many to upload: $MANIFEST is a file with a line LOCAL<tab>REMOTE for each",
+  "download_command": "shell command template to download file (not needed for file:// or http(s):// remotes)",
+  "download_retries": "times to retry a failed download, with backoff, resuming from the data received\n"
+                      "    where possible (default 3)",
+  "install_method": "the way to install files (symlink, copy, fastcopy, hardlink, reflink)",
   "local_path": "the local target path to sync to, relative to current dir",
   "make_backup": "make a backup (applies only to publish command)",
+  "multipart_size": "publish files and archives larger than this size (such as 64M) in parts of\n"
+                    "    this size, which are uploaded and downloaded concurrently (default is never)",
+  "not_found_exit_code": "exit status of download_command when the remote file doesn't exist (default 1,\n"
+                         "    as with cp or aws s3 cp); downloads failing with any other status are retried",
+  "ranged_download_command": "optional shell command template to download the rest of a file from\n"
+                             "    byte $OFFSET, used to resume a partial download",
   "remote_path": "remote path (in backing store such as S3) to sync to",
   "remote_prefix": "remote path prefix (such as s3://my-bucket/instaclone) to sync to",
-  "upload_command": "shell command template to upload file",
+  "storage_mode": "how to publish directories: archive (a single archive per version) or\n"
+                  "    content (files stored once by content hash, shared across versions)",
+  "stream_mode": "stream archives to and from transport commands, with no temporary archive file:\n"
+                 "    none, stdio ($LOCAL is - for stdin/stdout), or fifo ($LOCAL is a named pipe)",
+  "upload_command": "shell command template to upload file (not needed for file:// or http(s):// remotes)",
   "version_command": "a shell command that should be run to get a version string",
   "version_hashable": "a file path that should be SHA1 hashed to get a version string",
   "version_string": "explicit version string to use",
@@ -59,6 +90,9 @@ class Config(ConfigBase):
 
 CONFIG_NAME = "instaclone"
 CONFIG_DIR_ENV = "INSTACLONE_DIR"
+MAX_CACHE_SIZE_ENV = "INSTACLONE_MAX_CACHE_SIZE"
+LOCK_TIMEOUT_ENV = "INSTACLONE_LOCK_TIMEOUT"
+SHARED_CACHE_ENV = "INSTACLONE_SHARED_CACHE"
 CONFIG_HOME_DIR = ".instaclone"
 
 DEFAULT_ITEM_NAME = "default"
@@ -68,7 +102,11 @@ class ConfigError(RuntimeError):
   pass
 
 
-InstallMethod = Enum("InstallMethod", "symlink hardlink copy fastcopy")
+InstallMethod = Enum("InstallMethod", "symlink hardlink copy fastcopy reflink")
+
+StreamMode = Enum("StreamMode", "none stdio fifo")
+
+StorageMode = Enum("StorageMode", "archive content")
 
 
 @lru_cache(maxsize=None)
@@ -142,8 +180,10 @@ def _parse_and_validate(raw_config_list):
   items = []
   for raw in raw_config_list:
 
-    # Validation.
+    # Validation. The upload and download commands are checked once remote_prefix is expanded.
     for key in CONFIGS_REQUIRED:
+      if key in ("upload_command", "download_command"):
+        continue
       if key not in raw or raw[key] is None:
         raise ConfigError("must specify '%s' in item config: %s" % (key, raw))
 
@@ -155,10 +195,24 @@ def _parse_and_validate(raw_config_list):
     # Validate shell templates.
     # For these, we don't expand environment variables here, but instead do it at once at call time.
     for key in "upload_command", "download_command":
+      if raw[key] is None:
+        continue
       try:
         strif.shell_expand_to_popen(raw[key], {"REMOTE": "dummy", "LOCAL": "dummy"})
       except ValueError as e:
         raise ConfigError("invalid command in config value for %s: %s" % (key, e))
+    for key in "batch_upload_command", "batch_download_command":
+      if raw[key] is not None:
+        try:
+          strif.shell_expand_to_popen(raw[key], {"MANIFEST": "dummy"})
+        except ValueError as e:
+          raise ConfigError("invalid command in config value for %s: %s" % (key, e))
+    if raw["ranged_download_command"] is not None:
+      try:
+        strif.shell_expand_to_popen(raw["ranged_download_command"],
+                                    {"REMOTE": "dummy", "LOCAL": "dummy", "OFFSET": "0"})
+      except ValueError as e:
+        raise ConfigError("invalid command in config value for ranged_download_command: %s" % e)
 
     # Normalize and expand environment variables.
     for key in "local_path", "remote_prefix", "remote_path":
@@ -171,11 +225,49 @@ def _parse_and_validate(raw_config_list):
       except ValueError as e:
         raise ConfigError("invalid command in config value for %s: %s" % (key, e))
 
+    # Remotes with a built-in transport need no upload or download command.
+    if not transports.for_location(raw["remote_prefix"]):
+      for key in "upload_command", "download_command":
+        if raw[key] is None:
+          raise ConfigError("must specify '%s' in item config: %s" % (key, raw))
+
     # Parse enums.
     try:
       raw["install_method"] = InstallMethod[raw["install_method"]]
     except KeyError:
       raise ConfigError("invalid install_method: %s" % raw["install_method"])
+    try:
+      raw["stream_mode"] = StreamMode[raw["stream_mode"]]
+    except KeyError:
+      raise ConfigError("invalid stream_mode: %s" % raw["stream_mode"])
+    try:
+      raw["storage_mode"] = StorageMode[raw["storage_mode"]]
+    except KeyError:
+      raise ConfigError("invalid storage_mode: %s" % raw["storage_mode"])
+
+    if raw["archive_format"] not in archives.ARCHIVERS:
+      raise ConfigError("invalid archive_format: %s" % raw["archive_format"])
+    for key in "archive_level", "archive_threads", "download_retries", "not_found_exit_code":
+      if raw[key] is not None:
+        try:
+          raw[key] = int(raw[key])
+        except ValueError:
+          raise ConfigError("invalid %s: %s" % (key, raw[key]))
+    if raw["archive_level"] is not None:
+      # Blobs of directories in content storage are gzipped at this level.
+      archiver = archives.TarGzArchiver if raw["storage_mode"] == StorageMode.content else \
+        archives.ARCHIVERS[raw["archive_format"]]
+      (lowest, highest) = archiver.levels
+      if not lowest <= raw["archive_level"] <= highest:
+        raise ConfigError("invalid archive_level for %s (must be %s to %s): %s" %
+                          (archiver.name, lowest, highest, raw["archive_level"]))
+    if raw["download_retries"] is not None and raw["download_retries"] < 0:
+      raise ConfigError("invalid download_retries: %s" % raw["download_retries"])
+
+    if raw["multipart_size"] is not None:
+      raw["multipart_size"] = parse_size(raw["multipart_size"])
+      if raw["multipart_size"] <= 0:
+        raise ConfigError("invalid multipart_size: %s" % raw["multipart_size"])
 
     # Parse booleans. Values True and False may already be converted.
     try:
@@ -190,13 +282,65 @@ def _parse_and_validate(raw_config_list):
   return items
 
 
+_SIZE_RE = re.compile("^([0-9]+(?:\\.[0-9]*)?)([KMGT]?)B?$", re.IGNORECASE)
+_SIZE_UNITS = {"": 1, "K": 2 ** 10, "M": 2 ** 20, "G": 2 ** 30, "T": 2 ** 40}
+
+
+def parse_size(value):
+  """Parse a size in bytes, such as 500M or 10G (with binary units)."""
+  match = _SIZE_RE.match(str(value).strip())
+  if not match:
+    raise ConfigError("invalid size: %s" % value)
+  return int(float(match.group(1)) * _SIZE_UNITS[match.group(2).upper()])
+
+
+def max_cache_size(override=None):
+  """The size the cache should be kept under, if any, from override or the environment."""
+  value = override if override is not None else os.environ.get(MAX_CACHE_SIZE_ENV)
+  return parse_size(value) if value else None
+
+
+def lock_timeout():
+  """Seconds to wait for another process using the same cached version, if set in the environment."""
+  value = os.environ.get(LOCK_TIMEOUT_ENV)
+  if not value:
+    return None
+  try:
+    return float(value)
+  except ValueError:
+    raise ConfigError("invalid lock timeout: %s" % value)
+
+
+def shared_cache_dirs():
+  """
+  Shared cache directories, such as on a network volume, in the order they are checked
+  after the local cache. They are listed in the environment, separated by colons, as
+  directories laid out like the main directory, so each keeps its cache in "cache" (and
+  can be managed by setting INSTACLONE_DIR to it). Those that don't exist, say since a
+  volume isn't mounted, are skipped.
+  """
+  dirs = []
+  for path in os.environ.get(SHARED_CACHE_ENV, "").split(os.pathsep):
+    if not path:
+      continue
+    cache_dir = os.path.join(path, "cache")
+    if not os.path.isdir(cache_dir):
+      if not os.path.isdir(path) or not os.access(path, os.W_OK):
+        log.warn("shared cache dir not found, so skipping it: %s", cache_dir)
+        continue
+      locks.make_dirs(cache_dir)
+    dirs.append(cache_dir)
+  return dirs
+
+
 @log_calls
 def set_up_cache_dir():
   config_dir = _locate_config_dir()
   cache_dir = os.path.join(config_dir, "cache")
   if not os.path.exists(cache_dir):
     log.info("cache dir not found, so creating: %s", cache_dir)
-    strif.make_all_dirs(cache_dir)
+    # Other processes may be creating it, too.
+    locks.make_dirs(cache_dir)
   return cache_dir
 
 
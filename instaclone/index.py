@@ -0,0 +1,202 @@
+"""
+A persistent index of the cache, recording each cached version with its type, size, and
+when it was added and last used, as well as symlink installs, which version each copied
+install holds, and stored blobs, so that lookups, reports, and eviction don't need to walk
+the cache.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+INDEX_NAME = "index.sqlite"
+
+# Seconds to wait for another process that is writing to the index.
+LOCK_TIMEOUT = 60
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  path TEXT PRIMARY KEY,
+  name TEXT NOT NULL,
+  version TEXT NOT NULL,
+  kind TEXT NOT NULL,
+  size INTEGER NOT NULL,
+  store TEXT,
+  added REAL NOT NULL,
+  last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used);
+CREATE TABLE IF NOT EXISTS installs (
+  target TEXT PRIMARY KEY,
+  path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS unrecorded (
+  path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS copies (
+  target TEXT PRIMARY KEY,
+  path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blobs (
+  path TEXT PRIMARY KEY,
+  size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS hashes (
+  path TEXT PRIMARY KEY,
+  device INTEGER NOT NULL,
+  inode INTEGER NOT NULL,
+  size INTEGER NOT NULL,
+  mtime REAL NOT NULL,
+  sha1 TEXT NOT NULL
+);
+"""
+
+# A cached version. The path is relative to the cache contents. The size is disk usage,
+# not counting files hardlinked to blobs, if the version's files are in a blob store.
+Entry = namedtuple("Entry", "path name version kind size store added last_used")
+
+
+class CacheIndex(object):
+  """
+  The index, in a SQLite database. Each operation is its own transaction, on a connection
+  kept for each thread, so the index may be used from several threads and processes at once.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.created = not os.path.exists(path)
+    self._local = threading.local()
+    with self._transaction() as db:
+      db.executescript(_SCHEMA)
+
+  def __str__(self):
+    return "CacheIndex@%s" % self.path
+
+  def _connection(self):
+    db = getattr(self._local, "db", None)
+    if db is None:
+      db = sqlite3.connect(self.path, timeout=LOCK_TIMEOUT)
+      # With a write-ahead log, readers don't block the writer, and commits needn't sync
+      # the database itself. Losing the last commits on power loss is harmless, since
+      # versions missing from the index are added again when they are next looked up.
+      db.execute("PRAGMA journal_mode=WAL")
+      db.execute("PRAGMA synchronous=NORMAL")
+      self._local.db = db
+    return db
+
+  @contextmanager
+  def _transaction(self):
+    db = self._connection()
+    with db:
+      yield db
+
+  def get(self, path):
+    with self._transaction() as db:
+      row = db.execute("SELECT * FROM entries WHERE path = ?", (path,)).fetchone()
+    return Entry(*row) if row else None
+
+  def put(self, entry):
+    with self._transaction() as db:
+      db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entry)
+
+  def touch(self, path, now=None):
+    with self._transaction() as db:
+      db.execute("UPDATE entries SET last_used = ? WHERE path = ?", (now or time.time(), path))
+
+  def remove(self, path):
+    with self._transaction() as db:
+      db.execute("DELETE FROM entries WHERE path = ?", (path,))
+      db.execute("DELETE FROM unrecorded WHERE path = ?", (path,))
+
+  def entries(self):
+    """All entries, least recently used first."""
+    with self._transaction() as db:
+      return [Entry(*row) for row in db.execute("SELECT * FROM entries ORDER BY last_used")]
+
+  def add_install(self, target, path):
+    with self._transaction() as db:
+      db.execute("INSERT OR REPLACE INTO installs VALUES (?, ?)", (target, path))
+
+  def remove_install(self, target):
+    with self._transaction() as db:
+      db.execute("DELETE FROM installs WHERE target = ?", (target,))
+
+  def installs(self):
+    """List of (target, path) for all recorded symlink installs."""
+    with self._transaction() as db:
+      return db.execute("SELECT target, path FROM installs").fetchall()
+
+  def add_unrecorded(self, paths):
+    """
+    Note entries whose symlink installs aren't known, since they were cached before the
+    index was, so they may be installed anywhere.
+    """
+    with self._transaction() as db:
+      db.executemany("INSERT OR REPLACE INTO unrecorded VALUES (?)", [(path,) for path in paths])
+
+  def remove_unrecorded(self, path):
+    with self._transaction() as db:
+      db.execute("DELETE FROM unrecorded WHERE path = ?", (path,))
+
+  def unrecorded(self):
+    with self._transaction() as db:
+      return set(row[0] for row in db.execute("SELECT path FROM unrecorded"))
+
+  def set_copy(self, target, path):
+    with self._transaction() as db:
+      db.execute("INSERT OR REPLACE INTO copies VALUES (?, ?)", (target, path))
+
+  def remove_copy(self, target):
+    with self._transaction() as db:
+      db.execute("DELETE FROM copies WHERE target = ?", (target,))
+
+  def get_copy(self, target):
+    """The path of the version last copied to target, if any."""
+    with self._transaction() as db:
+      row = db.execute("SELECT path FROM copies WHERE target = ?", (target,)).fetchone()
+    return row[0] if row else None
+
+  def add_blobs(self, rows):
+    """Record stored blobs, given a list of (path, size), in one transaction."""
+    with self._transaction() as db:
+      db.executemany("INSERT OR REPLACE INTO blobs VALUES (?, ?)", rows)
+
+  def blob_paths(self):
+    with self._transaction() as db:
+      return [row[0] for row in db.execute("SELECT path FROM blobs")]
+
+  def remove_blobs(self, paths):
+    """Forget the given blobs. Returns their total size."""
+    size = 0
+    with self._transaction() as db:
+      for path in paths:
+        row = db.execute("SELECT size FROM blobs WHERE path = ?", (path,)).fetchone()
+        if row:
+          size += row[0]
+          db.execute("DELETE FROM blobs WHERE path = ?", (path,))
+    return size
+
+  def get_hash(self, path, stat_key):
+    """The remembered SHA1 of a file, if it has the same (device, inode, size, mtime)."""
+    with self._transaction() as db:
+      row = db.execute("SELECT sha1 FROM hashes WHERE path = ? AND device = ? AND inode = ? AND size = ? "
+                       "AND mtime = ?", (path,) + tuple(stat_key)).fetchone()
+    return row[0] if row else None
+
+  def put_hash(self, path, stat_key, sha1):
+    with self._transaction() as db:
+      db.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", (path,) + tuple(stat_key) + (sha1,))
+
+  def total_size(self):
+    """Total size of all entries and blobs."""
+    with self._transaction() as db:
+      entries_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+      blobs_size = db.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+    return entries_size + blobs_size
@@ -6,12 +6,22 @@ from __future__ import print_function
 
 __author__ = 'jlevy'
 
+import hashlib
+import httplib
+import json
 import logging as log
 import re
+import shutil
+import stat
 import sys
 import os
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 
 from enum import Enum  # enum34
+from functools32 import lru_cache  # functools32 pip
 
 
 # The subprocess module has known threading issues, so prefer subprocess32.
@@ -22,67 +32,403 @@ except ImportError:
 
 from strif import (atomic_output_file, temp_output_dir, write_string_to_file,
                    DEV_NULL, move_to_backup, movefile,
-                   copyfile_atomic, copytree_atomic, file_sha1,
-                   make_all_dirs, make_parent_dirs, chmod_native,
+                   copyfile_atomic, file_sha1,
+                   make_all_dirs, make_parent_dirs,
                    shell_expand_to_popen,
                    dict_merge)
 
 import archives
+import blobstore
 import configs
+import index
+import locks
+import multipart
+import parallel
+import streams
+import tracing
+import transports
+import trees
 
 from log_calls import log_calls
 
 SHELL_OUTPUT = sys.stderr
 
-# We only support one archive format currently.
-ARCHIVER = archives.TarGzArchiver
-
 # Suffix to use when making backups.
 BACKUP_SUFFIX = ".bak"
 
+# Suffix of the object published with each version, saying what was published.
+META_SUFFIX = ".meta.json"
+
+# Suffix of the object listing all published versions of an item.
+VERSIONS_SUFFIX = ".versions.json"
+
+# File manifest of a cached directory, kept in the cache for incremental copies.
+FILES_SUFFIX = ".files.json"
+
+META_FORMAT = 1
+
+# Log file, in the cache directory, of commands run in the background.
+BACKGROUND_LOG = "background.log"
+
+# Lock files, in the cache's locks directory, of cached versions and blob stores, and of setup.
+LOCK_SUFFIX = ".lock"
+SETUP_LOCK = "setup" + LOCK_SUFFIX
+
+# A file modified this recently could change again without its mtime changing, so
+# its hash isn't remembered.
+RECENT_MTIME_SECONDS = 2
+
+# Errors from a failed transfer, with either a command or a built-in transport. A missing
+# remote object is only reported this way, too.
+_TRANSFER_ERRORS = (subprocess.CalledProcessError, transports.TransportError)
+
+# Errors after which a download of something known to exist is worth retrying.
+_RETRY_ERRORS = (subprocess.CalledProcessError, IOError, httplib.HTTPException)
+
+# Suffix of the data received so far by a resumable download, kept beside its target,
+# and of the record of what that data is.
+PARTIAL_SUFFIX = ".download"
+PARTIAL_RECORD_SUFFIX = ".download.json"
+
+# Suffix of the directory, beside the target of a download in parts, that holds its parts.
+PARTS_SUFFIX = ".parts"
+
+# Seconds to wait before the first retry of a failed download, doubling for each retry after.
+RETRY_SECONDS = 1.0
+RETRY_MAX_SECONDS = 30.0
+
+# How to retry and resume downloads of objects known to exist: times to retry a failed
+# download, and the command, if any, that downloads the rest of an object from an offset.
+Resume = namedtuple("Resume", "retries ranged_command")
+
 
 class AppError(RuntimeError):
   pass
 
 
-@log_calls
-def _make_readonly(path, silent=False):
-  if silent and not os.path.exists(path):
-    return
-  return chmod_native(path, "ugo-w", recursive=True)
+def _check_sha1(remote_loc, sha1, expected_sha1):
+  if expected_sha1 and sha1 != expected_sha1:
+    raise AppError("Checksum mismatch for %s: expected %s but got %s" % (remote_loc, expected_sha1, sha1))
 
 
-@log_calls
-def _make_writable(path, silent=False):
-  if silent and not os.path.exists(path):
-    return
-  return chmod_native(path, "u+w", recursive=True)
+def _open_upload_stream(command_template, remote_loc, stream_mode):
+  """A context manager yielding a file object that uploads what is written to it."""
+  transport = transports.for_location(remote_loc)
+  if transport:
+    return transport.open_write(remote_loc)
+  return streams.command_input_stream(command_template, {"REMOTE": remote_loc}, stream_mode)
 
 
-def _upload_file(command_template, local_path, remote_loc):
-  popenargs = shell_expand_to_popen(command_template,
-                                    dict_merge(os.environ,
-                                               {"REMOTE": remote_loc,
-                                                "LOCAL": local_path}))
-  log.info("uploading: %s", " ".join(popenargs))
-  # TODO: Find a way to support force here (e.g. add or remove -f to s4cmd)
-  subprocess.check_call(popenargs, stdout=SHELL_OUTPUT, stderr=SHELL_OUTPUT,
-                        stdin=DEV_NULL)
+def _open_download_stream(command_template, remote_loc, stream_mode, offset=0, ranged_command=None):
+  """
+  A context manager yielding a file object that reads a download as it arrives, from
+  offset, if it is set, which needs a built-in transport or a ranged_command.
+  """
+  transport = transports.for_location(remote_loc)
+  if transport:
+    return transport.open_read(remote_loc, offset=offset)
+  if offset:
+    return streams.command_output_stream(ranged_command, {"REMOTE": remote_loc, "OFFSET": str(offset)},
+                                         stream_mode)
+  return streams.command_output_stream(command_template, {"REMOTE": remote_loc}, stream_mode)
 
 
-def _download_file(command_template, remote_loc, local_path):
-  with atomic_output_file(local_path, make_parents=True) as temp_target:
+def _can_resume(remote_loc, ranged_command):
+  """Whether a download from remote_loc can start from an offset."""
+  return transports.for_location(remote_loc) is not None or ranged_command is not None
+
+
+def _retry_wait(remote_loc, attempt, error, offset):
+  """Log a failed download and wait before retrying it, longer after each failure."""
+  seconds = min(RETRY_MAX_SECONDS, RETRY_SECONDS * 2 ** attempt)
+  log.warning("download failed (%s), retrying in %gs from %s bytes: %s", error, seconds, offset, remote_loc)
+  time.sleep(seconds)
+
+
+class _ResumingReader(object):
+  """
+  A file object reading a download as it arrives, which, if the download fails, is
+  retried with backoff, up to resume.retries times, continuing from the data already
+  read. The transport must allow downloads from an offset.
+  """
+
+  def __init__(self, command_template, remote_loc, stream_mode, resume):
+    self.command_template = command_template
+    self.remote_loc = remote_loc
+    self.stream_mode = stream_mode
+    self.resume = resume
+    self.offset = 0
+    self.failures = 0
+    self.context = None
+    self.stream = None
+    self.done = False
+
+  def _open(self):
+    self.context = _open_download_stream(self.command_template, self.remote_loc, self.stream_mode,
+                                         offset=self.offset, ranged_command=self.resume.ranged_command)
+    self.stream = self.context.__enter__()
+
+  def _finish(self, exc_info=(None, None, None)):
+    context = self.context
+    self.context = self.stream = None
+    # For a command, this is when a failure is known.
+    context.__exit__(*exc_info)
+
+  def read(self, size=-1):
+    while not self.done:
+      try:
+        if not self.context:
+          self._open()
+        data = self.stream.read(size)
+        if data:
+          self.offset += len(data)
+          return data
+        self._finish()
+        self.done = True
+      except transports.NotFoundError:
+        raise
+      except _RETRY_ERRORS as e:
+        if self.context:
+          try:
+            self._finish(sys.exc_info())
+          except _RETRY_ERRORS:
+            pass
+        if self.failures >= self.resume.retries:
+          raise
+        _retry_wait(self.remote_loc, self.failures, e, self.offset)
+        self.failures += 1
+    return ""
+
+  def close(self):
+    if self.context:
+      self._finish()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self.context:
+      self._finish((exc_type, exc_value, traceback))
+
+
+def _can_stream(config, remote_loc):
+  """Whether transfers to and from remote_loc can be streamed."""
+  return config.stream_mode != configs.StreamMode.none or transports.for_location(remote_loc) is not None
+
+
+def _upload_file(command_template, local_path, remote_loc,
+                 stream_mode=configs.StreamMode.none):
+  with tracing.span("upload", remote=remote_loc) as span:
+    span.add_file_size(local_path)
+    transport = transports.for_location(remote_loc)
+    if transport:
+      transport.upload(local_path, remote_loc)
+      return
+    if stream_mode != configs.StreamMode.none:
+      with streams.command_input_stream(command_template, {"REMOTE": remote_loc},
+                                        stream_mode) as stream:
+        with open(local_path, "rb") as f:
+          shutil.copyfileobj(f, stream, streams.BLOCK_SIZE)
+      return
     popenargs = shell_expand_to_popen(command_template,
                                       dict_merge(os.environ,
                                                  {"REMOTE": remote_loc,
-                                                  "LOCAL": temp_target}))
+                                                  "LOCAL": local_path}))
+    log.info("uploading: %s", " ".join(popenargs))
+    # TODO: Find a way to support force here (e.g. add or remove -f to s4cmd)
+    parallel.check_call(popenargs)
+
+
+def _remove_partial(partial_path):
+  for path in partial_path, partial_path[:-len(PARTIAL_SUFFIX)] + PARTIAL_RECORD_SUFFIX:
+    if os.path.exists(path):
+      os.unlink(path)
+
+
+def _download_from(command_template, remote_loc, partial_path, stream_mode, ranged_command=None):
+  """
+  Download into partial_path, appending to the data already there, if the transport
+  allows, and otherwise starting over. Data is written as it arrives, where possible,
+  so it is kept if the download fails.
+  """
+  offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+  if offset and not _can_resume(remote_loc, ranged_command):
+    log.info("no ranged_download_command to resume with, so starting over: %s", remote_loc)
+    offset = 0
+  elif offset:
+    log.info("resuming download from %s bytes: %s", offset, remote_loc)
+  # Starting over, the file is created afresh, so nothing may be left, not even an empty file.
+  if not offset and os.path.lexists(partial_path):
+    os.unlink(partial_path)
+  transport = transports.for_location(remote_loc)
+  if transport:
+    transport.download(remote_loc, partial_path, offset=offset)
+  elif stream_mode != configs.StreamMode.none:
+    with _open_download_stream(command_template, remote_loc, stream_mode,
+                               offset=offset, ranged_command=ranged_command) as stream:
+      with open(partial_path, "ab") as f:
+        shutil.copyfileobj(stream, f, streams.BLOCK_SIZE)
+  elif offset:
+    with temp_output_dir("instaclone-range.", always_clean=True) as temp_dir:
+      temp_range = os.path.join(temp_dir, os.path.basename(partial_path))
+      popenargs = shell_expand_to_popen(ranged_command,
+                                        dict_merge(os.environ, {"REMOTE": remote_loc, "LOCAL": temp_range,
+                                                                "OFFSET": str(offset)}))
+      log.info("downloading: %s", " ".join(popenargs))
+      parallel.check_call(popenargs)
+      with open(temp_range, "rb") as f_in, open(partial_path, "ab") as f_out:
+        shutil.copyfileobj(f_in, f_out, streams.BLOCK_SIZE)
+  else:
+    popenargs = shell_expand_to_popen(command_template,
+                                      dict_merge(os.environ, {"REMOTE": remote_loc, "LOCAL": partial_path}))
     log.info("downloading: %s", " ".join(popenargs))
-    # TODO: Find a way to support force here.
-    subprocess.check_call(popenargs, stdout=SHELL_OUTPUT, stderr=SHELL_OUTPUT,
-                          stdin=DEV_NULL)
+    parallel.check_call(popenargs)
+
 
+def _download_or_not_found(command_template, remote_loc, partial_path, stream_mode, resume,
+                           not_found_exit_code=None, confirm_not_found=False):
+  """
+  Download as _download_from does, and if not_found_exit_code is set, raise NotFoundError
+  if a command fails with that status, meaning the remote file doesn't exist. A command
+  can't say why it failed, so if confirm_not_found is set, it is run once more, right
+  away, and the file is only taken to be missing if it fails the same way again. Its
+  output is then shown only when debugging.
+  """
+  if not_found_exit_code is None:
+    _download_from(command_template, remote_loc, partial_path, stream_mode, ranged_command=resume.ranged_command)
+    return
+  for again in ([False, True] if confirm_not_found else [True]):
+    with parallel.held_output() as output:
+      try:
+        _download_from(command_template, remote_loc, partial_path, stream_mode,
+                       ranged_command=resume.ranged_command)
+        return
+      except subprocess.CalledProcessError as e:
+        if e.returncode != not_found_exit_code:
+          raise
+        if not log.getLogger().isEnabledFor(log.DEBUG):
+          del output[:]
+    log.debug("download failed with exit status %s%s: %s", e.returncode,
+              "" if again else ", so trying once more", remote_loc)
+  raise transports.NotFoundError("Not found (exit status %s): %s" % (not_found_exit_code, remote_loc))
+
+
+def _download_resumable(command_template, remote_loc, local_path, stream_mode, sha1, resume,
+                        not_found_exit_code=None, confirm_not_found=False):
+  """
+  Download a file, retrying as resume says. The data received is kept beside
+  local_path, with a record of what it is, until it is complete, so a retry, or a later
+  download of the same object, continues from it. Data that fails the hash check, as
+  resumed data might, is discarded, and the file downloaded once more from the start.
+  Raises NotFoundError, without retrying, if the file doesn't exist.
+  """
+  partial_path = local_path + PARTIAL_SUFFIX
+  record_path = local_path + PARTIAL_RECORD_SUFFIX
+  record = {"remote": remote_loc, "sha1": sha1}
+  make_parent_dirs(local_path)
+  try:
+    with open(record_path) as f:
+      resuming = json.load(f) == record and os.path.exists(partial_path)
+  except (IOError, ValueError):
+    resuming = False
+  if not resuming:
+    _remove_partial(partial_path)
+    _write_json(record, record_path)
+
+  for fresh in False, True:
+    for attempt in range(resume.retries + 1):
+      try:
+        _download_or_not_found(command_template, remote_loc, partial_path, stream_mode, resume,
+                               not_found_exit_code=not_found_exit_code, confirm_not_found=confirm_not_found)
+        break
+      except transports.NotFoundError:
+        _remove_partial(partial_path)
+        raise
+      except _RETRY_ERRORS as e:
+        if attempt == resume.retries:
+          raise
+        _retry_wait(remote_loc, attempt, e,
+                    os.path.getsize(partial_path) if os.path.exists(partial_path) else 0)
+    actual_sha1 = file_sha1(partial_path) if sha1 else None
+    if actual_sha1 == sha1:
+      break
+    _remove_partial(partial_path)
+    if fresh:
+      _check_sha1(remote_loc, actual_sha1, sha1)
+    log.warning("download doesn't match its hash, so starting over: %s", remote_loc)
+    _write_json(record, record_path)
+  os.rename(partial_path, local_path)
+  os.unlink(record_path)
+
+
+def _download_file(command_template, remote_loc, local_path,
+                   stream_mode=configs.StreamMode.none, sha1=None, resume=None, not_found_exit_code=None,
+                   confirm_not_found=False):
+  """
+  Download a file, checking its SHA1 hash, if one is given. If resume is given, the
+  download is retried and resumed as it says, and unless not_found_exit_code is set,
+  so a missing file can be told from a failed download, the file is known to exist.
+  """
+  with tracing.span("download", remote=remote_loc) as span:
+    if resume:
+      _download_resumable(command_template, remote_loc, local_path, stream_mode, sha1, resume,
+                          not_found_exit_code=not_found_exit_code, confirm_not_found=confirm_not_found)
+    else:
+      with atomic_output_file(local_path, make_parents=True) as temp_target:
+        transport = transports.for_location(remote_loc)
+        if transport:
+          transport.download(remote_loc, temp_target)
+          if sha1:
+            _check_sha1(remote_loc, file_sha1(temp_target), sha1)
+        elif stream_mode != configs.StreamMode.none:
+          with streams.command_output_stream(command_template, {"REMOTE": remote_loc},
+                                             stream_mode) as stream:
+            hashing_stream = streams.HashingReader(stream)
+            with open(temp_target, "wb") as f:
+              shutil.copyfileobj(hashing_stream, f, streams.BLOCK_SIZE)
+          _check_sha1(remote_loc, hashing_stream.hexdigest(), sha1)
+        else:
+          popenargs = shell_expand_to_popen(command_template,
+                                            dict_merge(os.environ,
+                                                       {"REMOTE": remote_loc,
+                                                        "LOCAL": temp_target}))
+          log.info("downloading: %s", " ".join(popenargs))
+          # TODO: Find a way to support force here.
+          parallel.check_call(popenargs)
+          if sha1:
+            _check_sha1(remote_loc, file_sha1(temp_target), sha1)
+    span.add_file_size(local_path)
+
+
+def _transfer_batch(command_template, pairs):
+  """
+  Transfer several files with one run of a batch command, which reads a manifest named
+  by $MANIFEST, with a line for each file, holding its source and destination, separated
+  by a tab.
+  """
+  with temp_output_dir("instaclone-batch.", always_clean=True) as temp_dir:
+    manifest_path = os.path.join(temp_dir, "manifest.tsv")
+    with open(manifest_path, "w") as f:
+      for (source, destination) in pairs:
+        f.write("%s\t%s\n" % (source, destination))
+    popenargs = shell_expand_to_popen(command_template,
+                                      dict_merge(os.environ, {"MANIFEST": manifest_path}))
+    log.info("transferring %s files: %s", len(pairs), " ".join(popenargs))
+    parallel.check_call(popenargs)
 
-def _compress_dir(local_dir, archive_path, force=False):
+
+def _batch_transfer(command_template):
+  """A function transferring a list of (source, destination) pairs, if a batch command is set."""
+  return (lambda pairs: _transfer_batch(command_template, pairs)) if command_template else None
+
+
+def _write_json(value, path):
+  with atomic_output_file(path, make_parents=True) as temp_path:
+    with open(temp_path, "w") as f:
+      json.dump(value, f, sort_keys=True, indent=2)
+
+
+def _compress_dir(local_dir, archive_path, archiver, level=None, threads=None, force=False):
   if os.path.exists(archive_path):
     if force:
       log.info("deleting previous archive: %s", archive_path)
@@ -90,65 +436,181 @@ def _compress_dir(local_dir, archive_path, force=False):
     else:
       raise AppError("Archive already in cache (has version changed?): %r" %
                      archive_path)
-  with atomic_output_file(archive_path) as temp_archive:
-    make_parent_dirs(temp_archive)
-    ARCHIVER.archive(local_dir, temp_archive)
+  with tracing.span("archive", format=archiver.name) as span:
+    with atomic_output_file(archive_path) as temp_archive:
+      make_parent_dirs(temp_archive)
+      archiver.archive(local_dir, temp_archive, level=level, threads=threads)
+    span.add_file_size(archive_path)
 
 
-def _decompress_dir(archive_path, target_path, force=False):
+def _clear_target_dir(target_path, force=False, trash_dir=None):
   if os.path.exists(target_path):
     if force:
       log.info("deleting previous dir: %s", target_path)
-      _rmtree_fast(target_path)
+      _rmtree_fast(target_path, trash_dir=trash_dir)
     else:
       raise AppError("Target already exists: %r" % target_path)
+
+
+def _decompress_dir(archive_path, target_path, force=False):
+  _clear_target_dir(target_path, force=force)
   with atomic_output_file(target_path) as temp_dir:
     make_all_dirs(temp_dir)
-    ARCHIVER.unarchive(archive_path, temp_dir)
+    archives.unarchive(archive_path, temp_dir, readonly=True)
 
 
-def _rsync_dir(source_dir, target_dir, chmod=None):
+def _download_and_decompress_dir(command_template, remote_loc, target_path,
+                                 stream_mode, force=False, sha1=None, resume=None):
+  """
+  Extract an archive as it is downloaded, so the archive is never written to
+  disk and extraction overlaps with the transfer. Checks the archive's SHA1
+  hash, if one is given. If resume is given, the download is retried as it
+  says, resuming where it left off, if the transport allows, or otherwise
+  starting the extraction over.
+  """
+  if resume and _can_resume(remote_loc, resume.ranged_command):
+    _decompress_stream_dir(lambda: _ResumingReader(command_template, remote_loc, stream_mode, resume),
+                           remote_loc, target_path, force=force, sha1=sha1)
+    return
+  retries = resume.retries if resume else 0
+  for attempt in range(retries + 1):
+    try:
+      _decompress_stream_dir(lambda: _open_download_stream(command_template, remote_loc, stream_mode),
+                             remote_loc, target_path, force=force, sha1=sha1)
+      return
+    except transports.NotFoundError:
+      raise
+    except _RETRY_ERRORS as e:
+      if attempt == retries:
+        raise
+      _retry_wait(remote_loc, attempt, e, 0)
+
+
+@contextmanager
+def _download_parts(command_template, remote_loc, target_path, parts, stream_mode, batch_command=None,
+                    resume=None):
   """
-  Use rsync to clone source_dir to target_dir.
-  Preserves the original owners and permissions.
-  As an optimization, rsync also allows perms to be partly modified
-  as files are synced.
+  Yield a stream of a file published in parts, which are downloaded concurrently, or
+  with runs of batch_command, if it is set, into a directory beside target_path. If
+  resume is given, each part's download is retried and resumed as it says, and what
+  was downloaded is kept if it fails, so a later download continues from it.
   """
-  popenargs = ["rsync", "-a", "--delete"]
-  if chmod:
-    popenargs.append("--chmod=%s" % chmod)
-  popenargs.append(source_dir.rstrip('/') + '/')
-  popenargs.append(target_dir)
-  log.info("using rsync for faster copy")
-  log.debug("rsync: %r" % popenargs)
-  subprocess.check_call(popenargs)
+  download = lambda part_loc, local_path: _download_file(command_template, part_loc, local_path,
+                                                         stream_mode=stream_mode, resume=resume)
+  parts_dir = locks.make_dirs(target_path + PARTS_SUFFIX)
+  with multipart.PartsReader(remote_loc, parts, download, parts_dir,
+                             download_batch=_batch_transfer(batch_command)) as reader:
+    yield reader
+  _rmtree_fast(parts_dir, ignore_errors=True)
+
+
+@contextmanager
+def _downloaded_part(command_template, part_loc, parts_dir, stream_mode, resume=None):
+  """Download a part into parts_dir, and yield it opened, deleting it once it is read."""
+  part_path = os.path.join(parts_dir, os.path.basename(part_loc))
+  _download_file(command_template, part_loc, part_path, stream_mode=stream_mode, resume=resume)
+  try:
+    with open(part_path, "rb") as f:
+      yield f
+  finally:
+    os.unlink(part_path)
+
+
+def _download_parts_to_file(command_template, remote_loc, local_path, parts,
+                            stream_mode, batch_command=None, resume=None):
+  """
+  Download a file published in parts, writing each at its offset. Each part is checked
+  against its hash. Parts are streamed straight into the file where the transport
+  allows, and otherwise downloaded beside it first, as they are with batch_command.
+  """
+  with atomic_output_file(local_path, make_parents=True) as temp_target:
+    if batch_command:
+      with _download_parts(command_template, remote_loc, local_path, parts, stream_mode,
+                           batch_command=batch_command, resume=resume) as stream:
+        with open(temp_target, "wb") as f:
+          shutil.copyfileobj(stream, f, streams.BLOCK_SIZE)
+      return
+    parts_dir = local_path + PARTS_SUFFIX
+    if resume and _can_resume(remote_loc, resume.ranged_command):
+      open_part = lambda part_loc: _ResumingReader(command_template, part_loc, stream_mode, resume)
+    elif not resume and (stream_mode != configs.StreamMode.none or transports.for_location(remote_loc)):
+      open_part = lambda part_loc: _open_download_stream(command_template, part_loc, stream_mode)
+    else:
+      locks.make_dirs(parts_dir)
+      open_part = lambda part_loc: _downloaded_part(command_template, part_loc, parts_dir, stream_mode,
+                                                    resume=resume)
+    multipart.download_to_file(remote_loc, parts, temp_target, open_part)
+    _rmtree_fast(parts_dir, ignore_errors=True)
 
 
-def _rmtree_fast(path, ignore_errors=False):
+def _decompress_stream_dir(open_stream, remote_loc, target_path, force=False, sha1=None):
   """
-  Delete a file or directory. Uses rsync to delete directories, which
-  is among the fastest ways possible to delete large numbers of
-  files. Note it can remove some read-only files.
-
-  slashroot.in/which-is-the-fastest-method-to-delete-files-in-linux
+  Extract an archive from the stream yielded by the context manager open_stream()
+  returns. Checks the archive's SHA1 hash, if one is given.
   """
-  if ignore_errors and not os.path.exists(path):
+  _clear_target_dir(target_path, force=force)
+  with atomic_output_file(target_path) as temp_dir:
+    make_all_dirs(temp_dir)
+    try:
+      with tracing.span("download_extract", remote=remote_loc) as span, open_stream() as stream:
+        hashing_stream = streams.HashingReader(stream)
+        archives.unarchive(hashing_stream, temp_dir, readonly=True)
+        streams.drain(hashing_stream)
+        span.add_bytes(hashing_stream.size)
+        _check_sha1(remote_loc, hashing_stream.hexdigest(), sha1)
+    except:
+      # Don't leave a partial directory behind, since failure is expected if
+      # the item is not an archive.
+      _rmtree_fast(temp_dir, ignore_errors=True)
+      raise
+
+
+def _compress_and_upload_dir(local_dir, command_template, remote_loc, target_path,
+                             stream_mode, archiver, level=None, threads=None, force=False):
+  """
+  Archive a directory straight into the upload command, while extracting the
+  same archive into target_path, so the archive is never written to disk and
+  compression overlaps with the transfer. Returns the SHA1 hash and size of the
+  archive.
+  """
+  _clear_target_dir(target_path, force=force)
+  with atomic_output_file(target_path) as temp_dir:
+    make_all_dirs(temp_dir)
+    try:
+      with tracing.span("archive_upload", format=archiver.name, remote=remote_loc) as span:
+        with _open_upload_stream(command_template, remote_loc, stream_mode) as upload_stream:
+          with streams.tee_to_consumer(upload_stream,
+                                       lambda stream: archives.unarchive(stream, temp_dir, readonly=True)) as stream:
+            hashing_stream = streams.HashingWriter(stream)
+            archiver.archive(local_dir, hashing_stream, level=level, threads=threads)
+        span.add_bytes(hashing_stream.size)
+    except:
+      _rmtree_fast(temp_dir, ignore_errors=True)
+      raise
+  return hashing_stream.hexdigest(), hashing_stream.size
+
+
+def _rmtree_fast(path, ignore_errors=False, trash_dir=None):
+  """
+  Delete a file or directory, with directories deleted in parallel. Note it
+  can remove read-only files and directories. If trash_dir is given, a directory
+  is instead moved there, if possible, to be deleted later, so large trees
+  don't hold up the caller. A file is just deleted, which is as quick as moving it.
+  """
+  if ignore_errors and not os.path.lexists(path):
     return
-  if os.path.isdir(path) and not os.path.islink(path):
-    with temp_output_dir("empty.", always_clean=True) as empty_dir:
-      popenargs = ["rsync", "-r", "--delete", empty_dir + '/', path]
-      subprocess.check_call(popenargs)
-    os.rmdir(path)
-  else:
-    os.unlink(path)
+  if trash_dir and os.path.isdir(path) and not os.path.islink(path) and trees.move_to_trash(path, trash_dir):
+    return
+  trees.remove_tree(path)
 
 
 @log_calls
 def _install_from_cache(cache_path, target_path, install_method,
-                        force=False, make_backup=False):
+                        force=False, make_backup=False, trash_dir=None):
   """
   Install a file or directory from cache, either symlinking,
-  hardlinking, or copying.
+  hardlinking, or copying. If trash_dir is given, anything replaced
+  is moved there rather than deleted right away.
   """
 
   def clear_symlink():
@@ -161,10 +623,10 @@ def _install_from_cache(cache_path, target_path, install_method,
     if os.path.exists(target_path):
       if force:
         if make_backup:
-          _rmtree_fast(target_path + BACKUP_SUFFIX, ignore_errors=True)
+          _rmtree_fast(target_path + BACKUP_SUFFIX, ignore_errors=True, trash_dir=trash_dir)
           move_to_backup(target_path, backup_suffix=BACKUP_SUFFIX)
         else:
-          _rmtree_fast(target_path)
+          _rmtree_fast(target_path, trash_dir=trash_dir)
       else:
         raise AppError("Target already exists: %r" % target_path)
 
@@ -175,25 +637,34 @@ def _install_from_cache(cache_path, target_path, install_method,
     checked_remove()
     os.symlink(cache_path, target_path)
   elif install_method == configs.InstallMethod.hardlink:
-    if os.path.isdir(cache_path):
-      raise AppError("Can't hardlink a directory: %r" % cache_path)
     checked_remove()
-    os.link(cache_path, target_path)
+    try:
+      if os.path.isdir(cache_path):
+        # A new tree of directories, with every file hardlinked to the cache.
+        with atomic_output_file(target_path) as temp_target:
+          trees.link_tree(cache_path, temp_target)
+      else:
+        os.link(cache_path, target_path)
+    except trees.TreeError as e:
+      raise AppError("%s (use another install_method)" % e)
+  elif install_method == configs.InstallMethod.reflink:
+    checked_remove()
+    with atomic_output_file(target_path) as temp_target:
+      trees.clone_tree(cache_path, temp_target)
   elif install_method == configs.InstallMethod.copy:
     checked_remove()
-    copytree_atomic(cache_path, target_path)
+    with atomic_output_file(target_path) as temp_target:
+      trees.copy_tree(cache_path, temp_target)
   elif install_method == configs.InstallMethod.fastcopy:
     if os.path.isdir(cache_path):
-      # Try it and see if rsync is available.
-      try:
-        clear_symlink()
-        # Ensure we add write perms since the cache has read-only perms.
-        # Other perms will be preserved.
-        _rsync_dir(cache_path, target_path, chmod="u+w")
-      except OSError as err:
-        log.info("rsync not found, will copy instead: %s", err)
-        checked_remove()
-        copytree_atomic(cache_path, target_path)
+      # A copy of a directory is replaced, as by a sync, without needing force.
+      clear_symlink()
+      if os.path.isdir(target_path):
+        _rmtree_fast(target_path, trash_dir=trash_dir)
+      checked_remove()
+      # The copy is writable by the owner, since the cache is read-only, but otherwise keeps modes.
+      with atomic_output_file(target_path) as temp_target:
+        trees.copy_tree(cache_path, temp_target)
     else:
       checked_remove()
       copyfile_atomic(cache_path, target_path)
@@ -201,6 +672,56 @@ def _install_from_cache(cache_path, target_path, install_method,
     raise AssertionError("Invalid install_method: %r" % install_method)
 
 
+def _link_or_clone(source_path, target_path):
+  """
+  Copy a file or directory from the cache to target_path, which must not exist, with
+  files hardlinked if both are on the same filesystem, since cached files are read-only,
+  and otherwise cloned or copied. The copy is read-only.
+  """
+  if os.stat(source_path).st_dev == os.stat(os.path.dirname(target_path)).st_dev:
+    try:
+      if os.path.isdir(source_path):
+        trees.link_tree(source_path, target_path)
+      else:
+        os.link(source_path, target_path)
+    except (OSError, trees.TreeError) as e:
+      # Say the files belong to another user, and the kernel protects them from hardlinks.
+      log.debug("can't hardlink, so copying: %s: %s", source_path, e)
+      _rmtree_fast(target_path, ignore_errors=True)
+    else:
+      trees.make_readonly(target_path)
+      return
+  trees.clone_tree(source_path, target_path)
+  trees.make_readonly(target_path)
+
+
+def _disk_usage(path, count_linked_files=True):
+  """
+  Disk usage of a file or directory. Optionally leaves out files with several links,
+  which are hardlinks to blobs that are counted separately.
+  """
+  if os.path.islink(path) or not os.path.isdir(path):
+    return os.lstat(path).st_blocks * 512
+  total = 0
+  for (dir_path, _, file_names) in os.walk(path):
+    total += os.lstat(dir_path).st_blocks * 512
+    for name in file_names:
+      st = os.lstat(os.path.join(dir_path, name))
+      if count_linked_files or not stat.S_ISREG(st.st_mode) or st.st_nlink == 1:
+        total += st.st_blocks * 512
+  return total
+
+
+def _format_size(size):
+  for unit in "", "K", "M", "G":
+    if size < 1024:
+      break
+    size /= 1024.0
+  else:
+    unit = "T"
+  return "%.1f%s" % (size, unit) if unit else "%d" % size
+
+
 VERSION_SEP = ".$"
 VERSION_END = "$"
 
@@ -209,30 +730,69 @@ class FileCache(object):
   """
   Manage uploading and downloading files to/from the cloud using a
   local cache to maintain copies.  Also seamlessly support directories
-  by archiving them as compressed files.  The cache is not bounded and
-  must be managed/cleaned up manually.
+  by archiving them as compressed files.  The cache is not bounded, but
+  gc evicts least recently used versions to bring it under a size limit.
+
+  Versions this cache lacks are looked for in the caches at shared_paths, in order,
+  before the remote, and are downloaded into the first of those that is writable, so
+  machines sharing it download each version once.
   """
 
   version = "1"
 
-  def __init__(self, root_path):
+  def __init__(self, root_path, shared_paths=()):
     self.root_path = root_path.rstrip("/")
     self.contents_path = os.path.join(root_path, "contents")
     self.version_path = os.path.join(root_path, "version")
+    self.index_path = os.path.join(root_path, index.INDEX_NAME)
+    # Deleted trees are moved here, then deleted in the background.
+    self.trash_path = os.path.join(root_path, "trash")
+    # Locks on the cache, so processes sharing it can add, install, and evict versions at once.
+    self.locks_path = os.path.join(root_path, "locks")
+    self.lock_timeout = configs.lock_timeout()
+    self.index = None
     self.setup_done = False
+    # The published index of versions of each item, fetched once per run, by its location.
+    self.published_versions = {}
+    self.published_versions_lock = threading.Lock()
     assert os.path.exists(self.root_path)
+    # A shared cache may be read-only, in which case versions are only copied from it.
+    self.writable = os.access(self.root_path, os.W_OK)
+    # The cache to look in next, before the remote.
+    self.next_tier = FileCache(shared_paths[0], shared_paths[1:]) if shared_paths else None
 
   def setup(self):
-    """Lazy initialize file cache post instantiation."""
+    """
+    Lazy initialize file cache post instantiation. Other processes sharing the cache may
+    be setting it up at the same time, so this is done holding a lock.
+    """
     if not self.setup_done:
-      if os.path.exists(self.version_path):
-        log.info("using cache: %s", self.root_path)
-      else:
-        log.info("initializing new cache: %s", self.root_path)
-        make_all_dirs(self.contents_path)
-        write_string_to_file(self.version_path, FileCache.version + "\n")
+      locks.make_dirs(self.locks_path)
+      with self._lock(SETUP_LOCK):
+        if os.path.exists(self.version_path):
+          log.info("using cache: %s", self.root_path)
+        else:
+          log.info("initializing new cache: %s", self.root_path)
+          locks.make_dirs(self.contents_path)
+          write_string_to_file(self.version_path, FileCache.version + "\n", backup_suffix=None)
+        self.index = index.CacheIndex(self.index_path)
+        if self.index.created:
+          self._rebuild_index()
       self.setup_done = True
 
+  def _lock(self, name, shared=False):
+    return locks.FileLock(os.path.join(self.locks_path, name), shared=shared, timeout=self.lock_timeout)
+
+  def _path_lock(self, path, shared=False):
+    """
+    The lock on a cached version or blob store, given its path relative to the contents.
+    It is held exclusively to add, replace, or delete what is there, and shared to use it.
+    """
+    return self._lock(hashlib.sha1(path).hexdigest() + LOCK_SUFFIX, shared=shared)
+
+  def _store_lock(self, config, shared=False):
+    return self._path_lock(os.path.relpath(self._blob_store_path(config), self.contents_path), shared=shared)
+
   def __str__(self):
     return "FileCache@%s" % self.root_path
 
@@ -260,21 +820,452 @@ class FileCache(object):
     return os.path.join(config.remote_prefix,
                         self.versioned_path(config, version, suffix))
 
+  @staticmethod
+  def _is_entry_name(name):
+    return VERSION_SEP in name and name.endswith(VERSION_END)
+
+  def _entry_key(self, config, version):
+    """The path of the directory holding a cached version, relative to contents."""
+    return os.path.relpath(os.path.dirname(self.cache_path(config, version)), self.contents_path)
+
+  def _blob_store_path(self, config):
+    return os.path.join(self.contents_path, self.pathify_remote_loc(config.remote_prefix), blobstore.BLOBS_DIR)
+
+  def _index_blobs(self, paths):
+    """Add stored blobs to the index, in one transaction."""
+    self.index.add_blobs([(os.path.relpath(path, self.contents_path), os.lstat(path).st_blocks * 512)
+                          for path in paths])
+
+  def _index_entry(self, entry_path, name, version, store_path=None, last_used=None):
+    """Add a cached version to the index. Its files are in store_path, if it is set."""
+    cached_path = os.path.join(entry_path, os.path.basename(name))
+    last_used = last_used or time.time()
+    entry = index.Entry(os.path.relpath(entry_path, self.contents_path), name, version,
+                        "dir" if os.path.isdir(cached_path) else "file",
+                        _disk_usage(entry_path, count_linked_files=store_path is None),
+                        store_path and os.path.relpath(store_path, self.contents_path),
+                        last_used, last_used)
+    self.index.put(entry)
+    return entry
+
+  def _add_to_index(self, config, version):
+    """Add a version just added to the cache to the index."""
+    cached_manifest = self.cache_path(config, version, suffix=blobstore.MANIFEST_SUFFIX)
+    store_path = self._blob_store_path(config) if os.path.exists(cached_manifest) else None
+    return self._index_entry(os.path.dirname(self.cache_path(config, version)), config.name, version,
+                             store_path=store_path)
+
+  def _rebuild_index(self):
+    """Index a cache that was filled before it had an index."""
+    entry_keys = []
+    blob_paths = []
+    for (dir_path, dir_names, _) in os.walk(self.contents_path):
+      for name in list(dir_names):
+        path = os.path.join(dir_path, name)
+        if name == blobstore.BLOBS_DIR:
+          dir_names.remove(name)
+          for (blob_dir_path, _, file_names) in os.walk(path):
+            blob_paths.extend(os.path.join(blob_dir_path, file_name) for file_name in file_names)
+        elif self._is_entry_name(name):
+          dir_names.remove(name)
+          (item_name, version) = name[:-len(VERSION_END)].split(VERSION_SEP, 1)
+          if not os.path.lexists(os.path.join(path, item_name)):
+            # Left by a failed download.
+            continue
+          store_path = None
+          if os.path.exists(os.path.join(path, item_name + blobstore.MANIFEST_SUFFIX)):
+            # The blob store for a version is in its nearest parent with one.
+            store_dir = dir_path
+            while not os.path.isdir(os.path.join(store_dir, blobstore.BLOBS_DIR)):
+              store_dir = os.path.dirname(store_dir)
+            store_path = os.path.join(store_dir, blobstore.BLOBS_DIR)
+          entry = self._index_entry(path, item_name, version, store_path=store_path,
+                                    last_used=os.lstat(path).st_mtime)
+          entry_keys.append(entry.path)
+    self._index_blobs(blob_paths)
+    # Checkouts made before the index may link to any of these, so gc keeps them until
+    # they are installed again and their installs are recorded.
+    self.index.add_unrecorded(entry_keys)
+    if entry_keys:
+      log.info("indexed %s cached versions", len(entry_keys))
+
+  def _lookup(self, config, version):
+    """
+    The index entry for a version, if it is cached. A version found in the cache but
+    not the index, say after an interrupted install, is added to the index.
+    """
+    cached_path = self.cache_path(config, version)
+    entry = self.index.get(self._entry_key(config, version))
+    if entry is None:
+      return self._add_to_index(config, version) if os.path.exists(cached_path) else None
+    if not os.path.lexists(cached_path):
+      log.info("forgetting version that is missing from cache: %s", entry.path)
+      self.index.remove(entry.path)
+      return None
+    return entry
+
+  def file_sha1(self, path):
+    """SHA1 hash of a file, remembered for as long as the file is unchanged."""
+    self.setup()
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat_key = (st.st_dev, st.st_ino, st.st_size, st.st_mtime)
+    sha1 = self.index.get_hash(path, stat_key)
+    if sha1 is None:
+      log.debug("computing sha1 of: %s", path)
+      with tracing.span("hash", path=path) as span:
+        sha1 = file_sha1(path)
+        span.add_bytes(st.st_size)
+      if time.time() - st.st_mtime > RECENT_MTIME_SECONDS:
+        self.index.put_hash(path, stat_key, sha1)
+    else:
+      log.debug("using remembered sha1 of: %s", path)
+    return sha1
+
+  def _record_use(self, config, version):
+    """
+    Mark a version as just used, for least-recently-used eviction, and if it is installed
+    as a symlink, record the install so the version isn't evicted while it is in use.
+    """
+    key = self._entry_key(config, version)
+    target = os.path.abspath(config.local_path)
+    self.index.touch(key)
+    self.index.remove_unrecorded(key)
+    if config.install_method == configs.InstallMethod.symlink:
+      self.index.add_install(target, key)
+    if config.install_method == configs.InstallMethod.fastcopy and os.path.isdir(self.cache_path(config, version)):
+      self.index.set_copy(target, key)
+    else:
+      self.index.remove_copy(target)
+
+  def _files_manifest(self, config, key):
+    """
+    The file manifest of a cached directory, given its entry key, made the first time
+    it is needed, or None if the version is no longer cached.
+    """
+    name = os.path.basename(config.name)
+    cached_path = os.path.join(self.contents_path, key, name)
+    manifest_path = os.path.join(self.contents_path, key, name + FILES_SUFFIX)
+    if os.path.isfile(manifest_path):
+      with open(manifest_path) as f:
+        manifest = json.load(f)
+      if manifest.get("format") == trees.FILES_FORMAT:
+        return manifest
+    if not os.path.isdir(cached_path):
+      return None
+    # Trees stored as blobs already have a manifest with the hash of each file.
+    known_hashes = {}
+    blob_manifest_path = os.path.join(self.contents_path, key, name + blobstore.MANIFEST_SUFFIX)
+    if os.path.isfile(blob_manifest_path):
+      known_hashes = dict((entry["path"], entry["hash"])
+                          for entry in blobstore.read_manifest(blob_manifest_path)["entries"]
+                          if entry["type"] == "file")
+    manifest = trees.scan_files(cached_path, known_hashes=known_hashes)
+    _write_json(manifest, manifest_path)
+    return manifest
+
+  def _update_copy(self, config, version, cached_path):
+    """
+    Turn a copy of another version, installed at the local path by fastcopy, into a copy
+    of this one, changing only the files that differ between the versions. Returns False
+    if there is no such copy, or it has been modified, so it needs a full copy instead.
+    """
+    target = config.local_path
+    old_key = self.index.get_copy(os.path.abspath(target))
+    if not old_key or os.path.islink(target) or not os.path.isdir(target):
+      return False
+    old_manifest = self._files_manifest(config, old_key)
+    if old_manifest is None:
+      log.info("previously installed version no longer cached, so copying all files: %s", old_key)
+      return False
+    if not trees.tree_matches(old_manifest, target):
+      log.info("files changed since install, so copying all files: %s", target)
+      return False
+    new_manifest = self._files_manifest(config, self._entry_key(config, version))
+    trees.update_tree(old_manifest, new_manifest, cached_path, target)
+    return True
+
+  def _install_cached(self, config, version, cached_path, force=False):
+    """Install a cached version, incrementally if it is a fastcopy over another version."""
+    if not (config.install_method == configs.InstallMethod.fastcopy and os.path.isdir(cached_path) and
+            self._update_copy(config, version, cached_path)):
+      _install_from_cache(cached_path, config.local_path,
+                          config.install_method, force=force, trash_dir=self.trash_path)
+
+  def _live_entries(self):
+    """
+    Versions currently symlinked to by installs, or that may be, since they were cached
+    before the index and haven't been installed since. Forgets installs that are gone.
+    """
+    live = self.index.unrecorded()
+    for (target, key) in self.index.installs():
+      entry_path = os.path.realpath(os.path.join(self.contents_path, key))
+      if os.path.islink(target) and os.path.realpath(target).startswith(entry_path + os.sep):
+        live.add(key)
+      else:
+        log.debug("forgetting install that is no longer a symlink to cache: %s", target)
+        self.index.remove_install(target)
+    return live
+
+  def _delete_blobs(self, paths):
+    for path in paths:
+      os.unlink(path)
+    return self.index.remove_blobs([os.path.relpath(path, self.contents_path) for path in paths])
+
+  def _delete_unused_blobs(self, store_path, paths):
+    """
+    Delete those of the given blobs, in a store given by its path relative to the contents,
+    that no tree links to any longer. While another process is adding to the store, blobs it
+    just added look unused, so they are all left for a later gc. Returns the space freed.
+    """
+    lock = self._path_lock(store_path)
+    if not lock.acquire(wait=False):
+      log.info("not deleting unused files, since the store is in use: %s", store_path)
+      return 0
+    try:
+      return self._delete_blobs(blobstore.unused_paths(paths))
+    finally:
+      lock.release()
+
+  def _evict(self, entry):
+    """Delete a cached version, and any blobs only it used. Returns the space freed."""
+    entry_path = os.path.join(self.contents_path, entry.path)
+    blob_paths = []
+    if entry.store:
+      cached_manifest = os.path.join(entry_path, os.path.basename(entry.name) + blobstore.MANIFEST_SUFFIX)
+      store = blobstore.BlobStore(os.path.join(self.contents_path, entry.store))
+      blob_paths = store.manifest_paths(blobstore.read_manifest(cached_manifest))
+    # Blobs are freed once no tree links to them, so trees of blobs are deleted now.
+    _rmtree_fast(entry_path, ignore_errors=True, trash_dir=None if entry.store else self.trash_path)
+    self.index.remove(entry.path)
+    return entry.size + (self._delete_unused_blobs(entry.store, blob_paths) if blob_paths else 0)
+
+  def _evict_unused(self, entry):
+    """
+    Evict a version, unless another process is using it, or has evicted it already.
+    Returns the space freed, or None if it wasn't evicted.
+    """
+    lock = self._path_lock(entry.path)
+    if not lock.acquire(wait=False):
+      log.debug("not evicting version in use by another process: %s", entry.path)
+      return None
+    try:
+      if not self.index.get(entry.path):
+        return None
+      log.info("evicting: %s", entry.path)
+      freed = self._evict(entry)
+      lock.remove()
+      return freed
+    finally:
+      lock.release()
+
+  @log_calls
+  def gc(self, max_size=None):
+    """
+    Evict least recently used versions until the cache is no larger than max_size.
+    Versions that are currently installed as symlinks are never evicted, nor are those
+    cached before the cache had an index, until they are next installed, since where
+    they are installed isn't known. Without a size, just deletes blobs no version uses
+    any longer.
+    """
+    self.setup()
+    live = self._live_entries()
+    entries = self.index.entries()
+    total = start_total = self.index.total_size()
+    evicted = 0
+    if max_size is None:
+      # Blobs are in the store two levels above them.
+      stores = {}
+      for path in self.index.blob_paths():
+        stores.setdefault(os.path.dirname(os.path.dirname(path)), []).append(os.path.join(self.contents_path, path))
+      for (store_path, paths) in sorted(stores.iteritems()):
+        total -= self._delete_unused_blobs(store_path, paths)
+    else:
+      for entry in entries:
+        if total <= max_size:
+          break
+        if entry.path in live:
+          log.debug("not evicting version in use: %s", entry.path)
+          continue
+        freed = self._evict_unused(entry)
+        if freed is not None:
+          total -= freed
+          evicted += 1
+      if total > max_size:
+        log.warn("cache is still over its limit, since remaining versions are in use: %s > %s",
+                 _format_size(total), _format_size(max_size))
+
+    log.info("gc: evicted %s of %s versions, cache size %s -> %s%s", evicted, len(entries),
+             _format_size(start_total), _format_size(total),
+             "" if max_size is None else " (limit %s)" % _format_size(max_size))
+
+  def status(self, stream=sys.stdout):
+    """Print all cached versions, most recently used first."""
+    self.setup()
+    live = self._live_entries()
+    unrecorded = self.index.unrecorded()
+    entries = self.index.entries()
+    for entry in reversed(entries):
+      note = ""
+      if entry.path in unrecorded:
+        note = "  (installs unknown)"
+      elif entry.path in live:
+        note = "  (installed)"
+      print("%8s  %s  %-4s  %s%s" %
+            (_format_size(entry.size), time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used)),
+             entry.kind, entry.path, note), file=stream)
+    print("%s versions, %s in total (including shared files)" %
+          (len(entries), _format_size(self.index.total_size())), file=stream)
+
   def _upload(self, config, cached_path, version):
     _upload_file(config.upload_command, cached_path,
                  self.remote_loc(config, version))
 
+  def _upload_published(self, config, local_path, remote_loc):
+    """
+    Upload a published file or archive, in parts if it is larger than multipart_size.
+    Returns the size and hash of each part, or None if it was uploaded whole.
+    """
+    if config.multipart_size and os.path.getsize(local_path) > config.multipart_size:
+      upload = lambda part_path, part_loc: _upload_file(config.upload_command, part_path, part_loc,
+                                                        stream_mode=config.stream_mode)
+      open_upload = None
+      if _can_stream(config, remote_loc):
+        open_upload = lambda part_loc: _open_upload_stream(config.upload_command, part_loc, config.stream_mode)
+      return multipart.upload_parts(local_path, remote_loc, config.multipart_size, upload,
+                                    upload_batch=_batch_transfer(config.batch_upload_command),
+                                    open_upload=open_upload)
+    _upload_file(config.upload_command, local_path, remote_loc, stream_mode=config.stream_mode)
+    return None
+
+  @staticmethod
+  def _resume(config):
+    """How to retry and resume downloads of objects known to exist."""
+    return Resume(config.download_retries or 0, config.ranged_download_command)
+
+  def blob_store(self, config):
+    """The store of content-addressed blobs shared by all items with the same remote prefix."""
+    return blobstore.BlobStore(
+      self._blob_store_path(config),
+      os.path.join(config.remote_prefix, blobstore.BLOBS_DIR),
+      upload=lambda local_path, remote_loc: _upload_file(config.upload_command, local_path, remote_loc,
+                                                         stream_mode=config.stream_mode),
+      download=lambda remote_loc, local_path: _download_file(config.download_command, remote_loc, local_path,
+                                                             stream_mode=config.stream_mode,
+                                                             resume=self._resume(config)),
+      upload_batch=_batch_transfer(config.batch_upload_command),
+      download_batch=_batch_transfer(config.batch_download_command),
+      on_add=self._index_blobs)
+
   @log_calls
   def publish(self, config, version, force=False):
-    # As precaution for users, we keep unarchived items in cache
-    # that may be symlinked to as read-only.
-    cached_path = self.cache_path(config, version)
-    try:
-      _make_writable(cached_path, silent=True)
+    tracing.annotate(item=config.name, version=version)
+    self.setup()
+    with self._path_lock(self._entry_key(config, version)):
+      locks.make_dirs(os.path.dirname(self.cache_path(config, version)))
+      # As precaution for users, we keep unarchived items in cache
+      # that may be symlinked to as read-only. They are created read-only,
+      # so the cache never needs a pass over the whole tree to change modes.
       self._publish_writable(config, version, make_backup=config.make_backup,
                              force=force)
-    finally:
-      _make_readonly(cached_path, silent=True)
+      self._add_to_index(config, version)
+      self._record_use(config, version)
+      self._write_through(config, version)
+
+  def versions_loc(self, config):
+    return os.path.join(config.remote_prefix, config.remote_path, config.name + VERSIONS_SUFFIX)
+
+  def _fetch_json(self, config, remote_loc, local_path, known=False, confirm_not_found=False):
+    """
+    Download and parse a JSON object. Returns None if it doesn't exist, which a download
+    command is run a second time to confirm, if confirm_not_found is set. If known is set,
+    the object is known to exist, so any failure of a download command is retried. A
+    download that fails some other way is retried, and then raises an error, since treating
+    the object as missing would mean probing for what was published, or losing the versions listed.
+    """
+    try:
+      _download_file(config.download_command, remote_loc, local_path, stream_mode=config.stream_mode,
+                     resume=self._resume(config), not_found_exit_code=None if known else config.not_found_exit_code,
+                     confirm_not_found=confirm_not_found)
+    except transports.NotFoundError:
+      return None
+    with open(local_path) as f:
+      value = json.load(f)
+    if value.get("format") != META_FORMAT:
+      raise AppError("Unsupported format (published by a newer version of instaclone?): %s" % remote_loc)
+    return value
+
+  def fetch_versions(self, config):
+    """
+    The published index of all versions of an item, or None if there is none. It is
+    only a hint, since a version published at the same time as another may be missing.
+    """
+    with temp_output_dir("instaclone-versions.", always_clean=True) as temp_dir:
+      return self._fetch_json(config, self.versions_loc(config),
+                              os.path.join(temp_dir, os.path.basename(config.name) + VERSIONS_SUFFIX),
+                              confirm_not_found=True)
+
+  def _published_versions(self, config):
+    """The published index of versions of an item, as fetch_versions returns, fetched once per run."""
+    with self.published_versions_lock:
+      loc = self.versions_loc(config)
+      if loc not in self.published_versions:
+        self.published_versions[loc] = self.fetch_versions(config)
+      return self.published_versions[loc]
+
+  def _fetch_meta(self, config, version, known=False):
+    """
+    What was published for a version, or None if it has no metadata. If known is set,
+    the metadata is known to exist, as the index of versions lists it. Otherwise, a
+    download command that fails as if it is missing is taken at its word, as it is only
+    looked for when the index doesn't list the version.
+    """
+    return self._fetch_json(config, self.remote_loc(config, version, suffix=META_SUFFIX),
+                            self.cache_path(config, version, suffix=META_SUFFIX), known=known)
+
+  def _publish_meta(self, config, version, kind, sha1, size, archive_format=None, parts=None):
+    """
+    Publish metadata for a version, so install knows what to download without probing,
+    and add it to the item's index of versions. This is done once the version itself is
+    published. If two versions are published at once, one may be missing from the index,
+    so the index is only a hint: install still finds the version by its own metadata. If
+    the version was uploaded in parts, the metadata lists them.
+    """
+    meta = {"format": META_FORMAT, "name": config.name, "version": version, "type": kind,
+            "archive_format": archive_format, "size": size, "sha1": sha1, "published": time.time()}
+    if parts:
+      meta["parts"] = parts
+    cached_meta = self.cache_path(config, version, suffix=META_SUFFIX)
+    _write_json(meta, cached_meta)
+    _upload_file(config.upload_command, cached_meta, self.remote_loc(config, version, suffix=META_SUFFIX),
+                 stream_mode=config.stream_mode)
+
+    versions = self.fetch_versions(config) or {"format": META_FORMAT, "name": config.name, "versions": {}}
+    versions["versions"][version] = {key: meta[key] for key in meta if key not in ("format", "name", "version", "parts")}
+    with temp_output_dir("instaclone-versions.", always_clean=True) as temp_dir:
+      versions_path = os.path.join(temp_dir, os.path.basename(config.name) + VERSIONS_SUFFIX)
+      _write_json(versions, versions_path)
+      _upload_file(config.upload_command, versions_path, self.versions_loc(config),
+                   stream_mode=config.stream_mode)
+    with self.published_versions_lock:
+      self.published_versions[self.versions_loc(config)] = versions
+
+  def print_versions(self, config, stream=sys.stdout):
+    """
+    Print all published versions of an item, most recent last, as listed in its index,
+    which may lack versions published at the same time as others, or by older versions
+    of instaclone.
+    """
+    versions = self.fetch_versions(config)
+    if versions is None:
+      log.info("no index of published versions: %s", self.versions_loc(config))
+      return
+    log.info("versions published at once, or by older versions of instaclone, may be missing from this list: %s",
+             self.versions_loc(config))
+    for (version, meta) in sorted(versions["versions"].iteritems(), key=lambda (_, meta): meta["published"]):
+      print("%s  %s  %-8s  %8s  %s" %
+            (config.name, time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["published"])),
+             meta["archive_format"] or meta["type"], _format_size(meta["size"]), version), file=stream)
 
   def _publish_writable_local_file(self, config, version,
                                    local_path, cached_path,
@@ -285,33 +1276,83 @@ class FileCache(object):
     # For speed on large files, move it rather than copy.
     # Also make it read-only, just as it will be after install.
     movefile(local_path, cached_path, make_parents=True)
-    _upload_file(config.upload_command, cached_path, remote_loc)
+    trees.make_readonly(cached_path)
+    parts = self._upload_published(config, cached_path, remote_loc)
+    self._publish_meta(config, version, "file", file_sha1(cached_path), os.path.getsize(cached_path),
+                       parts=parts)
     log.info("installed to cache: %s -> %s", local_path, cached_path)
     _install_from_cache(cached_path, local_path, config.install_method,
-                        force=False, make_backup=make_backup)
+                        force=False, make_backup=make_backup, trash_dir=self.trash_path)
     log.info("published file: %s", remote_loc)
 
+  def _publish_writable_local_tree(self, config, version,
+                                   local_path, cached_path,
+                                   force=False, make_backup=True):
+    """Publish a directory as a manifest plus any blobs not already published."""
+    store = self.blob_store(config)
+    cached_manifest = self.cache_path(config, version, suffix=blobstore.MANIFEST_SUFFIX)
+    remote_manifest_loc = self.remote_loc(config, version, suffix=blobstore.MANIFEST_SUFFIX)
+
+    log.debug("installing to cache: %s -> %s", local_path, cached_path)
+    _clear_target_dir(cached_path, force=force, trash_dir=self.trash_path)
+    manifest, sources = blobstore.scan_tree(local_path)
+    # Blobs are unused until the tree links to them, so gc mustn't delete them in between.
+    with self._store_lock(config, shared=True):
+      try:
+        store.upload_missing(sources, level=config.archive_level)
+        blobstore.write_manifest(manifest, cached_manifest)
+        # The manifest goes last, so a published manifest always has its blobs.
+        _upload_file(config.upload_command, cached_manifest, remote_manifest_loc,
+                     stream_mode=config.stream_mode)
+        self._publish_meta(config, version, "manifest", file_sha1(cached_manifest),
+                           os.path.getsize(cached_manifest))
+        with atomic_output_file(cached_path) as temp_dir:
+          make_all_dirs(temp_dir)
+          store.materialize(manifest, temp_dir, readonly=True)
+      finally:
+        store.flush()
+    log.info("installed to cache: %s -> %s", local_path, cached_path)
+    _install_from_cache(cached_path, local_path, config.install_method,
+                        force=True, make_backup=make_backup, trash_dir=self.trash_path)
+    log.info("published manifest: %s", remote_manifest_loc)
+
   def _publish_writable_local_dir(self, config, version,
                                   local_path, cached_path,
                                   force=False, make_backup=True):
-    cached_archive = self.cache_path(config, version, suffix=ARCHIVER.suffix)
-    remote_loc = self.remote_loc(config, version, suffix=ARCHIVER.suffix)
+    if config.storage_mode == configs.StorageMode.content:
+      return self._publish_writable_local_tree(config, version, local_path, cached_path,
+                                               force=force, make_backup=make_backup)
+    archiver = archives.ARCHIVERS[config.archive_format]
+    cached_archive = self.cache_path(config, version, suffix=archiver.suffix)
+    remote_loc = self.remote_loc(config, version, suffix=archiver.suffix)
 
     # We archive and then unarchive, to make sure we expand symlinks
     # exactly the way a future installation would.
     # TODO: This is usually what we want (think of relative symlinks
     # like ../../foo), but we could make it an option.
     log.debug("installing to cache: %s -> %s", local_path, cached_path)
-    _compress_dir(local_path, cached_archive, force=force)
-    _upload_file(config.upload_command, cached_archive, remote_loc)
-    _decompress_dir(cached_archive, cached_path, force=force)
-    # If everything has succeeded, we can safely delete the archive
-    # to save space.
-    os.unlink(cached_archive)
+    parts = None
+    # Archives that may be split into parts are written out first, so their size is known.
+    if _can_stream(config, remote_loc) and archiver.streaming and not config.multipart_size:
+      (sha1, size) = _compress_and_upload_dir(local_path, config.upload_command, remote_loc,
+                                              cached_path, config.stream_mode, archiver,
+                                              level=config.archive_level, threads=config.archive_threads,
+                                              force=force)
+    else:
+      _compress_dir(local_path, cached_archive, archiver,
+                    level=config.archive_level, threads=config.archive_threads,
+                    force=force)
+      parts = self._upload_published(config, cached_archive, remote_loc)
+      (sha1, size) = (file_sha1(cached_archive), os.path.getsize(cached_archive))
+      _decompress_dir(cached_archive, cached_path, force=force)
+      # If everything has succeeded, we can safely delete the archive
+      # to save space.
+      os.unlink(cached_archive)
+    self._publish_meta(config, version, "archive", sha1, size, archive_format=archiver.name, parts=parts)
     # Leave the previous version of the tree as a backup.
     log.info("installed to cache: %s -> %s", local_path, cached_path)
     _install_from_cache(cached_path, local_path, config.install_method,
-                        force=True, make_backup=make_backup)
+                        force=True, make_backup=make_backup, trash_dir=self.trash_path)
     log.info("published archive: %s", remote_loc)
 
   def _publish_writable(self, config, version, make_backup, force=False):
@@ -340,77 +1381,351 @@ class FileCache(object):
     else:
       raise ValueError("File not found: %r" % local_path)
 
+  def _download_tree(self, config, version, cached_path, force=False, sha1=None):
+    """
+    Download a directory published as a manifest, fetching only blobs not already in
+    the cache. Returns False if there is no manifest.
+    """
+    store = self.blob_store(config)
+    cached_manifest = self.cache_path(config, version, suffix=blobstore.MANIFEST_SUFFIX)
+    remote_manifest_loc = self.remote_loc(config, version, suffix=blobstore.MANIFEST_SUFFIX)
+    try:
+      # With a hash from the metadata, the manifest is known to exist.
+      _download_file(config.download_command, remote_manifest_loc, cached_manifest,
+                     stream_mode=config.stream_mode, sha1=sha1, resume=self._resume(config) if sha1 else None)
+    except _TRANSFER_ERRORS:
+      return False
+    log.info("downloaded published manifest: %s", remote_manifest_loc)
+    manifest = blobstore.read_manifest(cached_manifest)
+    # Blobs are unused until the tree links to them, so gc mustn't delete them in between.
+    with self._store_lock(config, shared=True):
+      try:
+        store.download_missing(manifest)
+        _clear_target_dir(cached_path, force=force, trash_dir=self.trash_path)
+        with atomic_output_file(cached_path) as temp_dir:
+          make_all_dirs(temp_dir)
+          store.materialize(manifest, temp_dir, readonly=True)
+      finally:
+        store.flush()
+    return True
+
+  def _download_archive_as(self, config, version, cached_path, archiver, force=False, sha1=None,
+                           parts=None, resume=None):
+    """
+    Download and extract a published archive of a directory into the cache. Raises
+    an error in _TRANSFER_ERRORS if the download fails, say because there is no such archive.
+    An archive published in parts is extracted as its parts are downloaded. If resume is
+    given, the archive is known to exist, and downloads are retried and resumed as it says.
+    """
+    remote_archive_loc = self.remote_loc(config, version, suffix=archiver.suffix)
+    if parts and archiver.streaming:
+      _decompress_stream_dir(lambda: _download_parts(config.download_command, remote_archive_loc, cached_path,
+                                                     parts, config.stream_mode,
+                                                     batch_command=config.batch_download_command,
+                                                     resume=resume),
+                             remote_archive_loc, cached_path, force=force, sha1=sha1)
+      log.info("downloaded and extracted published archive in %s parts: %s", len(parts), remote_archive_loc)
+    elif _can_stream(config, remote_archive_loc) and archiver.streaming:
+      _download_and_decompress_dir(config.download_command, remote_archive_loc,
+                                   cached_path, config.stream_mode, force=force, sha1=sha1, resume=resume)
+      log.info("downloaded and extracted published archive: %s", remote_archive_loc)
+    else:
+      cached_archive_path = self.cache_path(
+        config, version, suffix=archiver.suffix)
+      if parts:
+        _download_parts_to_file(config.download_command, remote_archive_loc, cached_archive_path, parts,
+                                config.stream_mode, batch_command=config.batch_download_command,
+                                resume=resume)
+      else:
+        _download_file(config.download_command, remote_archive_loc, cached_archive_path,
+                       stream_mode=config.stream_mode, sha1=sha1, resume=resume)
+      log.info("downloaded published archive: %s", remote_archive_loc)
+      _decompress_dir(cached_archive_path, cached_path, force=force)
+      # If everything has succeeded, we can safely delete the
+      # archive to save space.
+      os.unlink(cached_archive_path)
+
+  def _download_archive(self, config, version, cached_path, force=False):
+    """
+    Download and extract a published archive of a directory into the cache, for a
+    version published without metadata. Only the original tar.gz format is looked
+    for, as archives in other formats are always published with metadata. Returns
+    False if there is no archive, so the item must be a file.
+    """
+    try:
+      self._download_archive_as(config, version, cached_path, archives.TarGzArchiver, force=force)
+    except _TRANSFER_ERRORS:
+      return False
+    return True
+
+  def _download_published(self, config, version, cached_path, meta, force=False):
+    """Download a version into the cache, as described by its published metadata."""
+    remote_loc = self.remote_loc(config, version)
+    if meta["type"] == "file" and meta.get("parts"):
+      _download_parts_to_file(config.download_command, remote_loc, cached_path, meta["parts"],
+                              config.stream_mode, batch_command=config.batch_download_command,
+                              resume=self._resume(config))
+      log.info("downloaded published file in %s parts: %s", len(meta["parts"]), remote_loc)
+    elif meta["type"] == "file":
+      _download_file(config.download_command, remote_loc, cached_path,
+                     stream_mode=config.stream_mode, sha1=meta["sha1"], resume=self._resume(config))
+      log.info("downloaded published file: %s", remote_loc)
+    elif meta["type"] == "archive":
+      archiver = archives.ARCHIVERS.get(meta["archive_format"])
+      if not archiver:
+        raise AppError("Unsupported archive format: %s: %s" % (meta["archive_format"], remote_loc))
+      self._download_archive_as(config, version, cached_path, archiver, force=force, sha1=meta["sha1"],
+                                parts=meta.get("parts"), resume=self._resume(config))
+    elif meta["type"] == "manifest":
+      if not self._download_tree(config, version, cached_path, force=force, sha1=meta["sha1"]):
+        raise AppError("Published manifest is missing: %s" % remote_loc)
+    else:
+      raise AppError("Unsupported type of published item: %s: %s" % (meta["type"], remote_loc))
+
+  def _fetch(self, config, version, cached_path, force=False):
+    """
+    Download a version that isn't cached into the cache, and add it to the index.
+    Returns whether it is a "file" or "directory".
+    """
+    # Versions with metadata are listed in the item's index of versions. Those that aren't
+    # may still have it, if published at the same time as another, unless there's no index,
+    # as for items only published by older versions of instaclone.
+    versions = self._published_versions(config)
+    meta = None
+    if versions is not None:
+      meta = self._fetch_meta(config, version, known=version in versions["versions"])
+    if meta:
+      self._download_published(config, version, cached_path, meta, force=force)
+      kind = "file" if meta["type"] == "file" else "directory"
+    # Versions published without metadata have to be probed for.
+    # First try it as a directory/archive.
+    # This could be cleaner, but it's nice to be data-driven and not
+    # require a config saying it's a dir or file.
+    elif (config.storage_mode == configs.StorageMode.content and
+            self._download_tree(config, version, cached_path, force=force)) or \
+            self._download_archive(config, version, cached_path, force=force):
+      kind = "directory"
+    else:
+      log.debug("doesn't look like an archived directory: treating as file")
+      remote_loc = self.remote_loc(config, version)
+      _download_file(config.download_command, remote_loc, cached_path,
+                     stream_mode=config.stream_mode)
+      log.info("downloaded published file: %s", remote_loc)
+      kind = "file"
+
+    # Directories are already read-only, as they are extracted that way.
+    if not os.path.isdir(cached_path):
+      trees.make_readonly(cached_path)
+    self._add_to_index(config, version)
+    return kind
+
+  def _fetch_once(self, config, version, cached_path, lock, force=False):
+    """
+    Download a version that wasn't cached, taking its lock exclusively, so just one
+    process downloads it, and others wait for it and then use what it downloaded.
+    Returns what _fetch does, or None if another process downloaded it meanwhile.
+    """
+    with tracing.span("lock_wait"):
+      lock.acquire(shared=False)
+    if self._lookup(config, version):
+      log.info("downloaded by another process: %s", cached_path)
+      return None
+    # Anything left by an earlier download is left over from a process that failed.
+    entry_path = locks.make_dirs(os.path.dirname(cached_path))
+    for name in os.listdir(entry_path):
+      if ".partial." in name:
+        log.info("deleting partial download: %s", os.path.join(entry_path, name))
+        _rmtree_fast(os.path.join(entry_path, name), ignore_errors=True, trash_dir=self.trash_path)
+    with tracing.span("fetch") as span:
+      kind = self._fetch_shared(config, version, self.next_tier)
+      span.set(source="shared" if kind else "remote")
+      return kind or self._fetch(config, version, cached_path, force=force)
+
+  def _fetch_shared(self, config, version, tier):
+    """
+    Copy a version into this cache from tier, or the tiers after it, if one has it, or
+    else can download it. Returns what _fetch does, or None if no tier can provide it,
+    so it should be downloaded directly.
+    """
+    if tier is None:
+      return None
+    if not tier.writable:
+      if os.path.exists(tier.cache_path(config, version)):
+        return self._copy_version(tier, config, version)
+      return self._fetch_shared(config, version, tier.next_tier)
+    try:
+      with tier._locked_version(config, version):
+        tier.index.touch(tier._entry_key(config, version))
+        return self._copy_version(tier, config, version)
+    except (IOError, OSError, locks.LockError) as e:
+      log.warn("couldn't use shared cache, so downloading directly: %s: %s", tier.root_path, e)
+      return None
+
+  def _copy_version(self, source, config, version):
+    """
+    Add a version from another cache to this one. A tree stored as blobs is made from
+    this cache's blobs, adding those it lacks from the other cache's, so it still shares
+    them with other versions. Returns whether it is a "file" or "directory".
+    """
+    source_path = source.cache_path(config, version)
+    cached_path = self.cache_path(config, version)
+    log.info("copying from cache: %s -> %s", source_path, cached_path)
+    locks.make_dirs(os.path.dirname(cached_path))
+    source_manifest = source.cache_path(config, version, suffix=blobstore.MANIFEST_SUFFIX)
+    if os.path.isfile(source_manifest):
+      manifest = blobstore.read_manifest(source_manifest)
+      store = self.blob_store(config)
+      with self._store_lock(config, shared=True):
+        try:
+          store.add_from(source.blob_store(config), manifest)
+          store.download_missing(manifest)
+          blobstore.write_manifest(manifest, self.cache_path(config, version, suffix=blobstore.MANIFEST_SUFFIX))
+          with atomic_output_file(cached_path) as temp_dir:
+            make_all_dirs(temp_dir)
+            store.materialize(manifest, temp_dir, readonly=True)
+        finally:
+          store.flush()
+    else:
+      with atomic_output_file(cached_path) as temp_path:
+        _link_or_clone(source_path, temp_path)
+    self._add_to_index(config, version)
+    return "directory" if os.path.isdir(cached_path) else "file"
+
+  def _write_through(self, config, version):
+    """
+    Add a version just added to this cache to the first writable tier after it, unless
+    it has it, so other machines sharing that cache needn't download it.
+    """
+    tier = self.next_tier
+    while tier and not tier.writable:
+      tier = tier.next_tier
+    if not tier:
+      return
+    try:
+      tier.setup()
+      with tier._path_lock(tier._entry_key(config, version)):
+        if not tier._lookup(config, version):
+          tier._copy_version(self, config, version)
+    except (IOError, OSError, locks.LockError) as e:
+      log.warn("couldn't add to shared cache: %s: %s", tier.root_path, e)
+
+  @contextmanager
+  def _locked_version(self, config, version, force=False):
+    """
+    Hold the lock on a version, shared, so it isn't evicted meanwhile, downloading it
+    first if it isn't cached. Yields what _fetch returned, or None if it was cached.
+    """
+    self.setup()
+    with self._path_lock(self._entry_key(config, version), shared=True) as lock:
+      kind = None
+      if not self._lookup(config, version):
+        kind = self._fetch_once(config, version, self.cache_path(config, version), lock, force=force)
+      yield kind
+
   @log_calls
   def install(self, config, version, force=False):
-    self.setup()
+    tracing.annotate(item=config.name, version=version, method=config.install_method.name)
     cached_path = self.cache_path(config, version)
-    if os.path.exists(cached_path):
-      # It's a cached file or a cached directory and we've already unpacked it.
-      _install_from_cache(cached_path, config.local_path,
-                          config.install_method, force=force)
-      log.info("installed from cache (%s): %s -> %s",
-               config.install_method.name, config.local_path, cached_path)
-    else:
-      # First try it as a directory/archive.
-      remote_archive_loc = self.remote_loc(
-        config, version, suffix=ARCHIVER.suffix)
-      cached_archive_path = self.cache_path(
-        config, version, suffix=ARCHIVER.suffix)
-      is_dir = True
-      # This could be cleaner, but it's nice to be data-driven and not
-      # require a config saying it's a dir or file.
-      log.debug("checking for directory by seeing if archive suffix exists")
-      try:
-        _download_file(
-          config.download_command, remote_archive_loc, cached_archive_path)
-      except subprocess.CalledProcessError:
-        log.debug("doesn't look like an archived directory: treating as file")
-        is_dir = False
-      if is_dir:
-        log.info("downloaded published archive: %s", remote_archive_loc)
-        _decompress_dir(cached_archive_path, cached_path, force=force)
-        # If everything has succeeded, we can safely delete the
-        # archive to save space.
-        os.unlink(cached_archive_path)
-        log.info("installed directory: %s -> %s",
-                 config.local_path, cached_path)
+    with self._locked_version(config, version, force=force) as kind:
+      self._install_cached(config, version, cached_path, force=force)
+      if kind:
+        log.info("installed %s: %s -> %s", kind, config.local_path, cached_path)
       else:
-        remote_loc = self.remote_loc(config, version)
-        _download_file(config.download_command, remote_loc, cached_path)
-        log.info("downloaded published file: %s", remote_loc)
-        log.info("installed file: %s -> %s", config.local_path, cached_path)
+        # It's a cached file or a cached directory and we've already unpacked it.
+        log.info("installed from cache (%s): %s -> %s",
+                 config.install_method.name, config.local_path, cached_path)
+      self._record_use(config, version)
 
-      _make_readonly(cached_path)
-      _install_from_cache(cached_path, config.local_path,
-                          config.install_method, force=force)
+  @log_calls
+  def prefetch(self, config, version):
+    """
+    Download a version into the cache, unless it is already there, without installing
+    it, so a later install is a cache hit. Returns whether it was downloaded.
+    """
+    tracing.annotate(item=config.name, version=version)
+    cached_path = self.cache_path(config, version)
+    key = self._entry_key(config, version)
+    with self._locked_version(config, version) as kind:
+      if kind:
+        log.info("prefetched %s: %s", kind, cached_path)
+      else:
+        log.info("already cached: %s", cached_path)
+      # Count it as used, so it isn't evicted before it is installed.
+      self.index.touch(key)
+      # An incremental copy needs the version's file manifest, so make it now, too.
+      if config.install_method == configs.InstallMethod.fastcopy and os.path.isdir(cached_path):
+        self._files_manifest(config, key)
+    return kind is not None
+
+  def empty_trash(self):
+    """Delete anything moved to the trash, in the background."""
+    trees.empty_trash(self.trash_path, self.locks_path, background=True)
 
   @log_calls
   def purge(self):
     log.info("purging cache: %s", self.root_path)
-    _make_writable(self.root_path, silent=True)
-    _rmtree_fast(self.root_path)
+    _rmtree_fast(self.root_path, ignore_errors=True)
+
+
+_version_command_lock = threading.Lock()
+
 
+def _version_command_output(version_command):
+  """Run a version command, just once per run, since items often share one."""
+  # Items installed in parallel ask at once, so the first runs it while the others wait.
+  with _version_command_lock:
+    return _run_version_command(version_command)
 
-def version_for(config):
+
+@lru_cache(maxsize=None)
+def _run_version_command(version_command):
+  log.debug("version command: %s", version_command)
+  popenargs = shell_expand_to_popen(version_command, os.environ)
+  output = subprocess.check_output(
+    popenargs, stderr=SHELL_OUTPUT, stdin=DEV_NULL).strip()
+  if not configs._CONFIG_VERSION_RE.match(output):
+    raise configs.ConfigError(
+      "Invalid version output from version command: %r" % output)
+  return output
+
+
+def _revision_sha1(revision, path):
+  """SHA1 hash of a file as it is at a git revision, read with git show."""
+  popenargs = ["git", "show", "%s:./%s" % (revision, path)]
+  log.debug("computing sha1 of: %s", " ".join(popenargs))
+  process = subprocess.Popen(popenargs, stdin=DEV_NULL, stdout=subprocess.PIPE, stderr=SHELL_OUTPUT)
+  hashing_stream = streams.HashingReader(process.stdout)
+  streams.drain(hashing_stream)
+  if process.wait():
+    raise AppError("Couldn't read %s at git revision %s" % (path, revision))
+  return hashing_stream.hexdigest()
+
+
+def version_for(config, file_cache=None, revision=None):
   """
   The version for an item is either the explicit version specified by
-  the user, or the SHA1 hash of hashable file.
+  the user, or the SHA1 hash of hashable file. If file_cache is given,
+  it remembers hashes of unchanged files across runs. If revision is
+  given, the hashable file is read as it is at that git revision.
   """
+  with tracing.span("version", item=config.name):
+    return _version_for(config, file_cache=file_cache, revision=revision)
+
+
+def _version_for(config, file_cache=None, revision=None):
   bits = []
   if config.version_string:
     bits.append(str(config.version_string))
   if config.version_hashable:
-    log.debug("computing sha1 of: %s", config.version_hashable)
-    bits.append(file_sha1(config.version_hashable))
+    if revision:
+      bits.append(_revision_sha1(revision, config.version_hashable))
+    elif file_cache:
+      bits.append(file_cache.file_sha1(config.version_hashable))
+    else:
+      log.debug("computing sha1 of: %s", config.version_hashable)
+      bits.append(file_sha1(config.version_hashable))
   if config.version_command:
-    log.debug("version command: %s", config.version_command)
-    popenargs = shell_expand_to_popen(config.version_command, os.environ)
-    output = subprocess.check_output(
-      popenargs, stderr=SHELL_OUTPUT, stdin=DEV_NULL).strip()
-    if not configs._CONFIG_VERSION_RE.match(output):
-      raise configs.ConfigError(
-        "Invalid version output from version command: %r" % output)
-    bits.append(output)
+    bits.append(_version_command_output(config.version_command))
 
   return "-".join(bits)
 
@@ -418,7 +1733,7 @@ def version_for(config):
 #
 # ---- Command line ----
 
-Command = Enum("Command", "publish install purge configs remote")
+Command = Enum("Command", "publish install prefetch purge gc status configs remote")
 _command_list = [c.name for c in Command]
 
 
@@ -436,8 +1751,85 @@ def select_configs(config_list, items):
   return config_list
 
 
+def _install_all(file_cache, config_list, force=False, jobs=1):
+  """
+  Install all items. With more than one job, items are installed in parallel,
+  and failures are collected and reported together once all items are done.
+  """
+  if jobs <= 1 or len(config_list) <= 1:
+    for config in config_list:
+      file_cache.install(config, version_for(config, file_cache), force=force)
+    return
+
+  # Set up the cache once up front, rather than racing to do it in each task.
+  file_cache.setup()
+
+  def install_task(config):
+    return lambda: file_cache.install(config, version_for(config, file_cache), force=force)
+
+  log.info("installing %s items with %s jobs", len(config_list), jobs)
+  results = parallel.run_tasks([(config.name, install_task(config)) for config in config_list], jobs)
+  _check_results(results, "items", "install")
+
+
+def _check_results(results, noun, verb):
+  """Report the failures among task results, and raise if there are any."""
+  failures = [result for result in results if result.error]
+  for result in failures:
+    log.error("failed to %s %s: %s", verb, result.name, result.error)
+    log.debug("%s", result.traceback)
+  if failures:
+    raise AppError("%s of %s %s failed to %s: %s" %
+                   (len(failures), len(results), noun, verb, ", ".join(result.name for result in failures)))
+
+
+def _prefetch_all(file_cache, config_list, versions=None, revisions=None, jobs=1):
+  """
+  Download versions of all items into the cache, without installing them: the given
+  versions, or the versions at each of the given git revisions, or else the current
+  versions. Failures are reported together once all are done.
+  """
+  for version in versions or []:
+    if not configs._CONFIG_VERSION_RE.match(version):
+      raise configs.ConfigError("invalid version: '%s'" % version)
+  file_cache.setup()
+  targets = []
+  for config in config_list:
+    if versions:
+      item_versions = versions
+    elif revisions:
+      item_versions = [version_for(config, file_cache, revision=revision) for revision in revisions]
+    else:
+      item_versions = [version_for(config, file_cache)]
+    # Revisions often share a version.
+    for version in sorted(set(item_versions), key=item_versions.index):
+      targets.append(("%s@%s" % (config.name, version), config, version))
+
+  log.info("prefetching %s versions with %s jobs", len(targets), jobs)
+  results = parallel.run_tasks([(name, lambda config=config, version=version: file_cache.prefetch(config, version))
+                                for (name, config, version) in targets], jobs)
+  downloaded = len([result for result in results if result.value])
+  log.info("prefetched %s versions (%s already cached)", downloaded,
+           len([result for result in results if not result.error]) - downloaded)
+  _check_results(results, "versions", "prefetch")
+
+
+def run_in_background(args):
+  """
+  Run instaclone with the given arguments in a new session, which carries on after this
+  process exits, with output appended to a log file in the cache.
+  """
+  log_path = os.path.join(configs.set_up_cache_dir(), BACKGROUND_LOG)
+  popenargs = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")] + args
+  with open(log_path, "a") as log_file:
+    subprocess.Popen(popenargs, stdin=DEV_NULL, stdout=log_file, stderr=log_file, close_fds=True,
+                     preexec_fn=os.setsid)
+  log.info("running in the background, with output in: %s", log_path)
+
+
 def run_command(command, override_path=None, overrides=None,
-                force=False, items=None):
+                force=False, items=None, jobs=1, max_cache_size=None, list_versions=False,
+                versions=None, revisions=None):
   # Nondestructive commands that don't require cache.
   if command == Command.configs:
     config_list = select_configs(
@@ -450,30 +1842,53 @@ def run_command(command, override_path=None, overrides=None,
     file_cache = FileCache(configs.set_up_cache_dir())
     file_cache.purge()
 
+  elif command == Command.gc:
+    file_cache = FileCache(configs.set_up_cache_dir())
+    file_cache.gc(configs.max_cache_size(max_cache_size))
+
+  # Nondestructive commands that require cache but not configs.
+  elif command == Command.status:
+    file_cache = FileCache(configs.set_up_cache_dir())
+    file_cache.status()
+
   # Commands that require cache and configs.
   else:
     config_list = select_configs(
       configs.load(override_path=override_path, overrides=overrides),
       items)
 
-    file_cache = FileCache(configs.set_up_cache_dir())
+    file_cache = FileCache(configs.set_up_cache_dir(), shared_paths=configs.shared_cache_dirs())
 
     if command == Command.publish:
       for config in config_list:
-        file_cache.publish(config, version_for(config), force=force)
+        file_cache.publish(config, version_for(config, file_cache), force=force)
 
     elif command == Command.install:
-      for config in config_list:
-        file_cache.install(config, version_for(config), force=force)
+      _install_all(file_cache, config_list, force=force, jobs=jobs)
+
+    elif command == Command.prefetch:
+      _prefetch_all(file_cache, config_list, versions=versions, revisions=revisions, jobs=jobs)
 
     elif command == Command.remote:
       for config in config_list:
-        loc = file_cache.remote_loc(config, version_for(config))
-        print(loc)
+        if list_versions:
+          file_cache.print_versions(config)
+        else:
+          loc = file_cache.remote_loc(config, version_for(config, file_cache))
+          print(loc)
 
     else:
       raise AssertionError("unknown command: " + command)
 
+    # With a size limit, keep the cache within it as items are added.
+    limit = configs.max_cache_size(max_cache_size)
+    if limit is not None and command in (Command.publish, Command.install, Command.prefetch):
+      file_cache.gc(limit)
+
+  # Finish deleting anything replaced or evicted, without making the user wait.
+  if command in (Command.publish, Command.install, Command.prefetch, Command.gc):
+    file_cache.empty_trash()
+
 # TODO:
 # - "clean" command that deletes local resources (requiring -f if not in cache)
 # - "unpublish" command that deletes a remote resource (and purges from cache)
@@ -483,7 +1898,6 @@ def run_command(command, override_path=None, overrides=None,
 #   and a flag failover_publish indicating whether to publish
 # - command to unpublish all but most recent n versions of a resource?
 # - support compressing files as well as archives
-# - consider pax-based hardlink tree copy option (more cross platform than cp)
 # - init command to generate a config
 # - "--offline" mode for install (i.e. will fail if it has to download)
 # - test out more custom transport commands (s3cmd, awscli, wget, etc.)
@@ -0,0 +1,193 @@
+"""
+Locks on files in the cache, so processes sharing a cache (and threads within one) don't
+download, change, or delete the same version at once.
+
+Each lock is an flock on its own lock file. The kernel releases it when its holder exits,
+however it exits, so a lock file left behind never blocks anyone. A process that holds a
+lock exclusively records itself in the file, so if a lock is still held once the timeout
+passes, and the process that took it is gone (say the lock was inherited by a command that
+outlived it, or the filesystem didn't release it), the lock is broken, by replacing the file.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import errno
+import fcntl
+import logging as log
+import os
+import socket
+import time
+
+# Seconds to wait for a lock held by another process, such as one downloading the same version.
+LOCK_TIMEOUT = 3600
+
+# Seconds to wait before checking a lock again, doubling up to the maximum.
+POLL_SECONDS = 0.05
+POLL_MAX_SECONDS = 2.0
+
+
+class LockError(RuntimeError):
+  pass
+
+
+def _is_dead(pid):
+  try:
+    os.kill(pid, 0)
+  except OSError as e:
+    return e.errno == errno.ESRCH
+  return False
+
+
+class FileLock(object):
+  """
+  A lock on the file at path, exclusive or shared with other shared holders, which waits
+  up to timeout seconds for the lock to be released. As a context manager, it is taken,
+  then released at the end.
+  """
+
+  def __init__(self, path, shared=False, timeout=None):
+    self.path = path
+    self.shared = shared
+    self.timeout = LOCK_TIMEOUT if timeout is None else timeout
+    self.fd = None
+
+  def __str__(self):
+    return "FileLock@%s" % self.path
+
+  def _open(self):
+    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+    # Commands we run mustn't inherit the lock, or it would be held until they exit.
+    fcntl.fcntl(self.fd, fcntl.F_SETFD, fcntl.fcntl(self.fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+  def _close(self):
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+  @staticmethod
+  def _try_lock(fd, shared):
+    try:
+      fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+    except IOError as e:
+      if e.errno not in (errno.EAGAIN, errno.EACCES):
+        raise
+      return False
+    return True
+
+  def _is_current(self):
+    """Whether the open file is still the lock file, and wasn't replaced by breaking it."""
+    try:
+      st = os.stat(self.path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return False
+    fst = os.fstat(self.fd)
+    return (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino)
+
+  def _record_holder(self):
+    os.ftruncate(self.fd, 0)
+    os.lseek(self.fd, 0, os.SEEK_SET)
+    os.write(self.fd, "%s %s %s\n" % (socket.gethostname(), os.getpid(), int(time.time())))
+
+  def _holder(self):
+    """The host and pid that last took the lock exclusively, or None if unknown."""
+    os.lseek(self.fd, 0, os.SEEK_SET)
+    bits = os.read(self.fd, 1024).split()
+    return (bits[0], int(bits[1])) if len(bits) == 3 and bits[1].isdigit() else None
+
+  def _held_exclusively(self):
+    """Whether another holder has the lock exclusively, so the holder recorded is the one."""
+    fd = os.open(self.path, os.O_RDONLY)
+    try:
+      return not self._try_lock(fd, True)
+    finally:
+      os.close(fd)
+
+  def _break_if_stale(self):
+    """Break the lock if it is held by a process on this host that no longer exists."""
+    holder = self._holder()
+    if not holder or holder[0] != socket.gethostname() or not _is_dead(holder[1]):
+      return False
+    if not self._is_current() or not self._held_exclusively():
+      return False
+    log.warn("breaking stale lock held by process %s, which no longer exists: %s", holder[1], self.path)
+    try:
+      os.unlink(self.path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+    return True
+
+  def acquire(self, shared=None, wait=True):
+    """
+    Take the lock, shared or exclusive (by default, as set for this lock), waiting for
+    others to release it, unless wait is false. If the lock is already held, it is
+    converted, which releases it first, so what it protects may change in between.
+    Returns whether it was taken. Raises LockError if the timeout passes.
+    """
+    shared = self.shared if shared is None else shared
+    deadline = time.time() + self.timeout
+    delay = POLL_SECONDS
+    waiting = False
+    while True:
+      if self.fd is None:
+        self._open()
+      if self._try_lock(self.fd, shared):
+        if self._is_current():
+          if not shared:
+            self._record_holder()
+          return True
+        # The lock was broken and the file replaced, so lock the new one.
+        self._close()
+        continue
+      if not wait:
+        self._close()
+        return False
+      now = time.time()
+      if now >= deadline:
+        if not self._break_if_stale():
+          holder = self._holder()
+          raise LockError("Timed out after %ss waiting for lock%s: %s" %
+                          (self.timeout, " held by %s:%s" % holder if holder else "", self.path))
+        self._close()
+        deadline = now + self.timeout
+        continue
+      if not waiting:
+        log.info("waiting for lock: %s", self.path)
+        waiting = True
+      time.sleep(delay)
+      delay = min(delay * 2, POLL_MAX_SECONDS)
+
+  def release(self):
+    self._close()
+
+  def remove(self):
+    """Delete the lock file, while holding the lock exclusively, so it doesn't outlive what it locked."""
+    try:
+      os.unlink(self.path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def __enter__(self):
+    self.acquire()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.release()
+
+
+def make_dirs(path):
+  """
+  Create a directory and any parents it needs, unless it exists, even if other processes
+  are creating it at the same time.
+  """
+  try:
+    os.makedirs(path)
+  except OSError as e:
+    if e.errno != errno.EEXIST or not os.path.isdir(path):
+      raise
+  return path
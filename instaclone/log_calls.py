@@ -1,5 +1,5 @@
 """
-A simple utility to log calls to functions, for debugging.
+A simple utility to log calls to functions, for debugging, and to trace them.
 """
 
 __author__ = 'jlevy'
@@ -8,26 +8,45 @@ import functools
 import logging
 from logging import log
 
+import tracing
+
+_root_logger = logging.getLogger()
+
 
 def log_calls_with(severity):
-  """Create a decorator to log calls and return values of any function, for debugging."""
+  """
+  Create a decorator to log calls and return values of any function, for debugging, and
+  to time each call as a span, if tracing. If the severity isn't logged, and tracing is
+  off, the function is just called, with no arguments formatted.
+  """
 
   def decorator(fn):
     @functools.wraps(fn)
     def wrap(*params, **kwargs):
-      call_str = "%s(%s)" % (
-        fn.__name__, ", ".join([repr(p) for p in params] + ["%s=%s" % (k, repr(v)) for (k, v) in kwargs.items()]))
-      # TODO: Extract line number from caller and use that in logging.
-      log(severity, ">> %s", call_str)
-      ret = fn(*params, **kwargs)
-      # TODO: Add a way to make return short or omitted.
-      log(severity, "<< %s: %s", call_str, repr(ret))
-      return ret
+      logged = _root_logger.isEnabledFor(severity)
+      if not logged and not tracing.enabled():
+        return fn(*params, **kwargs)
+      with tracing.span(fn.__name__):
+        if not logged:
+          return fn(*params, **kwargs)
+        return _logged_call(severity, fn, params, kwargs)
 
     return wrap
 
   return decorator
 
+
+def _logged_call(severity, fn, params, kwargs):
+  call_str = "%s(%s)" % (
+    fn.__name__, ", ".join([repr(p) for p in params] + ["%s=%s" % (k, repr(v)) for (k, v) in kwargs.items()]))
+  # TODO: Extract line number from caller and use that in logging.
+  log(severity, ">> %s", call_str)
+  ret = fn(*params, **kwargs)
+  # TODO: Add a way to make return short or omitted.
+  log(severity, "<< %s: %s", call_str, repr(ret))
+  return ret
+
+
 # Convenience decorators for logging.
 log_calls_info = log_calls_with(logging.INFO)
 log_calls = log_calls_with(logging.DEBUG)
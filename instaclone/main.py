@@ -8,9 +8,13 @@ Settings may be overridden with corresponding command-line args.
 
 The install method determines how items are installed from cache:
 - symlink: Symlink to read-only cache (the default)
-- copy: A slow, full copy of the file or directory
-- fastcopy: A faster copy using rsync (preferred over copy)
-- hardlink: A hard link (files only)
+- copy: A full copy of the file or directory, with files copied in parallel
+- fastcopy: A copy that, when switching an installed copy to another version, only
+  changes the files that differ (preferred over copy)
+- hardlink: Hard links (for directories, a new directory tree with every file
+  hardlinked to the read-only cache, so no data is copied)
+- reflink: A copy that shares data blocks with the cache until modified, where the
+  filesystem supports it (such as btrfs or XFS), or else a plain copy
 
 For further documentation, see: https://github.com/vivlabs/instaclone
 """
@@ -47,6 +51,7 @@ def log_setup(level):
 def main():
   import instaclone
   import configs
+  import tracing
 
   config_docs = "Setting file keys:\n\n%s\n" % (
     "\n".join(["  %s: %s" % (k, v) for (k, v) in configs.CONFIG_DESCRIPTIONS.iteritems()]))
@@ -62,7 +67,29 @@ def main():
   parser.add_argument("--copy",
                       help="override: use install_method=fastcopy for all items",
                       action="store_true")
+  parser.add_argument("-j", "--jobs", help="number of items to install or prefetch in parallel (default 1)",
+                      type=int, default=1, metavar="N")
+  parser.add_argument("--list", help="with remote command, list all published versions of items",
+                      action="store_true")
+  parser.add_argument("--versions",
+                      help="with prefetch, comma-separated versions to download (default is the current version)",
+                      metavar="V1,V2")
+  parser.add_argument("--revisions",
+                      help="with prefetch, comma-separated git revisions to download the versions of, reading\n"
+                           "each item's version_hashable file as it is at each revision",
+                      metavar="R1,R2")
+  parser.add_argument("--background",
+                      help="with prefetch, run in the background, with output in the cache directory",
+                      action="store_true")
+  parser.add_argument("--max-cache-size",
+                      help="evict least recently used versions to keep the cache under this size, such as 10G\n"
+                           "(for gc, and after publish or install; default is $INSTACLONE_MAX_CACHE_SIZE)",
+                      metavar="SIZE")
   parser.add_argument("--debug", help="enable debugging output", action="store_true")
+  parser.add_argument("--trace",
+                      help="append the duration of each phase, such as hashing, downloading, and extracting,\n"
+                           "and the bytes it handled, to this file, as a line of JSON per phase",
+                      metavar="FILE")
 
   # XXX Unfortunately the setting "version" conflicts with argparse's --version.
   for (key, desc) in configs.CONFIG_DESCRIPTIONS.iteritems():
@@ -84,11 +111,26 @@ def main():
     overrides["install_method"] = "fastcopy"
 
   log_setup(log.DEBUG if args.debug else log.INFO)
+  if args.trace:
+    tracing.start(args.trace)
 
   log.debug("command-line overrides: %r", overrides)
 
-  instaclone.run_command(instaclone.Command[args.command], override_path=args.config, overrides=overrides,
-                         force=args.force, items=args.items)
+  if (args.versions or args.revisions or args.background) and args.command != "prefetch":
+    raise ValueError("--versions, --revisions, and --background are only for prefetch")
+  if args.versions and args.revisions:
+    raise ValueError("Specify just one of --versions and --revisions")
+
+  if args.background:
+    instaclone.run_in_background([arg for arg in sys.argv[1:] if arg != "--background"])
+    return
+
+  split = lambda value: [part.strip() for part in value.split(",") if part.strip()] if value else None
+  with tracing.span("command", command=args.command, items=args.items):
+    instaclone.run_command(instaclone.Command[args.command], override_path=args.config, overrides=overrides,
+                           force=args.force, items=args.items, jobs=args.jobs,
+                           max_cache_size=args.max_cache_size, list_versions=args.list,
+                           versions=split(args.versions), revisions=split(args.revisions))
 
 
 if __name__ == '__main__':
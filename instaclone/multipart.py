@@ -0,0 +1,253 @@
+"""
+Multipart transfers of large files. A file is split into fixed-size parts, each stored
+as its own remote object, next to where the whole file would go, so parts can be
+uploaded and downloaded concurrently with the usual transport commands, over
+several connections.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import hashlib
+import logging as log
+import os
+from multiprocessing.pool import ThreadPool
+
+from strif import file_sha1
+
+import parallel
+
+PART_SUFFIX = ".part%04d"
+
+# Number of parts to upload or download at once.
+MULTIPART_JOBS = 8
+
+BLOCK_SIZE = 2 ** 20
+
+# Python 2 can't interrupt a wait on a result without a timeout, so we use a long one.
+_WAIT_FOREVER = 2 ** 31
+
+
+class MultipartError(RuntimeError):
+  pass
+
+
+def part_loc(remote_loc, number):
+  return remote_loc + PART_SUFFIX % number
+
+
+def _copy_range(f_in, f_out, size):
+  digest = hashlib.sha1()
+  while size > 0:
+    data = f_in.read(min(size, BLOCK_SIZE))
+    if not data:
+      raise MultipartError("File ended before part was read: %s" % f_in.name)
+    digest.update(data)
+    f_out.write(data)
+    size -= len(data)
+  return digest.hexdigest()
+
+
+def _run(tasks, jobs):
+  results = parallel.run_tasks(tasks, jobs)
+  failures = [result for result in results if result.error]
+  for result in failures:
+    log.debug("failed to transfer part %s: %s", result.name, result.traceback)
+  if failures:
+    raise failures[0].error
+
+
+def upload_parts(path, remote_loc, part_size, upload, jobs=MULTIPART_JOBS, upload_batch=None, open_upload=None):
+  """
+  Upload a file in parts of part_size bytes. If open_upload is set, a function taking a
+  remote location and returning a context manager yielding a stream that uploads what is
+  written to it, each part is read straight from the file into its stream. Otherwise,
+  each part is written to a file beside the file, and uploaded with upload, a function
+  taking a local path and remote location, or if it is set, upload_batch, which takes a
+  list of such pairs and uploads all parts at once. Returns a list of the size and SHA1
+  hash of each part, which is needed to download them.
+  """
+  size = os.path.getsize(path)
+  offsets = range(0, size, part_size) or [0]
+  parts = [None] * len(offsets)
+
+  def copy_part(number, f_out):
+    offset = offsets[number]
+    part_length = min(part_size, size - offset)
+    with open(path, "rb") as f_in:
+      f_in.seek(offset)
+      sha1 = _copy_range(f_in, f_out, part_length)
+    parts[number] = {"size": part_length, "sha1": sha1}
+
+  def write_part(number):
+    with open(part_loc(path, number), "wb") as f_out:
+      copy_part(number, f_out)
+    return part_loc(path, number)
+
+  def stream_task(number):
+    def task():
+      with open_upload(part_loc(remote_loc, number)) as stream:
+        copy_part(number, stream)
+    return task
+
+  def upload_task(number):
+    def task():
+      try:
+        upload(write_part(number), part_loc(remote_loc, number))
+      finally:
+        _remove(part_loc(path, number))
+    return task
+
+  log.info("uploading in %s parts: %s", len(offsets), remote_loc)
+  numbers = range(len(offsets))
+  if open_upload:
+    _run([(part_loc(remote_loc, number), stream_task(number)) for number in numbers], jobs)
+  elif upload_batch:
+    try:
+      _run([(part_loc(remote_loc, number), lambda number=number: write_part(number)) for number in numbers], jobs)
+      upload_batch([(part_loc(path, number), part_loc(remote_loc, number)) for number in numbers])
+    finally:
+      for number in numbers:
+        _remove(part_loc(path, number))
+  else:
+    _run([(part_loc(remote_loc, number), upload_task(number)) for number in numbers], jobs)
+  return parts
+
+
+def _remove(path):
+  if os.path.exists(path):
+    os.unlink(path)
+
+
+def download_to_file(remote_loc, parts, path, open_part, jobs=MULTIPART_JOBS):
+  """
+  Download a file that was uploaded in parts into path, with parts downloaded concurrently
+  and each written at its offset, so no part is copied twice. open_part is a function
+  taking a part's remote location and returning a context manager yielding a stream of
+  it. Each part is checked against its size and hash, so the whole file is, too.
+  """
+  offsets = [0]
+  for part in parts[:-1]:
+    offsets.append(offsets[-1] + part["size"])
+  with open(path, "wb") as f:
+    f.truncate(offsets[-1] + parts[-1]["size"])
+
+  def task(number):
+    def write_part():
+      loc = part_loc(remote_loc, number)
+      with open_part(loc) as f_in, open(path, "r+b") as f_out:
+        f_out.seek(offsets[number])
+        sha1 = _copy_range(f_in, f_out, parts[number]["size"])
+        if f_in.read(1):
+          raise MultipartError("Part is larger than expected: %s" % loc)
+      if sha1 != parts[number]["sha1"]:
+        raise MultipartError("Part doesn't match its hash: %s" % loc)
+    return write_part
+
+  log.info("downloading in %s parts: %s", len(parts), remote_loc)
+  _run([(part_loc(remote_loc, number), task(number)) for number in range(len(parts))], jobs)
+
+
+class PartsReader(object):
+  """
+  A file object reading a file that was uploaded in parts, which are downloaded
+  concurrently, with download, a function taking a remote location and local path, into
+  parts_dir. Parts are read in order as soon as each is downloaded, so the file can be
+  consumed, say by extracting it, while later parts are still downloading. Only about
+  jobs parts are downloaded ahead of the reader, so a slow reader doesn't leave the
+  whole file on disk. If set, download_batch is used instead, to download each group
+  of jobs parts at once, given a list of (remote location, local path) pairs, with the
+  next group downloaded while the last is read. Each part is checked against its hash,
+  and deleted once read. A part left complete in parts_dir, say by an earlier run that
+  failed, isn't downloaded again.
+  """
+
+  def __init__(self, remote_loc, parts, download, parts_dir, jobs=MULTIPART_JOBS, download_batch=None):
+    self.remote_loc = remote_loc
+    self.parts = parts
+    self.download = download
+    self.parts_dir = parts_dir
+    self.jobs = max(1, min(jobs, len(parts)))
+    self.download_batch = download_batch
+    self.pool = ThreadPool(processes=self.jobs)
+    self.pending = [None] * len(parts)
+    self.number = 0
+    self.current = None
+    if download_batch:
+      self._submit_batch(0)
+    else:
+      for number in range(self.jobs):
+        self._submit(number)
+
+  def _part_path(self, number):
+    return os.path.join(self.parts_dir, os.path.basename(part_loc(self.remote_loc, number)))
+
+  def _submit(self, number):
+    if number < len(self.parts):
+      self.pending[number] = self.pool.apply_async(self._download_part, (number,))
+
+  def _submit_batch(self, start):
+    numbers = range(start, min(start + self.jobs, len(self.parts)))
+    if numbers:
+      batch = self.pool.apply_async(self._download_batch, (numbers,))
+      for number in numbers:
+        self.pending[number] = batch
+
+  def _matches(self, number):
+    path = self._part_path(number)
+    return (os.path.isfile(path) and os.path.getsize(path) == self.parts[number]["size"] and
+            file_sha1(path) == self.parts[number]["sha1"])
+
+  def _check_part(self, number):
+    if not self._matches(number):
+      raise MultipartError("Part doesn't match its size and hash: %s" % part_loc(self.remote_loc, number))
+
+  def _download_part(self, number):
+    if self._matches(number):
+      log.info("using part already downloaded: %s", self._part_path(number))
+      return
+    self.download(part_loc(self.remote_loc, number), self._part_path(number))
+    self._check_part(number)
+
+  def _download_batch(self, numbers):
+    missing = [number for number in numbers if not self._matches(number)]
+    if missing:
+      self.download_batch([(part_loc(self.remote_loc, number), self._part_path(number)) for number in missing])
+    for number in missing:
+      self._check_part(number)
+
+  def _start_part(self):
+    """Wait for the next part, and download another in its place."""
+    self.pending[self.number].get(_WAIT_FOREVER)
+    if not self.download_batch:
+      self._submit(self.number + self.jobs)
+    elif self.number % self.jobs == 0:
+      self._submit_batch(self.number + self.jobs)
+    self.current = open(self._part_path(self.number), "rb")
+
+  def read(self, size=-1):
+    while self.number < len(self.parts):
+      if self.current is None:
+        self._start_part()
+      data = self.current.read(size)
+      if data:
+        return data
+      self.current.close()
+      os.unlink(self.current.name)
+      self.current = None
+      self.number += 1
+    return ""
+
+  def close(self):
+    if self.current:
+      self.current.close()
+      self.current = None
+    self.pool.terminate()
+    self.pool.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
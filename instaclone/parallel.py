@@ -0,0 +1,164 @@
+"""
+Running independent tasks on a pool of worker threads.
+
+Logging and subprocess output from each task is buffered and emitted as one
+block when the task finishes, so output from different tasks is not interleaved.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import logging as log
+import sys
+import tempfile
+import threading
+import traceback
+from collections import namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+# The subprocess module has known threading issues, so prefer subprocess32.
+try:
+  import subprocess32 as subprocess
+except ImportError:
+  import subprocess
+
+from strif import DEV_NULL
+
+import tracing
+
+SHELL_OUTPUT = sys.stderr
+
+# Python 2 can't interrupt a wait on a result without a timeout, so we use a long one.
+_WAIT_FOREVER = 2 ** 31
+
+_local = threading.local()
+_output_lock = threading.Lock()
+
+TaskResult = namedtuple("TaskResult", "name value error traceback")
+
+
+class _ThreadBufferFilter(log.Filter):
+  """Divert log records from tasks into the per-thread buffer instead of emitting them."""
+
+  def filter(self, record):
+    buffer = getattr(_local, "buffer", None)
+    if buffer is None:
+      return True
+    buffer.append(record)
+    return False
+
+
+def _flush_buffer(records):
+  with _output_lock:
+    for record in records:
+      log.getLogger(record.name).handle(record)
+
+
+def check_call(popenargs, **kwargs):
+  """
+  Like subprocess.check_call, with stdout and stderr going to SHELL_OUTPUT by default.
+  Within a task, output is captured and logged with the task's other output.
+  """
+  kwargs.setdefault("stdin", DEV_NULL)
+  if getattr(_local, "buffer", None) is None:
+    kwargs.setdefault("stdout", SHELL_OUTPUT)
+    kwargs.setdefault("stderr", SHELL_OUTPUT)
+    return subprocess.check_call(popenargs, **kwargs)
+
+  kwargs.setdefault("stderr", subprocess.STDOUT)
+  try:
+    output = subprocess.check_output(popenargs, **kwargs)
+  except subprocess.CalledProcessError as e:
+    output = e.output
+    raise
+  finally:
+    for line in (output or "").splitlines():
+      log.info("%s", line)
+  return 0
+
+
+@contextmanager
+def captured_output():
+  """
+  Yield a file to use as stdout or stderr of a subprocess that is run some other way
+  than with check_call. Within a task, anything written to it is logged with the task's
+  other output once the context exits.
+  """
+  if getattr(_local, "buffer", None) is None:
+    yield SHELL_OUTPUT
+    return
+  with tempfile.TemporaryFile() as output:
+    try:
+      yield output
+    finally:
+      output.seek(0)
+      for line in output.read().splitlines():
+        log.info("%s", line)
+
+
+@contextmanager
+def held_output():
+  """
+  Hold back logging, and output of commands run with check_call or captured_output, on
+  this thread, as if within a task, and yield the list of log records held. They are
+  emitted when the context exits, except any the caller removes from the list, say
+  because a failure it expected makes them misleading.
+  """
+  outer = getattr(_local, "buffer", None)
+  records = _local.buffer = []
+  buffer_filter = _ThreadBufferFilter()
+  handlers = log.getLogger().handlers if outer is None else []
+  for handler in handlers:
+    handler.addFilter(buffer_filter)
+  try:
+    yield records
+  finally:
+    _local.buffer = outer
+    for handler in handlers:
+      handler.removeFilter(buffer_filter)
+    if outer is None:
+      _flush_buffer(records)
+    else:
+      outer.extend(records)
+
+
+def _run_task(name, fn, parent_span):
+  _local.buffer = []
+  try:
+    with tracing.within(parent_span):
+      value = fn()
+    return TaskResult(name, value, None, None)
+  except Exception as e:
+    return TaskResult(name, None, e, traceback.format_exc())
+  finally:
+    records = _local.buffer
+    _local.buffer = None
+    _flush_buffer(records)
+
+
+def run_tasks(tasks, jobs):
+  """
+  Run the given list of (name, fn) tasks on up to jobs threads. Never raises
+  for a task failure; instead returns a TaskResult for each task, in order.
+  """
+  buffer_filter = _ThreadBufferFilter()
+  handlers = log.getLogger().handlers
+  for handler in handlers:
+    handler.addFilter(buffer_filter)
+  pool = ThreadPool(processes=max(1, min(jobs, len(tasks))))
+  # Spans traced by tasks belong to the span that ran them.
+  parent_span = tracing.current()
+  try:
+    pending = [pool.apply_async(_run_task, (name, fn, parent_span)) for (name, fn) in tasks]
+    results = [result.get(_WAIT_FOREVER) for result in pending]
+    pool.close()
+    return results
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+    for handler in handlers:
+      handler.removeFilter(buffer_filter)
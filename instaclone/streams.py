@@ -0,0 +1,257 @@
+"""
+Streaming data to and from shell commands, so archives never need to be written to disk.
+
+A command template sees the stream as $LOCAL. In stdio mode, $LOCAL is "-" and the
+command reads its input from stdin or writes its output to stdout. In fifo mode, $LOCAL
+is a named pipe, which works with any command that reads or writes a file sequentially.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import errno
+import hashlib
+import logging as log
+import os
+import signal
+import sys
+import threading
+from contextlib import contextmanager
+
+# The subprocess module has known threading issues, so prefer subprocess32.
+try:
+  import subprocess32 as subprocess
+except ImportError:
+  import subprocess
+
+from strif import temp_output_dir, shell_expand_to_popen, dict_merge, DEV_NULL
+
+import configs
+import parallel
+
+STDIO_LOCAL = "-"
+
+BLOCK_SIZE = 2 ** 20
+
+EXIT_WAIT_SECONDS = 1.0
+
+
+@contextmanager
+def _fifo():
+  with temp_output_dir("instaclone-fifo.", always_clean=True) as temp_dir:
+    path = os.path.join(temp_dir, "stream")
+    os.mkfifo(path)
+    yield path
+
+
+@contextmanager
+def _noop_context(value):
+  yield value
+
+
+def _wait_and_unblock(process, fifo_path, reading, opened):
+  """
+  Wait for process to exit. If it exits without ever opening the fifo (say, because
+  the remote file doesn't exist), our own open() of the fifo would block forever, so
+  open and close the other end ourselves until ours has returned.
+  """
+  process.wait()
+  flags = (os.O_WRONLY if reading else os.O_RDONLY) | os.O_NONBLOCK
+  while not opened.is_set():
+    try:
+      os.close(os.open(fifo_path, flags))
+    except OSError as e:
+      # A non-blocking open for writing fails if our reader hasn't opened it yet.
+      if e.errno != errno.ENXIO:
+        raise
+    opened.wait(0.05)
+
+
+def _terminate(process):
+  try:
+    process.terminate()
+  except OSError as e:
+    # It may have exited already.
+    if e.errno != errno.ESRCH:
+      raise
+
+
+def _close_quietly(stream):
+  try:
+    stream.close()
+  except IOError:
+    pass
+
+
+def drain(stream):
+  """Read a stream to the end."""
+  while stream.read(BLOCK_SIZE):
+    pass
+
+
+@contextmanager
+def _command_stream(command_template, values, stream_mode, reading):
+  with parallel.captured_output() as output:
+    with (_fifo() if stream_mode == configs.StreamMode.fifo else _noop_context(STDIO_LOCAL)) as local:
+      popenargs = shell_expand_to_popen(command_template, dict_merge(os.environ, values, {"LOCAL": local}))
+      log.info("%s: %s", "streaming download" if reading else "streaming upload", " ".join(popenargs))
+      opened = threading.Event()
+      if stream_mode == configs.StreamMode.fifo:
+        process = subprocess.Popen(popenargs, stdin=DEV_NULL, stdout=output, stderr=output)
+        waiter = threading.Thread(target=_wait_and_unblock, args=(process, local, reading, opened))
+        waiter.daemon = True
+        waiter.start()
+        try:
+          stream = open(local, "rb" if reading else "wb")
+        finally:
+          opened.set()
+      elif reading:
+        process = subprocess.Popen(popenargs, stdin=DEV_NULL, stdout=subprocess.PIPE, stderr=output)
+        stream = process.stdout
+        waiter = threading.Thread(target=process.wait)
+        waiter.start()
+      else:
+        process = subprocess.Popen(popenargs, stdin=subprocess.PIPE, stdout=output, stderr=output)
+        stream = process.stdin
+        waiter = threading.Thread(target=process.wait)
+        waiter.start()
+
+      try:
+        yield stream
+        if reading:
+          # Consumers like tarfile may stop before the end of the data, and the
+          # command shouldn't see a broken pipe.
+          drain(stream)
+        stream.close()
+      except:
+        exc_info = sys.exc_info()
+        _close_quietly(stream)
+        # A failed command is the usual reason a stream ends early, so give it a
+        # moment to exit on its own before terminating it.
+        waiter.join(EXIT_WAIT_SECONDS)
+        terminated = waiter.is_alive()
+        if terminated:
+          _terminate(process)
+          waiter.join()
+        # If the command failed on its own, that is the more useful error.
+        if process.returncode and not terminated and process.returncode != -signal.SIGPIPE:
+          raise subprocess.CalledProcessError(process.returncode, popenargs)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+      waiter.join()
+      if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, popenargs)
+
+
+class HashingWriter(object):
+  """A file object that writes to another, keeping the SHA1 hash and size of all data."""
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.digest = hashlib.sha1()
+    self.size = 0
+
+  def write(self, data):
+    self.digest.update(data)
+    self.size += len(data)
+    self.stream.write(data)
+
+  def flush(self):
+    self.stream.flush()
+
+  def hexdigest(self):
+    return self.digest.hexdigest()
+
+
+class HashingReader(object):
+  """A file object that reads from another, keeping the SHA1 hash and size of all data."""
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.digest = hashlib.sha1()
+    self.size = 0
+
+  def read(self, size=-1):
+    data = self.stream.read(size)
+    self.digest.update(data)
+    self.size += len(data)
+    return data
+
+  def hexdigest(self):
+    return self.digest.hexdigest()
+
+
+class _TeeWriter(object):
+  """A file object that writes everything to several other file objects."""
+
+  def __init__(self, streams):
+    self.streams = streams
+
+  def write(self, data):
+    for stream in self.streams:
+      stream.write(data)
+
+  def flush(self):
+    for stream in self.streams:
+      stream.flush()
+
+
+@contextmanager
+def tee_to_consumer(stream, consumer):
+  """
+  Context manager yielding a file object that writes both to stream and to consumer,
+  which is called on another thread with a file object reading the same data.
+  Raises any error from consumer once everything is written.
+  """
+  read_fd, write_fd = os.pipe()
+  reader = os.fdopen(read_fd, "rb")
+  writer = os.fdopen(write_fd, "wb")
+  errors = []
+
+  def run_consumer():
+    try:
+      consumer(reader)
+      drain(reader)
+    except:
+      errors.append(sys.exc_info())
+    finally:
+      reader.close()
+
+  thread = threading.Thread(target=run_consumer)
+  thread.start()
+  try:
+    yield _TeeWriter([stream, writer])
+  except IOError as e:
+    _close_quietly(writer)
+    thread.join()
+    # A broken pipe here means the consumer failed, and its error is more useful.
+    if errors and e.errno == errno.EPIPE:
+      exc_info = errors[0]
+      raise exc_info[0], exc_info[1], exc_info[2]
+    raise
+  except:
+    _close_quietly(writer)
+    thread.join()
+    raise
+  writer.close()
+  thread.join()
+  if errors:
+    exc_info = errors[0]
+    raise exc_info[0], exc_info[1], exc_info[2]
+
+
+def command_output_stream(command_template, values, stream_mode):
+  """
+  Context manager that runs a command and yields a file object reading its output
+  as it arrives. Raises CalledProcessError if the command fails.
+  """
+  return _command_stream(command_template, values, stream_mode, reading=True)
+
+
+def command_input_stream(command_template, values, stream_mode):
+  """
+  Context manager that runs a command and yields a file object writing to its
+  input. Raises CalledProcessError if the command fails.
+  """
+  return _command_stream(command_template, values, stream_mode, reading=False)
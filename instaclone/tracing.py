@@ -0,0 +1,171 @@
+"""
+Tracing of where the time in a run goes. Phases such as hashing, downloading, extracting,
+and copying are timed as spans, which nest, and each span is written as it ends, as a line
+of JSON in the trace file, with its duration and, where known, the bytes it handled.
+
+Tracing is off unless a trace file is set, and then a span is a shared object that does
+nothing, so phases can be traced wherever it is useful, at no real cost.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_trace_file = None
+_write_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count(1)
+
+
+def start(path):
+  """Append a line for each span to the file at path, from now on."""
+  global _trace_file
+  _trace_file = open(path, "a")
+
+
+def enabled():
+  return _trace_file is not None
+
+
+def _stack():
+  stack = getattr(_local, "stack", None)
+  if stack is None:
+    stack = _local.stack = []
+  return stack
+
+
+def _write(record):
+  line = json.dumps(record, sort_keys=True, default=str) + "\n"
+  with _write_lock:
+    _trace_file.write(line)
+    # Flushed as it goes, so a trace is complete up to a failure, and lines from processes
+    # appending to the same file don't interleave.
+    _trace_file.flush()
+
+
+class Span(object):
+  """
+  A timed phase, with fields describing it, written when it ends. The bytes it handled
+  are counted with add_bytes, and more fields can be set as they are known.
+  """
+
+  def __init__(self, name, fields):
+    self.name = name
+    self.fields = fields
+    self.bytes = None
+    self.id = None
+    self.parent = None
+    self.start = None
+
+  def add_bytes(self, count):
+    self.bytes = (self.bytes or 0) + count
+
+  def add_file_size(self, path):
+    self.add_bytes(os.path.getsize(path))
+
+  def set(self, **fields):
+    self.fields.update(fields)
+
+  def __enter__(self):
+    stack = _stack()
+    self.id = next(_ids)
+    self.parent = stack[-1].id if stack else None
+    stack.append(self)
+    self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    seconds = time.time() - self.start
+    _stack().pop()
+    record = dict(self.fields)
+    record.update(span=self.name, id=self.id, parent=self.parent, pid=os.getpid(),
+                  thread=threading.current_thread().name,
+                  start=round(self.start, 6), seconds=round(seconds, 6))
+    if self.bytes is not None:
+      record["bytes"] = self.bytes
+    if exc_type:
+      record["error"] = exc_type.__name__
+    _write(record)
+    return False
+
+
+class _NullSpan(object):
+  """The span used when tracing is off, which does nothing."""
+
+  def add_bytes(self, count):
+    pass
+
+  def add_file_size(self, path):
+    pass
+
+  def set(self, **fields):
+    pass
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name, **fields):
+  """A context manager timing a phase, yielding the span, to count bytes or set fields on."""
+  if _trace_file is None:
+    return _NULL_SPAN
+  return Span(name, fields)
+
+
+def traced(name):
+  """Decorator timing each call of a function as a span with the given name."""
+
+  def decorator(fn):
+    @functools.wraps(fn)
+    def wrap(*params, **kwargs):
+      if _trace_file is None:
+        return fn(*params, **kwargs)
+      with Span(name, {}):
+        return fn(*params, **kwargs)
+
+    return wrap
+
+  return decorator
+
+
+def current():
+  """The innermost span running on this thread, or None."""
+  stack = getattr(_local, "stack", None)
+  return stack[-1] if stack else None
+
+
+def annotate(**fields):
+  """Set fields on the innermost span running on this thread, if any."""
+  if _trace_file is not None and current():
+    current().set(**fields)
+
+
+@contextmanager
+def within(parent):
+  """
+  Make spans started on this thread children of parent, a span from another thread, such
+  as the one that handed this thread its work.
+  """
+  if parent is None:
+    yield
+    return
+  stack = _stack()
+  stack.append(parent)
+  try:
+    yield
+  finally:
+    stack.pop()
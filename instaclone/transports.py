@@ -0,0 +1,313 @@
+"""
+Built-in transports, used instead of the upload and download commands when the remote
+prefix is a file:// or http(s):// URL, so transfers need no process per file.
+
+A file:// remote is a directory on a local or network filesystem, and files are copied
+within the kernel where possible. An http(s):// remote is a server that answers GET and
+PUT for each location; connections are kept alive and reused between requests.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import errno
+import httplib
+import logging as log
+import os
+import shutil
+import socket
+import threading
+import urllib
+import urlparse
+from contextlib import contextmanager
+from StringIO import StringIO
+
+from strif import atomic_output_file
+
+import locks
+import trees
+
+BLOCK_SIZE = 2 ** 20
+
+# Seconds to wait for an HTTP server to respond.
+HTTP_TIMEOUT = 60
+
+# Characters left as they are in the path of an HTTP location.
+_URL_SAFE = "/:@!$&'()*+,;=-._~%"
+
+
+class TransportError(IOError):
+  """A transfer failed."""
+  pass
+
+
+class NotFoundError(TransportError):
+  """The remote location doesn't exist."""
+  pass
+
+
+def _skip(stream, size):
+  """Read and discard size bytes of stream."""
+  while size > 0:
+    data = stream.read(min(size, BLOCK_SIZE))
+    if not data:
+      raise TransportError("Stream ended before offset: %s" % getattr(stream, "name", stream))
+    size -= len(data)
+
+
+class FileTransport(object):
+  """Transfers to and from a directory, named by file:// locations."""
+
+  @staticmethod
+  def _path(remote_loc):
+    parsed = urlparse.urlsplit(remote_loc)
+    if parsed.netloc not in ("", "localhost"):
+      raise TransportError("Only local file URLs are supported: %s" % remote_loc)
+    return urllib.url2pathname(parsed.path)
+
+  def _output_file(self, remote_loc):
+    # Parts of a file are uploaded concurrently, so their directory may be created by
+    # another thread at the same time.
+    path = self._path(remote_loc)
+    locks.make_dirs(os.path.dirname(path))
+    return atomic_output_file(path)
+
+  def upload(self, local_path, remote_loc):
+    log.info("uploading: %s -> %s", local_path, remote_loc)
+    with self._output_file(remote_loc) as temp_path:
+      trees.copy_file(local_path, temp_path)
+
+  def download(self, remote_loc, local_path, offset=0):
+    """
+    Download to local_path, which must not exist, or if offset is set, append what
+    follows offset to it.
+    """
+    if offset:
+      with self.open_read(remote_loc, offset=offset) as stream:
+        with open(local_path, "ab") as f:
+          shutil.copyfileobj(stream, f, BLOCK_SIZE)
+      return
+    log.info("downloading: %s -> %s", remote_loc, local_path)
+    try:
+      trees.copy_file(self._path(remote_loc), local_path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      raise NotFoundError("Not found: %s" % remote_loc)
+
+  @contextmanager
+  def open_read(self, remote_loc, offset=0):
+    """Yield a file object reading remote_loc, from offset."""
+    log.info("streaming download%s: %s", " from %s bytes" % offset if offset else "", remote_loc)
+    try:
+      stream = open(self._path(remote_loc), "rb")
+    except IOError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      raise NotFoundError("Not found: %s" % remote_loc)
+    with stream:
+      stream.seek(offset)
+      yield stream
+
+  @contextmanager
+  def open_write(self, remote_loc):
+    log.info("streaming upload: %s", remote_loc)
+    with self._output_file(remote_loc) as temp_path:
+      with open(temp_path, "wb") as stream:
+        yield stream
+
+
+class _ChunkedWriter(object):
+  """A file object writing to an HTTP request body with chunked transfer encoding."""
+
+  def __init__(self, connection):
+    self.connection = connection
+
+  def write(self, data):
+    if data:
+      self.connection.send("%x\r\n%s\r\n" % (len(data), data))
+
+  def flush(self):
+    pass
+
+  def close(self):
+    self.connection.send("0\r\n\r\n")
+
+
+class _ResponseReader(object):
+  """
+  A file object reading the body of an HTTP response, which fails if the connection
+  ends before the whole body is read. (Python 2's HTTPResponse returns the data so far.)
+  """
+
+  def __init__(self, response, remote_loc):
+    self.response = response
+    self.remote_loc = remote_loc
+    length = response.getheader("content-length")
+    self.remaining = int(length) if length and length.isdigit() else None
+
+  def read(self, size=-1):
+    data = self.response.read() if size < 0 else self.response.read(size)
+    if self.remaining is not None:
+      self.remaining -= len(data)
+      if (not data or size < 0) and self.remaining > 0:
+        raise TransportError("Connection ended with %s bytes left to read: %s" % (self.remaining, self.remote_loc))
+    return data
+
+
+class HttpTransport(object):
+  """
+  Transfers to and from an HTTP server, with GET and PUT. Idle connections are kept in
+  a pool, per host, so requests from any thread reuse them.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.idle = {}
+
+  def _checkout(self, parsed):
+    with self.lock:
+      connections = self.idle.get((parsed.scheme, parsed.netloc))
+      if connections:
+        return connections.pop()
+    return self._connect(parsed)
+
+  @staticmethod
+  def _connect(parsed):
+    if parsed.scheme == "https":
+      return httplib.HTTPSConnection(parsed.netloc, timeout=HTTP_TIMEOUT)
+    return httplib.HTTPConnection(parsed.netloc, timeout=HTTP_TIMEOUT)
+
+  def _checkin(self, parsed, connection):
+    with self.lock:
+      self.idle.setdefault((parsed.scheme, parsed.netloc), []).append(connection)
+
+  @staticmethod
+  def _target(parsed):
+    path = urllib.quote(parsed.path or "/", safe=_URL_SAFE)
+    return path + "?" + parsed.query if parsed.query else path
+
+  @staticmethod
+  def _check_status(remote_loc, response, method):
+    if response.status == httplib.NOT_FOUND:
+      raise NotFoundError("Not found: %s" % remote_loc)
+    if response.status // 100 != 2:
+      raise TransportError("HTTP %s failed with status %s %s: %s" %
+                           (method, response.status, response.reason, remote_loc))
+
+  @contextmanager
+  def _exchange(self, remote_loc, send):
+    """
+    Yield the response to a request made by send, a function taking a connection.
+    A kept-alive connection may have been closed by the server in the meantime, so
+    a request that fails to get any response is retried once, on a new connection.
+    The connection is reused only if the response is read to the end.
+    """
+    parsed = urlparse.urlsplit(remote_loc)
+    for retry in False, True:
+      connection = self._connect(parsed) if retry else self._checkout(parsed)
+      try:
+        send(connection, self._target(parsed))
+        response = connection.getresponse()
+        break
+      except (httplib.HTTPException, socket.error) as e:
+        connection.close()
+        if retry:
+          raise TransportError("HTTP request failed: %s: %s" % (remote_loc, e))
+        log.debug("retrying on a new connection: %s: %s", remote_loc, e)
+    try:
+      yield response
+    except:
+      connection.close()
+      raise
+    if response.isclosed():
+      self._checkin(parsed, connection)
+    else:
+      connection.close()
+
+  def _read_response(self, remote_loc, method, send):
+    with self._exchange(remote_loc, send) as response:
+      self._check_status(remote_loc, response, method)
+      response.read()
+
+  def upload(self, local_path, remote_loc):
+    log.info("uploading: %s -> %s", local_path, remote_loc)
+
+    def send(connection, target):
+      with open(local_path, "rb") as f:
+        connection.request("PUT", target, f, {"Content-Length": str(os.fstat(f.fileno()).st_size)})
+
+    self._read_response(remote_loc, "PUT", send)
+
+  def download(self, remote_loc, local_path, offset=0):
+    """
+    Download to local_path, which must not exist, or if offset is set, append what
+    follows offset to it.
+    """
+    log.info("downloading%s: %s -> %s", " from %s bytes" % offset if offset else "", remote_loc, local_path)
+    with self.open_read(remote_loc, offset=offset, quiet=True) as stream:
+      with open(local_path, "ab" if offset else "wb") as f:
+        shutil.copyfileobj(stream, f, BLOCK_SIZE)
+
+  @contextmanager
+  def open_read(self, remote_loc, offset=0, quiet=False):
+    """
+    Yield a file object reading remote_loc, from offset. A server that ignores the range
+    requested sends everything, and what precedes offset is skipped. If offset is at the
+    end, there is nothing to read.
+    """
+    if not quiet:
+      log.info("streaming download%s: %s", " from %s bytes" % offset if offset else "", remote_loc)
+    headers = {"Range": "bytes=%s-" % offset} if offset else {}
+    with self._exchange(remote_loc,
+                        lambda connection, target: connection.request("GET", target, headers=headers)) as response:
+      if offset and response.status == httplib.REQUESTED_RANGE_NOT_SATISFIABLE:
+        response.read()
+        yield StringIO()
+        return
+      self._check_status(remote_loc, response, "GET")
+      reader = _ResponseReader(response, remote_loc)
+      if offset and response.status != httplib.PARTIAL_CONTENT:
+        _skip(reader, offset)
+      yield reader
+
+  @contextmanager
+  def open_write(self, remote_loc):
+    """
+    Yield a file object writing the body of a PUT request, sent as it is written, in
+    chunks, since its length isn't known in advance.
+    """
+    log.info("streaming upload: %s", remote_loc)
+    parsed = urlparse.urlsplit(remote_loc)
+    connection = self._checkout(parsed)
+    try:
+      connection.putrequest("PUT", self._target(parsed))
+      connection.putheader("Transfer-Encoding", "chunked")
+      connection.endheaders()
+      writer = _ChunkedWriter(connection)
+      yield writer
+      writer.close()
+      response = connection.getresponse()
+      self._check_status(remote_loc, response, "PUT")
+      response.read()
+    except (httplib.HTTPException, socket.error) as e:
+      connection.close()
+      raise TransportError("HTTP request failed: %s: %s" % (remote_loc, e))
+    except:
+      connection.close()
+      raise
+    self._checkin(parsed, connection)
+
+
+_TRANSPORTS = {
+  "file": FileTransport(),
+  "http": HttpTransport(),
+  "https": HttpTransport(),
+}
+
+
+def for_location(remote_loc):
+  """The built-in transport for a remote location or prefix, or None if it has none."""
+  scheme = remote_loc.split("://", 1)[0].lower() if "://" in remote_loc else None
+  return _TRANSPORTS.get(scheme)
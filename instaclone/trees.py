@@ -0,0 +1,642 @@
+"""
+Fast operations on large directory trees, done natively, with directories processed in
+parallel, since most of the time goes to filesystem calls, which release the GIL.
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import ctypes
+import errno
+import itertools
+import logging as log
+import os
+import shutil
+import stat
+import sys
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+# The subprocess module has known threading issues, so prefer subprocess32.
+try:
+  import subprocess32 as subprocess
+except ImportError:
+  import subprocess
+
+from strif import file_sha1
+
+import locks
+import tracing
+
+# Number of directories to process at once.
+WALK_THREADS = 8
+
+FILES_FORMAT = 1
+
+BLOCK_SIZE = 2 ** 20
+
+# Lock file, in the cache's locks directory, held by the process emptying the trash.
+TRASH_LOCK = "trash.lock"
+
+# The Linux ioctl to clone a file, sharing its data blocks copy-on-write (btrfs, XFS).
+FICLONE = 0x40049409
+
+# Errors meaning a filesystem or kernel can't clone a file, or copy it within the kernel.
+_UNSUPPORTED_ERRNOS = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                       errno.EBADF)
+
+_IS_LINUX = sys.platform.startswith("linux")
+
+
+def _libc_function(name, restype, argtypes):
+  """A function from libc, or None if it isn't available."""
+  try:
+    function = getattr(ctypes.CDLL(None, use_errno=True), name)
+  except (OSError, AttributeError):
+    return None
+  function.restype = restype
+  function.argtypes = argtypes
+  return function
+
+
+_copy_file_range = None
+_sendfile = None
+
+if _IS_LINUX:
+  import fcntl
+
+  # Python 2 has no os.copy_file_range or os.sendfile, so call them from libc, if it's
+  # recent enough. Both copy data within the kernel, and sendfile works on older kernels.
+  _offset_p = ctypes.POINTER(ctypes.c_longlong)
+  _copy_file_range = _libc_function("copy_file_range", ctypes.c_ssize_t,
+                                    [ctypes.c_int, _offset_p, ctypes.c_int, _offset_p,
+                                     ctypes.c_size_t, ctypes.c_uint])
+  _sendfile = _libc_function("sendfile", ctypes.c_ssize_t,
+                             [ctypes.c_int, ctypes.c_int, _offset_p, ctypes.c_size_t])
+
+
+class TreeError(RuntimeError):
+  pass
+
+
+def _walk_parallel(source_dir, target_dir, visit, threads=WALK_THREADS):
+  """
+  Walk source_dir breadth first, calling visit(source_subdir, target_subdir) for each
+  directory in parallel. Visit handles the entries of a directory and returns the list
+  of (source, target) pairs of its subdirectories, which are visited next.
+  """
+  pool = ThreadPool(processes=threads)
+  try:
+    level = [(source_dir, target_dir)]
+    while level:
+      level = [pair for pairs in pool.map(lambda pair: visit(*pair), level) for pair in pairs]
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+
+
+def _run_parallel(function, items, threads=WALK_THREADS):
+  pool = ThreadPool(processes=threads)
+  try:
+    results = pool.map(function, items, chunksize=64)
+    pool.close()
+  except:
+    pool.terminate()
+    raise
+  finally:
+    pool.join()
+  return results
+
+
+def _link_or_copy(source, target):
+  try:
+    os.link(source, target)
+  except OSError as e:
+    if e.errno == errno.EXDEV:
+      raise TreeError("Can't hardlink across filesystems: %r -> %r" % (source, target))
+    # A file linked very many times may exceed the filesystem's limit on links.
+    if e.errno != errno.EMLINK:
+      raise
+    shutil.copy2(source, target)
+
+
+@tracing.traced("link")
+def link_tree(source_dir, target_dir, threads=WALK_THREADS):
+  """
+  Recreate the directories of source_dir at target_dir, which must not exist, with
+  every file hardlinked to the file in source_dir, and symlinks copied. So no file data
+  is copied. Directories are made writable by the owner, so files can be added or
+  removed, but the files themselves are shared and keep their modes.
+  """
+  # Counters are updated from several threads, which is safe for itertools.count.
+  dirs = itertools.count()
+  files = itertools.count()
+
+  def visit(source, target):
+    subdirs = []
+    os.mkdir(target)
+    for name in os.listdir(source):
+      source_path = os.path.join(source, name)
+      target_path = os.path.join(target, name)
+      st = os.lstat(source_path)
+      if stat.S_ISDIR(st.st_mode):
+        subdirs.append((source_path, target_path))
+      elif stat.S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(source_path), target_path)
+      else:
+        _link_or_copy(source_path, target_path)
+        files.next()
+    # Keep the original mode, but writable, so files can be added or removed.
+    os.chmod(target, stat.S_IMODE(os.stat(source).st_mode) | stat.S_IWUSR)
+    dirs.next()
+    return subdirs
+
+  _walk_parallel(source_dir, target_dir, visit, threads=threads)
+  log.info("hardlinked %s files in %s directories: %s -> %s",
+           files.next(), dirs.next(), source_dir, target_dir)
+
+
+def _clone(source_fd, target_fd):
+  fcntl.ioctl(target_fd, FICLONE, source_fd)
+
+
+def _check_result(result):
+  if result < 0:
+    err = ctypes.get_errno()
+    raise OSError(err, os.strerror(err))
+  return result
+
+
+def _copy_in_kernel(source_fd, target_fd):
+  while _check_result(_copy_file_range(source_fd, None, target_fd, None, BLOCK_SIZE * 64, 0)):
+    pass
+
+
+def _sendfile_all(source_fd, target_fd):
+  while _check_result(_sendfile(target_fd, source_fd, None, BLOCK_SIZE * 64)):
+    pass
+
+
+def _copy(source_fd, target_fd):
+  with os.fdopen(os.dup(source_fd), "rb") as f_in, os.fdopen(os.dup(target_fd), "wb") as f_out:
+    shutil.copyfileobj(f_in, f_out, BLOCK_SIZE)
+
+
+class _FileCopier(object):
+  """
+  Copy files by the fastest means the filesystem supports: cloning, which shares data
+  blocks copy-on-write (if clone is set), then copying within the kernel, then a plain
+  copy. Once a way fails as unsupported, it isn't tried again between the same source
+  and target filesystems, since a tree may span several, say with bind mounts. Counts
+  how many files each way copied.
+  """
+
+  def __init__(self, clone=False):
+    self.methods = OrderedDict()
+    if clone and _IS_LINUX:
+      self.methods["cloned"] = _clone
+    if _copy_file_range:
+      self.methods["copied in kernel"] = _copy_in_kernel
+    if _sendfile:
+      self.methods["sent in kernel"] = _sendfile_all
+    self.methods["copied"] = _copy
+    self.counts = OrderedDict((name, itertools.count()) for name in self.methods)
+    # (way, source device, target device) for each way that failed as unsupported.
+    self.unsupported = set()
+
+  def copy(self, source_path, target_path, st):
+    source_fd = os.open(source_path, os.O_RDONLY)
+    try:
+      # Copies are writable by the owner, but otherwise have the original's mode.
+      target_fd = os.open(target_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+      try:
+        devices = (st.st_dev, os.fstat(target_fd).st_dev)
+        for (name, method) in self.methods.iteritems():
+          if (name,) + devices in self.unsupported:
+            continue
+          try:
+            method(source_fd, target_fd)
+          except (IOError, OSError) as e:
+            if e.errno not in _UNSUPPORTED_ERRNOS or name == "copied":
+              raise
+            log.debug("can't use %s: %s", method.__name__, e)
+            self.unsupported.add((name,) + devices)
+            # Start over, in case anything was written.
+            os.ftruncate(target_fd, 0)
+            os.lseek(target_fd, 0, os.SEEK_SET)
+            os.lseek(source_fd, 0, os.SEEK_SET)
+            continue
+          self.counts[name].next()
+          break
+        os.fchmod(target_fd, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+      finally:
+        os.close(target_fd)
+    finally:
+      os.close(source_fd)
+    os.utime(target_path, (st.st_atime, st.st_mtime))
+
+  def summary(self):
+    counts = [(name, count.next()) for (name, count) in self.counts.iteritems()]
+    return ", ".join("%s %s" % (count, name) for (name, count) in counts if count)
+
+
+def copy_tree(source, target, threads=WALK_THREADS, clone=False):
+  """
+  Copy a file or directory to target, which must not exist, preserving modes, mtimes,
+  and symlinks, except that everything is made writable by the owner. Directories and
+  symlinks are created first, then files are copied in parallel, within the kernel where
+  possible. If clone is set, files are cloned where the filesystem supports it (as on
+  btrfs or XFS), so data blocks are shared until they are modified.
+  """
+  copier = _FileCopier(clone=clone)
+  span = tracing.span("clone" if clone else "copy")
+  if not os.path.isdir(source):
+    with span:
+      st = os.stat(source)
+      copier.copy(source, target, st)
+      span.add_bytes(st.st_size)
+  else:
+    # Lists are appended to from several threads, which is safe.
+    dirs = []
+    files = []
+
+    def visit(source_dir, target_dir):
+      subdirs = []
+      st = os.stat(source_dir)
+      os.mkdir(target_dir, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+      dirs.append((target_dir, st))
+      for name in os.listdir(source_dir):
+        source_path = os.path.join(source_dir, name)
+        target_path = os.path.join(target_dir, name)
+        st = os.lstat(source_path)
+        if stat.S_ISDIR(st.st_mode):
+          subdirs.append((source_path, target_path))
+        elif stat.S_ISLNK(st.st_mode):
+          os.symlink(os.readlink(source_path), target_path)
+        elif stat.S_ISREG(st.st_mode):
+          files.append((source_path, target_path, st))
+        else:
+          _make_special(target_path, st)
+      return subdirs
+
+    with span:
+      _walk_parallel(source, target, visit, threads=threads)
+      _run_parallel(lambda args: copier.copy(*args), files, threads=threads)
+      # The mkdir mode is subject to the umask, and mtimes change as files are added.
+      for (target_dir, st) in dirs:
+        os.chmod(target_dir, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+        os.utime(target_dir, (st.st_atime, st.st_mtime))
+      span.add_bytes(sum(st.st_size for (_, _, st) in files))
+  log.info("copied files (%s): %s -> %s", copier.summary() or "none", source, target)
+
+
+def clone_tree(source, target, threads=WALK_THREADS):
+  """Copy a file or directory as with copy_tree, cloning files where possible."""
+  copy_tree(source, target, threads=threads, clone=True)
+
+
+# Shared, so each way of copying that turns out to be unsupported is only tried once.
+_single_file_copier = _FileCopier()
+_single_file_cloner = _FileCopier(clone=True)
+
+
+def copy_file(source_path, target_path):
+  """
+  Copy one file to target_path, which must not exist, within the kernel where possible,
+  preserving its mode (made writable by the owner) and mtime.
+  """
+  _single_file_copier.copy(source_path, target_path, os.stat(source_path))
+
+
+def clone_file(source_path, target_path):
+  """Copy one file as with copy_file, cloning it where the filesystem supports it."""
+  _single_file_cloner.copy(source_path, target_path, os.stat(source_path))
+
+
+def _lstat_tree(root, threads=WALK_THREADS):
+  """A dict from each path under root, relative to root, to its lstat result."""
+  # Dicts are updated from several threads, which is safe.
+  stats = {}
+
+  def visit(dir_path, rel_dir):
+    subdirs = []
+    for name in os.listdir(dir_path):
+      path = os.path.join(dir_path, name)
+      rel_path = os.path.join(rel_dir, name) if rel_dir else name
+      st = os.lstat(path)
+      stats[rel_path] = st
+      if stat.S_ISDIR(st.st_mode):
+        subdirs.append((path, rel_path))
+    return subdirs
+
+  _walk_parallel(root, "", visit, threads=threads)
+  return stats
+
+
+def _make_special(target_path, st):
+  """
+  Recreate a FIFO, which can't be copied, since opening it would block. Sockets and
+  devices are skipped, as they can't be recreated.
+  """
+  if stat.S_ISFIFO(st.st_mode):
+    os.mkfifo(target_path)
+    os.chmod(target_path, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+    os.utime(target_path, (st.st_atime, st.st_mtime))
+  else:
+    log.warning("skipping special file, which can't be copied: %s", target_path)
+
+
+def _entry_type(st):
+  if stat.S_ISDIR(st.st_mode):
+    return "dir"
+  elif stat.S_ISLNK(st.st_mode):
+    return "link"
+  elif stat.S_ISREG(st.st_mode):
+    return "file"
+  return "special"
+
+
+def hash_files(paths, threads=WALK_THREADS):
+  """The SHA1 hash of each of the given files, computed in parallel."""
+  return _run_parallel(file_sha1, paths, threads=threads)
+
+
+def scan_files(root, known_hashes=None, threads=WALK_THREADS):
+  """
+  A file manifest of a directory, listing every path in it, with its type, mode, size,
+  and mtime, as well as the SHA1 hash of files and the target of symlinks. Files are
+  hashed in parallel, except those whose hash is in the known_hashes dict.
+  """
+  known_hashes = known_hashes or {}
+  entries = []
+  for (rel_path, st) in sorted(_lstat_tree(root, threads=threads).iteritems()):
+    entry = {"path": rel_path, "type": _entry_type(st), "mode": stat.S_IMODE(st.st_mode),
+             "size": st.st_size, "mtime": st.st_mtime}
+    if entry["type"] == "link":
+      entry["target"] = os.readlink(os.path.join(root, rel_path))
+    entries.append(entry)
+
+  def hash_entry(entry):
+    if entry["type"] == "file":
+      entry["hash"] = known_hashes.get(entry["path"]) or file_sha1(os.path.join(root, entry["path"]))
+
+  _run_parallel(hash_entry, entries, threads=threads)
+  log.info("scanned %s items: %s", len(entries), root)
+  return {"format": FILES_FORMAT, "entries": entries}
+
+
+def tree_matches(manifest, root, threads=WALK_THREADS):
+  """
+  Whether a directory still has exactly the paths in a file manifest, with the same
+  types, and the same sizes and mtimes (to the second) for files, and targets for
+  symlinks. Only file metadata is checked, so this is much cheaper than hashing.
+  """
+  stats = _lstat_tree(root, threads=threads)
+  if len(stats) != len(manifest["entries"]):
+    return False
+  for entry in manifest["entries"]:
+    st = stats.get(entry["path"])
+    if st is None or _entry_type(st) != entry["type"]:
+      return False
+    if entry["type"] == "file" and (st.st_size != entry["size"] or int(st.st_mtime) != int(entry["mtime"])):
+      return False
+    if entry["type"] == "link" and os.readlink(os.path.join(root, entry["path"])) != entry["target"]:
+      return False
+  return True
+
+
+@tracing.traced("update")
+def update_tree(old_manifest, new_manifest, source_dir, target_dir, threads=WALK_THREADS):
+  """
+  Change a copy of the directory described by old_manifest into a copy of source_dir,
+  which is described by new_manifest, by deleting, adding, and replacing only the paths
+  that differ. Files and directories are made writable by the owner, as with copy_tree.
+  """
+  old_entries = dict((entry["path"], entry) for entry in old_manifest["entries"])
+  new_entries = dict((entry["path"], entry) for entry in new_manifest["entries"])
+
+  def changed(entry, keys):
+    old_entry = old_entries.get(entry["path"])
+    return old_entry is None or any(old_entry.get(key) != entry.get(key) for key in keys)
+
+  removed = [path for (path, entry) in old_entries.iteritems()
+             if path not in new_entries or new_entries[path]["type"] != entry["type"]]
+  added = [entry for (path, entry) in sorted(new_entries.iteritems())
+           if path not in old_entries or old_entries[path]["type"] != entry["type"]]
+  added_paths = set(entry["path"] for entry in added)
+  kept = [entry for entry in new_manifest["entries"] if entry["path"] not in added_paths]
+  replaced = [entry for entry in kept if
+              (entry["type"] == "file" and changed(entry, ["hash"])) or
+              (entry["type"] == "link" and changed(entry, ["target"]))]
+  retouched = [entry for entry in kept if entry["type"] == "file" and not changed(entry, ["hash"]) and
+               changed(entry, ["mode", "mtime"])]
+
+  # Parents before children, so subtrees go in one call, and paths within them are already gone.
+  for path in sorted(removed):
+    remove_tree(os.path.join(target_dir, path))
+  for entry in replaced:
+    _remove_missing_ok(os.unlink, os.path.join(target_dir, entry["path"]))
+
+  copier = _FileCopier()
+  files = []
+  dirs = []
+  for entry in added + replaced:
+    source_path = os.path.join(source_dir, entry["path"])
+    target_path = os.path.join(target_dir, entry["path"])
+    if entry["type"] == "dir":
+      os.mkdir(target_path, 0700)
+      dirs.append(entry)
+    elif entry["type"] == "link":
+      os.symlink(entry["target"], target_path)
+    elif entry["type"] == "file":
+      files.append((source_path, target_path, os.stat(source_path)))
+    else:
+      _make_special(target_path, os.lstat(source_path))
+  _run_parallel(lambda args: copier.copy(*args), files, threads=threads)
+  for entry in retouched:
+    target_path = os.path.join(target_dir, entry["path"])
+    os.chmod(target_path, entry["mode"] | stat.S_IWUSR)
+    os.utime(target_path, (entry["mtime"], entry["mtime"]))
+
+  # Directories that are new, or whose mode or contents changed, get the source's mode and mtime.
+  touched = set(os.path.dirname(path) for path in removed)
+  touched.update(os.path.dirname(entry["path"]) for entry in added + replaced)
+  dirs.extend(entry for entry in kept if entry["type"] == "dir" and
+              (entry["path"] in touched or changed(entry, ["mode", "mtime"])))
+  dirs.sort(key=lambda entry: entry["path"], reverse=True)
+  if "" in touched:
+    dirs.append({"path": ""})
+  for entry in dirs:
+    st = os.stat(os.path.join(source_dir, entry["path"]))
+    target_path = os.path.join(target_dir, entry["path"])
+    os.chmod(target_path, stat.S_IMODE(st.st_mode) | stat.S_IWUSR)
+    os.utime(target_path, (st.st_atime, st.st_mtime))
+
+  log.info("updated %s: %s added, %s replaced, %s deleted, %s unchanged (%s)", target_dir,
+           len(added), len(replaced), len(removed), len(kept) - len(replaced),
+           copier.summary() or "no files copied")
+
+
+def remove_tree(path, threads=WALK_THREADS):
+  """
+  Delete a file or directory, with directories processed in parallel. Read-only
+  directories are made writable as needed. Entries that disappear meanwhile, say
+  because another process is deleting the same tree, are ignored.
+  """
+  if not os.path.isdir(path) or os.path.islink(path):
+    _remove_missing_ok(os.unlink, path)
+    return
+  # Directories in the order visited, so parents come before their subdirectories.
+  dirs = []
+  files = itertools.count()
+
+  def visit(dir_path, _):
+    try:
+      mode = os.lstat(dir_path).st_mode
+      if not mode & stat.S_IWUSR:
+        os.chmod(dir_path, stat.S_IMODE(mode) | stat.S_IWUSR | stat.S_IXUSR)
+      names = os.listdir(dir_path)
+    except OSError as e:
+      if e.errno != errno.ENOENT:
+        raise
+      return []
+    dirs.append(dir_path)
+    subdirs = []
+    for name in names:
+      entry_path = os.path.join(dir_path, name)
+      try:
+        is_dir = stat.S_ISDIR(os.lstat(entry_path).st_mode)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+        continue
+      if is_dir:
+        subdirs.append((entry_path, None))
+      else:
+        _remove_missing_ok(os.unlink, entry_path)
+        files.next()
+    return subdirs
+
+  _walk_parallel(path, None, visit, threads=threads)
+  for dir_path in reversed(dirs):
+    _remove_missing_ok(os.rmdir, dir_path)
+  log.debug("deleted %s files in %s directories: %s", files.next(), len(dirs), path)
+
+
+@tracing.traced("chmod")
+def make_readonly(path, threads=WALK_THREADS):
+  """
+  Remove write permission from a file, or a directory and everything in it, with
+  directories processed in parallel. Directories are changed last, so the walk can't
+  be blocked by a directory it has just made read-only.
+  """
+  write_bits = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+  dirs = []
+
+  def remove_write(entry_path, st):
+    if st.st_mode & write_bits:
+      os.chmod(entry_path, stat.S_IMODE(st.st_mode) & ~write_bits)
+
+  def visit(dir_path, _):
+    dirs.append(dir_path)
+    subdirs = []
+    for name in os.listdir(dir_path):
+      entry_path = os.path.join(dir_path, name)
+      st = os.lstat(entry_path)
+      if stat.S_ISDIR(st.st_mode):
+        subdirs.append((entry_path, None))
+      elif not stat.S_ISLNK(st.st_mode):
+        remove_write(entry_path, st)
+    return subdirs
+
+  if os.path.isdir(path) and not os.path.islink(path):
+    _walk_parallel(path, None, visit, threads=threads)
+    for dir_path in reversed(dirs):
+      remove_write(dir_path, os.lstat(dir_path))
+  else:
+    remove_write(path, os.stat(path))
+
+
+def _remove_missing_ok(remove, path):
+  try:
+    remove(path)
+  except OSError as e:
+    if e.errno != errno.ENOENT:
+      raise
+
+
+def move_to_trash(path, trash_dir):
+  """
+  Atomically move a file or directory into trash_dir, to be deleted later by
+  empty_trash. Returns False, leaving the path in place, if it can't be moved, say
+  because trash_dir is on another filesystem.
+  """
+  try:
+    os.makedirs(trash_dir)
+  except OSError as e:
+    if e.errno != errno.EEXIST:
+      raise
+  # A unique name, so items never collide.
+  trash_path = os.path.join(trash_dir, "%s.%s" % (os.path.basename(path), os.urandom(8).encode("hex")))
+  try:
+    # Moving a directory to a new parent updates its "..", so it must be writable.
+    if os.path.isdir(path) and not os.path.islink(path):
+      mode = os.lstat(path).st_mode
+      if not mode & stat.S_IWUSR:
+        os.chmod(path, stat.S_IMODE(mode) | stat.S_IWUSR)
+    os.rename(path, trash_path)
+  except OSError as e:
+    if e.errno not in (errno.EXDEV, errno.EACCES, errno.EPERM):
+      raise
+    log.debug("can't move to trash, so deleting now: %s: %s", path, e)
+    return False
+  log.debug("moved to trash: %s -> %s", path, trash_path)
+  return True
+
+
+def empty_trash(trash_dir, locks_dir, background=False):
+  """
+  Delete everything in trash_dir. In the background, this is done by a separate
+  process, which continues even after this one exits. Only one process empties a
+  trash_dir at a time, holding a lock in locks_dir; others leave it to that one, which
+  carries on until the trash is empty, including anything moved there meanwhile.
+  """
+  if not os.path.isdir(trash_dir) or not os.listdir(trash_dir):
+    return
+  if background:
+    # Run as a module, found on the path this one was imported from, rather than as a
+    # script path, so this works however the package is installed, even zipped.
+    path_entry = os.path.abspath(__file__)
+    for _ in __name__.split("."):
+      path_entry = os.path.dirname(path_entry)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [path_entry, os.environ.get("PYTHONPATH")])))
+    with open(os.devnull, "r+b") as devnull:
+      subprocess.Popen([sys.executable, "-m", __name__, "--empty-trash", trash_dir, locks_dir],
+                       stdin=devnull, stdout=devnull, stderr=devnull, env=env,
+                       close_fds=True, preexec_fn=os.setsid)
+    log.info("deleting trash in the background: %s", trash_dir)
+  else:
+    lock = locks.FileLock(os.path.join(locks_dir, TRASH_LOCK))
+    if not lock.acquire(wait=False):
+      log.debug("trash is being emptied by another process: %s", trash_dir)
+      return
+    try:
+      names = os.listdir(trash_dir)
+      while names:
+        for name in names:
+          remove_tree(os.path.join(trash_dir, name))
+        names = os.listdir(trash_dir)
+    finally:
+      lock.release()
+
+
+if __name__ == "__main__":
+  # Run as a separate process to empty the trash.
+  if len(sys.argv) == 4 and sys.argv[1] == "--empty-trash":
+    empty_trash(sys.argv[2], sys.argv[3])
+  else:
+    sys.exit("usage: %s --empty-trash DIR LOCKS_DIR" % sys.argv[0])
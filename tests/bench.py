@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+"""
+Benchmarks of publish and install, end to end, on synthetic trees.
+
+Each tree is generated once, from a fixed seed, so runs are comparable: a node_modules
+shaped tree of many small files, a few large files of random data, and deep chains of
+symlinks. Each is published in each archive format (and as content-addressed blobs),
+with a local cp-based transport, then installed with each install method, both into an
+empty cache (so the download and extraction are included) and from the cache.
+
+Each run records wall time, CPU time, peak RSS, and bytes written to disk (which aren't
+counted on tmpfs), of instaclone and the commands it runs. Results are written as JSON,
+and if a baseline from an earlier run is given, compared with it: any run that got slower
+or bigger by more than the threshold is reported, and the exit status is 1.
+
+Usage:
+  tests/bench.py --profile quick
+  tests/bench.py --profile full --output baseline.json
+  tests/bench.py --profile full --baseline baseline.json --trees node_modules --methods symlink,fastcopy
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import argparse
+import errno
+import json
+import os
+import platform
+import random
+import shutil
+import stat
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from distutils.spawn import find_executable
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(BASE_DIR, "..", "instaclone", "main.py")
+
+RESULTS_FORMAT = 1
+
+PROFILES = {
+  "quick": {"files": 2000, "blobs": 3, "blob_size": 16 * 2 ** 20, "chains": 10, "chain_depth": 10},
+  "full": {"files": 100000, "blobs": 3, "blob_size": 2 * 2 ** 30, "chains": 100, "chain_depth": 40},
+}
+
+TREES = ["node_modules", "blobs", "symlinks"]
+
+# Archive formats, with the command each needs, and "content" for content-addressed storage.
+FORMATS = OrderedDict([("tar.gz", None), ("tar.zst", "zstd"), ("tar.lz4", "lz4"), ("tar.xz", "xz"),
+                       ("zip", "zip"), ("content", None)])
+
+METHODS = ["symlink", "copy", "fastcopy", "hardlink", "reflink"]
+
+METRICS = ["wall_seconds", "cpu_seconds", "peak_rss_bytes", "bytes_written"]
+
+SEED = 1234
+
+CHUNK_SIZE = 2 ** 20
+
+_WORDS = ("function var return this require module exports prototype undefined null "
+          "length value callback error options object string number array index key "
+          "self args result data buffer stream event emit listener").split()
+
+
+def _random_bytes(rng, size):
+  return ("%0*x" % (2 * size, rng.getrandbits(8 * size))).decode("hex") if size else ""
+
+
+def _random_text(rng, size):
+  words = []
+  length = 0
+  while length < size:
+    word = rng.choice(_WORDS)
+    words.append(word)
+    length += len(word) + 1
+  return " ".join(words)[:size]
+
+
+def _write(path, data):
+  parent = os.path.dirname(path)
+  if not os.path.isdir(parent):
+    os.makedirs(parent)
+  with open(path, "wb") as f:
+    f.write(data)
+
+
+def _make_node_modules(root, spec, rng):
+  """Packages, each with a few source files, some with their own nested node_modules."""
+  count = 0
+  packages = [os.path.join(root, "node_modules")]
+  number = 0
+  while count < spec["files"]:
+    parent = rng.choice(packages[:50])
+    package = os.path.join(parent, "package-%d" % number)
+    number += 1
+    if len(packages) < 2000 and rng.random() < 0.3:
+      packages.append(os.path.join(package, "node_modules"))
+    _write(os.path.join(package, "package.json"),
+           json.dumps({"name": os.path.basename(package), "version": "1.0.%d" % number}))
+    _write(os.path.join(package, "README.md"), _random_text(rng, int(rng.lognormvariate(7, 1))))
+    count += 2
+    for i in range(min(rng.randint(1, 12), spec["files"] - count)):
+      _write(os.path.join(package, "lib" if i else "", "file-%d.js" % i),
+             _random_text(rng, int(rng.lognormvariate(7, 1.2))))
+      count += 1
+
+
+def _make_blobs(root, spec, rng):
+  for number in range(spec["blobs"]):
+    with open(os.path.join(root, "blob-%d.bin" % number), "wb") as f:
+      remaining = spec["blob_size"]
+      while remaining > 0:
+        f.write(_random_bytes(rng, min(CHUNK_SIZE, remaining)))
+        remaining -= CHUNK_SIZE
+
+
+def _make_symlinks(root, spec, rng):
+  """Chains of relative symlinks to files, and to a directory, all within the tree."""
+  for chain in range(spec["chains"]):
+    _write(os.path.join(root, "data", "file-%d.txt" % chain), _random_text(rng, 4096))
+    chain_dir = os.path.join(root, "chains", "chain-%d" % chain)
+    os.makedirs(chain_dir)
+    for link in range(spec["chain_depth"]):
+      last = link == spec["chain_depth"] - 1
+      os.symlink("../../data/file-%d.txt" % chain if last else "link-%d" % (link + 1),
+                 os.path.join(chain_dir, "link-%d" % link))
+  dirs = os.path.join(root, "dirs")
+  os.makedirs(dirs)
+  for link in range(spec["chain_depth"]):
+    last = link == spec["chain_depth"] - 1
+    os.symlink("../data" if last else "dir-%d" % (link + 1), os.path.join(dirs, "dir-%d" % link))
+
+
+_MAKERS = {"node_modules": _make_node_modules, "blobs": _make_blobs, "symlinks": _make_symlinks}
+
+
+def generate(data_dir, tree, spec):
+  """Generate a tree, unless one was already generated with the same spec. Returns its path."""
+  root = os.path.join(data_dir, tree)
+  spec_path = root + ".json"
+  if os.path.isfile(spec_path):
+    with open(spec_path) as f:
+      if json.load(f) == spec:
+        return root
+  _remove(root)
+  print("generating %s tree: %s" % (tree, root), file=sys.stderr)
+  os.makedirs(root)
+  _MAKERS[tree](root, spec, random.Random("%s-%s" % (SEED, tree)))
+  with open(spec_path, "w") as f:
+    json.dump(spec, f)
+  return root
+
+
+def _remove(path):
+  """Delete a file, symlink, or tree, including read-only directories."""
+  if os.path.islink(path) or os.path.isfile(path):
+    os.unlink(path)
+  elif os.path.isdir(path):
+    for (dir_path, dir_names, _) in os.walk(path):
+      for name in dir_names:
+        sub_path = os.path.join(dir_path, name)
+        if not os.path.islink(sub_path):
+          os.chmod(sub_path, stat.S_IMODE(os.lstat(sub_path).st_mode) | stat.S_IRWXU)
+    os.chmod(path, stat.S_IMODE(os.lstat(path).st_mode) | stat.S_IRWXU)
+    shutil.rmtree(path, onerror=_ignore_missing)
+
+
+def _ignore_missing(function, path, exc_info):
+  if not (isinstance(exc_info[1], OSError) and exc_info[1].errno == errno.ENOENT):
+    raise exc_info[1]
+
+
+def _apparent_size(path):
+  total = 0
+  for (dir_path, _, file_names) in os.walk(path):
+    for name in file_names:
+      total += os.lstat(os.path.join(dir_path, name)).st_size
+  return total
+
+
+class Bench(object):
+  """Runs instaclone in a scratch directory, measuring each run."""
+
+  def __init__(self, bench_dir, python, logs_dir):
+    self.bench_dir = bench_dir
+    self.work_dir = os.path.join(bench_dir, "work")
+    self.home_dir = os.path.join(bench_dir, "home")
+    self.remote_dir = os.path.join(bench_dir, "remote")
+    self.python = python
+    self.logs_dir = logs_dir
+    for path in self.work_dir, self.home_dir, self.remote_dir, self.logs_dir:
+      if not os.path.isdir(path):
+        os.makedirs(path)
+    self.env = dict((key, value) for (key, value) in os.environ.iteritems()
+                    if not key.startswith("INSTACLONE_"))
+    self.env["INSTACLONE_DIR"] = self.home_dir
+
+  def write_config(self, tree, format, method):
+    item = OrderedDict([
+      ("local_path", tree),
+      ("remote_prefix", self.remote_dir),
+      ("remote_path", format),
+      ("version_string", "bench"),
+      ("upload_command", "install -D $LOCAL $REMOTE"),
+      ("download_command", "cp $REMOTE $LOCAL"),
+      ("install_method", method),
+    ])
+    if format == "content":
+      item["storage_mode"] = "content"
+    else:
+      item["archive_format"] = format
+    # JSON is valid YAML.
+    with open(os.path.join(self.work_dir, "instaclone.json"), "w") as f:
+      json.dump({"items": [item]}, f, indent=2)
+
+  def clear_cache(self):
+    self.wait_for_trash()
+    _remove(os.path.join(self.home_dir, "cache"))
+
+  def wait_for_trash(self, timeout=600):
+    """Wait for trash left by the last run to be deleted in the background, so it doesn't slow the next."""
+    trash_dir = os.path.join(self.home_dir, "cache", "trash")
+    deadline = time.time() + timeout
+    while os.path.isdir(trash_dir) and os.listdir(trash_dir) and time.time() < deadline:
+      time.sleep(0.1)
+
+  def run(self, name, args):
+    """Run instaclone, returning its measurements, or raising if it fails."""
+    self.wait_for_trash()
+    log_path = os.path.join(self.logs_dir, name.replace("/", "_") + ".log")
+    with open(log_path, "w") as log_file:
+      start = time.time()
+      process = subprocess.Popen([self.python, MAIN] + args, cwd=self.work_dir, env=self.env,
+                                 stdin=open(os.devnull), stdout=log_file, stderr=log_file)
+      # The usage of the process includes that of all commands it ran and waited for.
+      (_, status, usage) = os.wait4(process.pid, 0)
+      wall = time.time() - start
+      process.returncode = status
+    if status:
+      raise RuntimeError("%s failed with status %s (see %s)" % (name, status, log_path))
+    return OrderedDict([
+      ("wall_seconds", round(wall, 3)),
+      ("cpu_seconds", round(usage.ru_utime + usage.ru_stime, 3)),
+      ("user_seconds", round(usage.ru_utime, 3)),
+      ("system_seconds", round(usage.ru_stime, 3)),
+      # Linux reports kilobytes.
+      ("peak_rss_bytes", usage.ru_maxrss * 1024),
+      ("bytes_written", usage.ru_oublock * 512),
+    ])
+
+
+def _median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+
+def _measure(bench, name, args, before, repeat):
+  """Run a benchmark repeat times, calling before first each time. Returns the median of each metric."""
+  runs = []
+  for _ in range(repeat):
+    before()
+    runs.append(bench.run(name, args))
+  result = OrderedDict((key, _median([run[key] for run in runs])) for key in runs[0])
+  print("%-40s %8.2fs wall %8.2fs cpu %8.1fM rss %8.1fM written" %
+        (name, result["wall_seconds"], result["cpu_seconds"], result["peak_rss_bytes"] / 2.0 ** 20,
+         result["bytes_written"] / 2.0 ** 20), file=sys.stderr)
+  return result
+
+
+def run_benchmarks(bench, sources, formats, methods, repeat):
+  results = []
+
+  def add(name, tree, format, method, phase, measure):
+    entry = OrderedDict([("name", name), ("tree", tree), ("format", format), ("method", method),
+                         ("phase", phase)])
+    try:
+      entry.update(measure())
+    except RuntimeError as e:
+      print("error: %s" % e, file=sys.stderr)
+      entry["error"] = str(e)
+    results.append(entry)
+    return "error" not in entry
+
+  for (tree, source) in sources.iteritems():
+    local_path = os.path.join(bench.work_dir, tree)
+    for format in formats:
+
+      def before_publish():
+        bench.clear_cache()
+        _remove(os.path.join(bench.remote_dir, format))
+        _remove(local_path)
+        subprocess.check_call(["cp", "-a", source, local_path])
+
+      bench.write_config(tree, format, "symlink")
+
+      def measure_publish():
+        result = _measure(bench, name, ["publish", tree], before_publish, repeat)
+        result["remote_bytes"] = _apparent_size(os.path.join(bench.remote_dir, format))
+        return result
+
+      name = "%s/%s/publish" % (tree, format)
+      if not add(name, tree, format, None, "publish", measure_publish):
+        continue
+
+      for method in methods:
+        bench.write_config(tree, format, method)
+        name = "%s/%s/%s/install_cold" % (tree, format, method)
+        add(name, tree, format, method, "install_cold",
+            lambda: _measure(bench, name, ["install", tree],
+                             lambda: (bench.clear_cache(), _remove(local_path)), repeat))
+        name = "%s/%s/%s/install_warm" % (tree, format, method)
+        add(name, tree, format, method, "install_warm",
+            lambda: _measure(bench, name, ["install", tree], lambda: _remove(local_path), repeat))
+  return results
+
+
+def compare(results, baseline, threshold, min_seconds, min_bytes):
+  """
+  Compare results with a baseline, by name. Returns the comparisons, and the names of
+  runs with a metric that grew by more than threshold, as a fraction, and by more than
+  min_seconds or min_bytes.
+  """
+  baseline_by_name = dict((entry["name"], entry) for entry in baseline["results"] if "error" not in entry)
+  comparisons = []
+  regressions = []
+  for entry in results:
+    base = baseline_by_name.get(entry["name"])
+    if not base or "error" in entry:
+      continue
+    changes = OrderedDict()
+    regressed = []
+    for metric in METRICS:
+      (old, new) = (base.get(metric), entry.get(metric))
+      if old is None or new is None:
+        continue
+      changes[metric] = OrderedDict([("baseline", old), ("current", new),
+                                     ("ratio", round(float(new) / old, 3) if old else None)])
+      minimum = min_seconds if metric.endswith("_seconds") else min_bytes
+      if new > old * (1 + threshold) and new - old > minimum:
+        regressed.append(metric)
+    comparisons.append(OrderedDict([("name", entry["name"]), ("changes", changes), ("regressed", regressed)]))
+    if regressed:
+      regressions.append(entry["name"])
+      print("regression: %s: %s" %
+            (entry["name"], ", ".join("%s %s -> %s" % (metric, changes[metric]["baseline"], changes[metric]["current"])
+                                      for metric in regressed)), file=sys.stderr)
+  return (comparisons, regressions)
+
+
+def _git_revision():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=BASE_DIR, stderr=open(os.devnull)).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def _split(value, choices, what):
+  items = [item.strip() for item in value.split(",") if item.strip()]
+  for item in items:
+    if item not in choices:
+      raise ValueError("Unknown %s: %s (choose from %s)" % (what, item, ", ".join(choices)))
+  return items
+
+
+def main():
+  parser = argparse.ArgumentParser(description="Benchmark instaclone publish and install",
+                                   formatter_class=argparse.RawTextHelpFormatter, epilog=__doc__)
+  parser.add_argument("--profile", choices=sorted(PROFILES), default="quick",
+                      help="sizes of the synthetic trees (default quick)")
+  parser.add_argument("--files", type=int, help="override: number of files in the node_modules tree")
+  parser.add_argument("--blob-size", type=int, help="override: size in bytes of each large file")
+  parser.add_argument("--trees", default=",".join(TREES), help="comma-separated trees (default all)")
+  parser.add_argument("--formats", help="comma-separated formats (default all whose commands are installed)")
+  parser.add_argument("--methods", default=",".join(METHODS), help="comma-separated install methods (default all)")
+  parser.add_argument("--repeat", type=int, default=1, help="runs of each benchmark, taking the median (default 1)")
+  parser.add_argument("--dir", default="/tmp/instaclone-bench",
+                      help="scratch directory; generated trees are kept and reused (default /tmp/instaclone-bench)")
+  parser.add_argument("--python", default=sys.executable, help="Python to run instaclone with")
+  parser.add_argument("--output", help="JSON file to write results to (default results.json in --dir)")
+  parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+  parser.add_argument("--threshold", type=float, default=0.2,
+                      help="fraction a metric may grow over the baseline (default 0.2)")
+  parser.add_argument("--min-seconds", type=float, default=0.5,
+                      help="ignore changes in time smaller than this (default 0.5)")
+  parser.add_argument("--min-bytes", type=int, default=2 ** 20,
+                      help="ignore changes in size smaller than this (default 1M)")
+  args = parser.parse_args()
+
+  spec = dict(PROFILES[args.profile])
+  if args.files is not None:
+    spec["files"] = args.files
+  if args.blob_size is not None:
+    spec["blob_size"] = args.blob_size
+  trees = _split(args.trees, TREES, "tree")
+  formats = _split(args.formats, FORMATS, "format") if args.formats else \
+    [format for (format, command) in FORMATS.iteritems() if not command or find_executable(command)]
+  methods = _split(args.methods, METHODS, "install method")
+
+  data_dir = os.path.join(args.dir, "data")
+  sources = OrderedDict((tree, generate(data_dir, tree, spec)) for tree in trees)
+  bench_dir = os.path.join(args.dir, "run")
+  _remove(bench_dir)
+  bench = Bench(bench_dir, args.python, os.path.join(args.dir, "logs"))
+  results = run_benchmarks(bench, sources, formats, methods, args.repeat)
+  _remove(bench_dir)
+
+  report = OrderedDict([
+    ("format", RESULTS_FORMAT),
+    ("created", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())),
+    ("profile", args.profile),
+    ("spec", spec),
+    ("repeat", args.repeat),
+    ("revision", _git_revision()),
+    ("platform", platform.platform()),
+    ("python", platform.python_version()),
+    ("cpus", os.sysconf("SC_NPROCESSORS_ONLN")),
+    ("results", results),
+  ])
+  regressions = []
+  if args.baseline:
+    with open(args.baseline) as f:
+      baseline = json.load(f)
+    if baseline.get("spec") != spec:
+      print("warning: baseline used other tree sizes: %s" % baseline.get("spec"), file=sys.stderr)
+    (report["comparisons"], regressions) = compare(results, baseline, args.threshold, args.min_seconds,
+                                                   args.min_bytes)
+    report["regressions"] = regressions
+
+  output = args.output or os.path.join(args.dir, "results.json")
+  with open(output, "w") as f:
+    json.dump(report, f, indent=2)
+    f.write("\n")
+  print("results: %s" % output, file=sys.stderr)
+  failures = [entry["name"] for entry in results if "error" in entry]
+  if failures:
+    print("%s benchmarks failed: %s" % (len(failures), ", ".join(failures)), file=sys.stderr)
+  if regressions:
+    print("%s benchmarks regressed against %s" % (len(regressions), args.baseline), file=sys.stderr)
+  return 1 if failures or regressions else 0
+
+
+if __name__ == '__main__':
+  try:
+    sys.exit(main())
+  except IOError as e:
+    if e.errno != errno.EPIPE:
+      raise
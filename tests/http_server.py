@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+A minimal HTTP server over a directory, for testing http:// remotes: GET (with a Range
+from an offset), and PUT (with a Content-Length or chunked), with connections kept alive.
+
+Usage: http_server.py ROOT_DIR PORT
+"""
+
+from __future__ import print_function
+
+__author__ = 'jlevy'
+
+import BaseHTTPServer
+import errno
+import os
+import SocketServer
+import sys
+import urllib
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  root = None
+
+  def _path(self):
+    return os.path.join(self.root, urllib.unquote(self.path).lstrip("/"))
+
+  def _reply(self, status, body=""):
+    self.send_response(status)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    path = self._path()
+    if not os.path.isfile(path):
+      self._reply(404)
+      return
+    with open(path, "rb") as f:
+      data = f.read()
+    byte_range = self.headers.get("Range")
+    if byte_range:
+      offset = int(byte_range.split("=", 1)[1].rstrip("-"))
+      if offset >= len(data):
+        self._reply(416)
+      else:
+        self._reply(206, data[offset:])
+    else:
+      self._reply(200, data)
+
+  def _read_chunked(self):
+    parts = []
+    while True:
+      size = int(self.rfile.readline().strip(), 16)
+      if size == 0:
+        self.rfile.readline()
+        return "".join(parts)
+      parts.append(self.rfile.read(size))
+      self.rfile.readline()
+
+  def do_PUT(self):
+    if self.headers.get("Transfer-Encoding") == "chunked":
+      data = self._read_chunked()
+    else:
+      data = self.rfile.read(int(self.headers["Content-Length"]))
+    path = self._path()
+    try:
+      os.makedirs(os.path.dirname(path))
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+    with open(path, "wb") as f:
+      f.write(data)
+    self._reply(201)
+
+  def log_message(self, format, *args):
+    pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+
+def main():
+  if len(sys.argv) != 3:
+    print("Usage: %s ROOT_DIR PORT" % sys.argv[0], file=sys.stderr)
+    sys.exit(2)
+  Handler.root = sys.argv[1]
+  Server(("127.0.0.1", int(sys.argv[2])), Handler).serve_forever()
+
+
+if __name__ == '__main__':
+  main()
@@ -39,6 +39,8 @@ $dir/tests.sh 2>&1 \
   | perl -pe '$|=1; s/File ".*\/([a-zA-Z0-9._]+.py)", line [0-9]*,/File "...\/\1", line __X,/g' \
   | perl -pe '$|=1; s/, line [0-9]*,/, line __X,/g' \
   | perl -pe '$|=1; s/partial.[a-z0-9]*/partial.__X/g' \
+  | perl -pe '$|=1; s/\b(instaclone-[a-z]+)\.[A-Za-z0-9_]{6}\b/\1.__X/g' \
+  | perl -pe '$|=1; s/\d{4}-\d\d-\d\d \d\d:\d\d/__DATE/g' \
   | perl -pe '$|=1; s/ at 0x[0-9a-f]*/ at 0x__X/g' \
   | perl -pe '$|=1; s/[0-9.:T-]*Z/__TIMESTAMP/g' \
   | perl -pe '$|=1; s|s3://[a-zA-Z0-9_-]+/|s3://__BUCKET/|g' \
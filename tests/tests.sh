@@ -77,7 +77,9 @@ run publish || expect_error
 
 run install -f
 
-find $HOME/.instaclone/cache -type f
+# Trash, locks, and the index change from run to run, so they're left out.
+find $HOME/.instaclone/cache -type f -not -path "*/trash/*" -not -path "*/locks/*" -not -name "*.lock" \
+  -not -name "index.sqlite*"
 
 # Try cleaning cache again and re-installing.
 
@@ -88,6 +90,9 @@ run install || expect_error
 
 run install -f
 
+# Install all items again, several at once.
+run install -f --jobs 3
+
 # Check contents once more.
 ls_portable
 
@@ -117,6 +122,230 @@ rm -rf $INSTACLONE_DIR
 
 run install -f
 
+# --- Features, with the items in features.yml, published to a local directory ---
+
+features="--config features.yml"
+rm -rf /tmp/instaclone-tests-remote
+
+# Streaming transfers, through a named pipe, and through stdin and stdout.
+cp -a $base_dir/work-dir/test-dir fifo-dir
+cp -a $base_dir/work-dir/test-dir stdio-dir
+
+run publish fifo-dir stdio-dir $features
+
+run purge
+
+run install fifo-dir stdio-dir -f $features
+
+diff -r $base_dir/work-dir/test-dir fifo-dir
+
+diff -r $base_dir/work-dir/test-dir stdio-dir
+
+# Each of the other archive formats.
+for format in zst lz4 xz zip; do
+  cp -a $base_dir/work-dir/test-dir $format-dir
+done
+
+run publish zst-dir lz4-dir xz-dir zip-dir $features
+
+run purge
+
+run install zst-dir lz4-dir xz-dir zip-dir -f $features
+
+for format in zst lz4 xz zip; do
+  diff -r $base_dir/work-dir/test-dir $format-dir
+done
+
+ls /tmp/instaclone-tests-remote/files/formats/*
+
+# An already compressed file over 1MiB, which each format stores in frames written by
+# instaclone itself rather than compressing it again.
+head -c 1500000 /dev/urandom > stored.gz
+
+for format in zst lz4 xz; do
+  rm -rf stored-dir
+  mkdir stored-dir
+  cp stored.gz stored-dir/
+  run publish stored-dir --archive-format tar.$format --version-string $format $features
+done
+
+run purge
+
+for format in zst lz4 xz; do
+  run install stored-dir -f --archive-format tar.$format --version-string $format $features
+  cmp stored.gz stored-dir/stored.gz
+done
+
+# A compression level out of range for the format is rejected before anything is published.
+run publish stored-dir --archive-format tar.zst --archive-level 25 --version-string bad-level $features || expect_error
+
+# Content storage, with files shared by two versions that differ in one file.
+cp -a $base_dir/work-dir/test-dir content-dir
+
+run publish content-dir $features
+
+rm content-dir
+cp -a $base_dir/work-dir/test-dir content-dir
+echo changed > content-dir/file-a
+
+run publish content-dir --version-string v2 $features
+
+run purge
+
+run install content-dir -f $features
+
+diff -r $base_dir/work-dir/test-dir content-dir
+
+run install content-dir -f --version-string v2 $features
+
+cat content-dir/file-a
+
+# The published versions of an item, and what the cache holds.
+run remote content-dir --list $features
+
+run remote content-dir $features
+
+run status
+
+# Shrink the cache, which evicts only versions that aren't installed.
+run gc --max-cache-size 0
+
+run status
+
+diff -r $base_dir/work-dir/test-dir/subdir content-dir/subdir
+
+# A cache filled before it had an index, where installs of its versions weren't recorded,
+# so gc keeps all of them, including the one content-dir links to, until they are installed again.
+rm -f $INSTACLONE_DIR/cache/index.sqlite*
+
+run status
+
+run gc --max-cache-size 0
+
+diff -r $base_dir/work-dir/test-dir/subdir content-dir/subdir
+
+# A hardlinked install, a directory of links to the files in the cache.
+run install zst-dir -f --install-method hardlink $features
+
+ls_portable zst-dir/
+
+ls -l zst-dir/file-a | awk '{print $2}'
+
+diff -r $base_dir/work-dir/test-dir zst-dir
+
+# A reflinked install, a writable copy (falling back to a plain copy where the
+# filesystem can't share blocks).
+run install lz4-dir -f --install-method reflink $features
+
+ls_portable lz4-dir/
+
+echo changed > lz4-dir/file-a
+
+run install lz4-dir -f --install-method reflink $features
+
+diff -r $base_dir/work-dir/test-dir lz4-dir
+
+# A fastcopy install of one version over another, which changes only the files that differ.
+rm content-dir
+
+run install content-dir --install-method fastcopy $features
+
+run install content-dir --install-method fastcopy --version-string v2 $features
+
+cat content-dir/file-a
+
+# Once the copy is edited, the next version is copied in full.
+echo edited > content-dir/file-b
+
+run install content-dir -f --install-method fastcopy $features
+
+diff -r $base_dir/work-dir/test-dir content-dir
+
+# A file and a directory large enough to be published in parts.
+seq 1 20000 > multipart-file
+cp -a $base_dir/work-dir/test-dir multipart-dir
+seq 1 50000 > multipart-dir/file-d
+
+run publish multipart-file multipart-dir $features
+
+ls /tmp/instaclone-tests-remote/files/multipart/*
+
+run purge
+
+run install multipart-file multipart-dir -f $features
+
+seq 1 20000 | diff - multipart-file
+
+seq 1 50000 | diff - multipart-dir/file-d
+
+# An http:// remote, served from a local directory.
+$base_dir/http_server.py /tmp/instaclone-tests-remote/http 8761 &
+http_server=$!
+trap 'kill $http_server' EXIT
+sleep 1
+
+cp -a $base_dir/work-dir/test-dir http-dir
+
+run publish http-dir $features
+
+run purge
+
+run install http-dir -f $features
+
+diff -r $base_dir/work-dir/test-dir http-dir
+
+ls /tmp/instaclone-tests-remote/http/instaclone/http/*
+
+# Prefetch versions into the cache ahead of installing them.
+run purge
+
+run prefetch content-dir --versions v1,v2 $features
+
+run prefetch content-dir --versions v1,v2 $features
+
+run status
+
+run install content-dir -f --version-string v2 $features
+
+run prefetch content-dir --versions v3 $features || expect_error
+
+# Two processes installing the same version at once, into an empty cache, which is
+# downloaded once, by whichever gets there first.
+run purge
+
+run install multipart-dir --local-path locked-dir1 $features > locked-dir1.log 2>&1 &
+install1=$!
+run install multipart-dir --local-path locked-dir2 $features > locked-dir2.log 2>&1 &
+install2=$!
+wait $install1
+wait $install2
+
+cat locked-dir1.log locked-dir2.log | grep -c "^downloaded and extracted"
+
+diff -r multipart-dir locked-dir1
+
+diff -r multipart-dir locked-dir2
+
+# A shared cache, which keeps what is installed, so once the local cache is purged,
+# an item is installed from it with no download (the download command would fail).
+export INSTACLONE_SHARED_CACHE=/tmp/instaclone-tests-shared
+rm -rf $INSTACLONE_SHARED_CACHE
+mkdir $INSTACLONE_SHARED_CACHE
+
+run purge
+
+run install stdio-dir -f $features
+
+ls $INSTACLONE_SHARED_CACHE/cache/contents/tmp/instaclone-tests-remote/commands/stream
+
+run purge
+
+run install stdio-dir -f --download-command false $features
+
+diff -r $base_dir/work-dir/test-dir stdio-dir
+
+unset INSTACLONE_SHARED_CACHE
+
 # Leave files installed in case it's helpful to debug anything.
 
 # --- End of tests ---